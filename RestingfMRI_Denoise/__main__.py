@@ -8,12 +8,25 @@ from os.path import dirname, abspath, join, exists, isfile, abspath
 import sys
 import RestingfMRI_Denoise.utils.utils as ut
 from RestingfMRI_Denoise.workflows.base import init_denoise_wf, config
+from RestingfMRI_Denoise.workflows.executor import (run_denoise, screen_pipelines, watch_denoise, grab_runs,
+                                                    load_pipelines, POLL_INTERVAL, STABLE_SECONDS, GROUP_INTERVAL)
 from RestingfMRI_Denoise.utils import profiler_callback
+from RestingfMRI_Denoise.utils.instrumentation import enable_stage_log, stage_log_path
+from RestingfMRI_Denoise.utils.profile_summary import create_profile_summary
+from RestingfMRI_Denoise.utils.cost_estimate import estimate_cost, format_estimate, save_estimate
+from RestingfMRI_Denoise.utils.lifecycle import drop_unused_designs
 from RestingfMRI_Denoise.utils.json_validator import is_valid
+from RestingfMRI_Denoise.utils.pipeline_grid import load_grid, write_grid
+from RestingfMRI_Denoise.utils.compcor import COMPCOR_MODES
+from RestingfMRI_Denoise.utils.temporal_filter import TEMPORAL_FILTERS
 from RestingfMRI_Denoise.pipelines import (get_pipelines_paths,
                                    get_pipelines_names,
                                    get_pipeline_path)
-from RestingfMRI_Denoise.parcellation import get_parcelation_file_path
+from RestingfMRI_Denoise.parcellation import get_parcelation_file_path, get_parcellation_name
+from RestingfMRI_Denoise.utils.seed_maps import SEED_RADIUS, parse_seed
+from RestingfMRI_Denoise.utils.screening import N_BOOTSTRAP
+from RestingfMRI_Denoise.utils.thread_budget import (ThreadBudgetMultiProcPlugin, available_cpus, set_thread_limit,
+                                                     threads_per_worker)
 
 HIGH_PASS_DEFAULT = 0.008
 LOW_PASS_DEFAULT = 0.08
@@ -42,10 +55,18 @@ def get_parser() -> argparse.ArgumentParser:
                         nargs='+',
                         help='Name of pipelines used for denoising, can be both paths to json files with pipeline or name of pipelines from package.',
                         default="all")
+    parser.add_argument("--pipeline-grid",
+                        nargs='+',
+                        default=[],
+                        help="Json files with pipeline grid specifications (base pipeline and lists of values of \
+                        pipeline settings, e.g. spike thresholds). Generated pipelines are written to \
+                        WORK_DIR/pipeline_grid and used instead of package pipelines unless --pipelines is given.")
     parser.add_argument("-pa", "--parcellation",
                         nargs='+',
-                        help='Name of parcellation used for denoising.',
-                        default="Schaefer2018_200Parcels_7Networks_order_FSLMNI152_1mm")
+                        help='Name (or list) of parcellations used for connectivity estimation, can be both names \
+                        of parcellations from package or paths to parcellation files. Time series of all \
+                        parcellations are extracted in single pass over denoised data.',
+                        default=["Schaefer2018_200Parcels_7Networks_order_FSLMNI152_1mm"])
     parser.add_argument("-d", "--derivatives",
                         nargs="+",
                         default=['fmriprep'],
@@ -62,7 +83,8 @@ def get_parser() -> argparse.ArgumentParser:
     parser.add_argument("--profiler",
                         type=str,
                         help="Run profiler along workflow execution to estimate resources usage \
-                        PROFILER is path to output log file.")
+                        PROFILER is path to output log file. Stage-level records of interfaces \
+                        are stored next to it in PROFILER_stages.jsonl file.")
     parser.add_argument("-g", "--debug",
                         help="Run RestingfMRI_Denoise in debug mode - richer output, stops on first unchandled exception.",
                         action="store_true")
@@ -70,9 +92,152 @@ def get_parser() -> argparse.ArgumentParser:
                         type=str,
                         help="Create workflow graph at GRAPH path")
     parser.add_argument("--dry",
-                        help="Perform everything except actually running workflow",
+                        help="Perform everything except actually running workflow. Prints estimate of CPU time, \
+                        peak memory per node and bytes written to work dir and derivatives of every stage, \
+                        based on NIfTI headers and confounds of selected runs.",
                         action="store_true",
                         default=False)
+    parser.add_argument("--dry-json",
+                        type=str,
+                        default=None,
+                        help="Save cost estimate of dry run to DRY_JSON file.")
+    parser.add_argument("--dry-calibration",
+                        nargs='+',
+                        default=[],
+                        help="Profiler logs or stage logs (PROFILER_stages.jsonl) of earlier runs of the same \
+                        cohort used to calibrate cost estimate of dry run. Stage log of --profiler is used \
+                        when it exists.")
+    parser.add_argument("--engine",
+                        choices=["nipype", "inprocess", "cohort"],
+                        default="nipype",
+                        help="Execution engine. 'nipype' builds nipype workflow, 'inprocess' runs the same stages \
+                        as python calls over process pool with minimal checkpoint per run, 'cohort' denoises \
+                        parcel signals of all runs and pipelines at once with batched regression (fast QC sweep, \
+                        approximates voxelwise denoising, no denoised images), default nipype.")
+    parser.add_argument("--n-procs",
+                        type=int,
+                        default=None,
+                        help="Number of parallel processes (MultiProc plugin for nipype engine), \
+                        by default nipype runs serially and inprocess engine uses all cpus.")
+    parser.add_argument("--denoise-threads",
+                        type=int,
+                        default=1,
+                        help="Number of threads used by each denoising job to smooth and clean chunks of image, \
+                        results do not depend on number of threads, default 1.")
+    parser.add_argument("--cpu-budget",
+                        type=int,
+                        default=None,
+                        help="Number of cores available to the whole run. BLAS/OpenMP threads of each parallel \
+                        worker are limited to CPU_BUDGET // N_PROCS (times number of processes declared by \
+                        node), effective numbers are stored in profiler log. By default all available cpus.")
+    parser.add_argument("--motion-gate",
+                        help="Exclude runs with high motion (mean FD or max FD above threshold) before denoising. \
+                        Excluded runs are listed in group confounds summary and report.",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--dfc-window",
+                        type=int,
+                        default=None,
+                        help="Window length (in volumes) of sliding-window dynamic connectivity, \
+                        dynamic connectivity is computed only if window is given.")
+    parser.add_argument("--dfc-step",
+                        type=int,
+                        default=1,
+                        help="Shift (in volumes) between consecutive windows, default 1.")
+    parser.add_argument("--dfc-taper",
+                        type=str,
+                        default="rectangular",
+                        help="Window taper: rectangular or window name accepted by scipy.signal.get_window \
+                        (e.g. hamming, hann), default rectangular.")
+    parser.add_argument("--seeds",
+                        nargs='+',
+                        default=None,
+                        help="Seeds of seed-to-voxel correlation maps computed for every run and pipeline: \
+                        paths to seed masks or MNI coordinates given as NAME:x,y,z (e.g. PCC:0,-52,18).")
+    parser.add_argument("--seed-radius",
+                        type=float,
+                        default=SEED_RADIUS,
+                        help=f"Radius (mm) of spherical seeds defined by coordinates, default {SEED_RADIUS}.")
+    parser.add_argument("--pilot",
+                        type=int,
+                        default=None,
+                        help="Screen pipelines on PILOT runs before processing the whole cohort: QC measures of \
+                        all pipelines are estimated with bootstrap confidence intervals on pilot runs and pipelines \
+                        clearly dominated by other pipeline are pruned. Decision trace is stored in \
+                        pipelines_screening.npz and in the report.")
+    parser.add_argument("--pilot-strategy",
+                        choices=["stratified", "random"],
+                        default="stratified",
+                        help="Selection of pilot runs: 'stratified' draws one run from each of PILOT strata of \
+                        mean FD, 'random' draws runs uniformly, default stratified.")
+    parser.add_argument("--pilot-bootstrap",
+                        type=int,
+                        default=N_BOOTSTRAP,
+                        help=f"Number of bootstrap resamples of pilot runs, default {N_BOOTSTRAP}.")
+    parser.add_argument("--pilot-seed",
+                        type=int,
+                        default=0,
+                        help="Seed of pilot selection and bootstrap, default 0.")
+    parser.add_argument("--watch",
+                        help="Watch mode: poll derivatives for runs completed by fMRIPrep, denoise every new run \
+                        as soon as its files are present and stable and refresh group QC and report periodically. \
+                        Uses in-process engine (parcel space with --engine cohort).",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--watch-interval",
+                        type=float,
+                        default=POLL_INTERVAL,
+                        help=f"Seconds between polls of derivatives in watch mode, default {POLL_INTERVAL}.")
+    parser.add_argument("--watch-stable",
+                        type=float,
+                        default=STABLE_SECONDS,
+                        help=f"Files of run must be unchanged between polls and at least WATCH_STABLE seconds \
+                        old to treat run as completed, default {STABLE_SECONDS}.")
+    parser.add_argument("--watch-group-interval",
+                        type=float,
+                        default=GROUP_INTERVAL,
+                        help=f"Minimal number of seconds between refreshes of group QC in watch mode, \
+                        default {GROUP_INTERVAL}.")
+    parser.add_argument("--watch-exit-idle",
+                        type=float,
+                        default=None,
+                        help="Stop watch mode after no new run was found for WATCH_EXIT_IDLE seconds, \
+                        by default watch runs until interrupted.")
+    parser.add_argument("--keep-intermediates",
+                        help="Keep denoised images and design cache in work dir. By default in-process engines \
+                        remove denoised image once its connectivity, seed maps and derivatives copy are done.",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--evict-intermediates",
+                        help="Remove denoised images of nipype engine once their consumers are done (in-process \
+                        engines do it by default). Nipype cache of evicted runs is lost: rerun in the same work \
+                        dir denoises them again and recomputes their downstream nodes.",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--work-quota",
+                        type=float,
+                        default=None,
+                        help="Quota of work dir in GB. Denoising jobs wait while running jobs would exceed it \
+                        and unused design cache entries are dropped first. By default work dir is not limited.")
+    parser.add_argument("--tsv-tables",
+                        help="Also export group-level tables (group confounds and motion summaries, QC-FC \
+                        summaries, edge weights, screening trace) as TSV next to .npz files.",
+                        action="store_true")
+    parser.add_argument("--compcor",
+                        choices=COMPCOR_MODES,
+                        default="fmriprep",
+                        help="Source of aCompCor regressors of aCompCor pipelines: 'fmriprep' uses a_comp_cor \
+                        columns of fMRIPrep confounds, 'anatomical' computes 5 white matter and 5 CSF components \
+                        from BOLD and fMRIPrep tissue segmentation with randomized SVD (cached once per run), \
+                        'temporal' also adds 5 tCompCor components, default fmriprep.")
+    parser.add_argument("--temporal-filter",
+                        choices=TEMPORAL_FILTERS,
+                        default="butterworth",
+                        help="Temporal filter engine: 'butterworth' filters every image with nilearn, 'fft' \
+                        computes the same filter from FFT response and low rank correction of run edges \
+                        precomputed once per TR, number of volumes and band (2-4 times faster cleaning, signals \
+                        equal nilearn up to 1e-4 SD for runs up to 1200 volumes, up to 6e-3 for longer band-passed \
+                        runs where nilearn loses precision), default butterworth.")
     parser.add_argument("-w", "--work_dir",
                         help="Path where intermediate results should be stored, default /tmp/RestingfMRI_Denoise/",
                         default="/tmp/RestingfMRI_Denoise/")
@@ -108,19 +273,58 @@ def parse_pipelines(pipelines_args: str or set = "all") -> set:
                 raise ValueError(f"File: '{p} is not a valid pipeline")
         return ret
 
-def parse_parcellation(parcellation_args: str):
+def parse_pipeline_grid(grid_paths: list, output_dir: str) -> set:
+    """
+    Expands pipeline grid specifications into pipeline json files (see
+    utils.pipeline_grid).
+    :param grid_paths: paths to json files with grid specifications
+    :param output_dir: directory of generated pipelines
+    :return: set of paths of generated pipelines
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    pipelines = [pipeline for path in grid_paths for pipeline in load_grid(path)]
+    return set(write_grid(pipelines, output_dir))
+
+def parse_parcellation(parcellation_args: str or list) -> list:
     """
     Parses all possible parcellation options:
-    :param parcellation_args: str.
-    :return: parcellation path.
+    :param parcellation_args: str or list, names of parcellations from
+    denoise.parcellation directory or paths to parcellation files.
+    :return: list of parcellation paths.
     """
     if type(parcellation_args) is str:
-        return get_parcelation_file_path(parcellation_args)
-    else: 
-        raise ValueError("Only string argument is valid!")
+        parcellation_args = [parcellation_args]
+    ret = []
+    for p in parcellation_args:
+        if isfile(p):
+            ret.append(abspath(p))
+        else:
+            ret.append(get_parcelation_file_path(p))
+    if len(set(get_parcellation_name(p) for p in ret)) != len(ret):
+        raise ValueError("Parcellations must have unique file names")
+    return ret
+
+def parse_seeds(seeds_args: list or None) -> list or None:
+    """
+    Parses seeds options, mask files are replaced by absolute paths.
+    :param seeds_args: list of paths to seed masks or coordinates NAME:x,y,z.
+    :return: list of seeds or None if no seeds were given.
+    """
+    if not seeds_args:
+        return None
+    ret = [abspath(seed) if isfile(seed) else seed for seed in seeds_args]
+    names = [parse_seed(seed)[0] for seed in ret]
+    if len(set(names)) != len(names):
+        raise ValueError("Seeds must have unique names")
+    return ret
 
-def main() -> None:
-    args = get_parser().parse_args()
+def main(argv: list = None, pool=None) -> None:
+    """
+    Runs RestingfMRI_Denoise with command line arguments.
+    :param argv: arguments, by default sys.argv[1:]
+    :param pool: process pool of in-process engines kept warm by daemon
+    """
+    args = get_parser().parse_args(argv)
     workflow_args = dict()
     # bids dir
     if str(args.bids_dir).startswith("./"):
@@ -143,24 +347,174 @@ def main() -> None:
         else:
             os.makedirs(dirname(profiler_path), exist_ok=True)
         logger = logging.getLogger('callback')
+        for handler in list(logger.handlers):  # handlers of previous job of daemon
+            logger.removeHandler(handler)
         logger.setLevel(logging.DEBUG)
         handler = logging.FileHandler(profiler_path)
         logger.addHandler(handler)
         config.enable_resource_monitor()
+        enable_stage_log(stage_log_path(profiler_path))
     # derivatives
     derivatives = args.derivatives if type(args.derivatives) in (list, bool) else [args.derivatives]
     derivatives = list(map(lambda x: join(input_dir, 'derivatives', x), derivatives))
     # pipelines
     pipelines_paths = parse_pipelines(args.pipelines)
+    if args.pipeline_grid:
+        grid_paths = parse_pipeline_grid(args.pipeline_grid, join(args.work_dir, 'pipeline_grid'))
+        pipelines_paths = grid_paths if args.pipelines == "all" else pipelines_paths | grid_paths
+    # parcellations
+    parcellation_paths = parse_parcellation(args.parcellation)
+    # seeds
+    seeds = parse_seeds(args.seeds)
+    # dry run cost estimate
+    if args.dry:
+        stage_logs = list(args.dry_calibration)
+        if args.profiler is not None and exists(stage_log_path(profiler_path)):
+            stage_logs.append(profiler_path)
+        # watch mode runs in-process engine
+        engine = "inprocess" if args.watch and args.engine == "nipype" else args.engine
+        if engine == "nipype":
+            n_workers = args.n_procs if args.n_procs is not None and args.n_procs > 1 else 1
+        else:
+            n_workers = args.n_procs or available_cpus()
+        table, totals = estimate_cost(grab_runs(input_dir, derivatives, args.tasks, args.sessions, args.subjects,
+                                                False, skip_incomplete=args.watch),
+                                      load_pipelines(pipelines_paths),
+                                      parcellation_paths,
+                                      engine=engine,
+                                      n_workers=n_workers,
+                                      seeds=seeds,
+                                      keep_intermediates=args.keep_intermediates or (
+                                          engine == "nipype" and not args.evict_intermediates),
+                                      compcor=args.compcor,
+                                      temporal_filter=args.temporal_filter,
+                                      stage_logs=stage_logs)
+        print(format_estimate(table, totals))
+        if args.dry_json is not None:
+            save_estimate(table, totals, args.dry_json)
+    # watch mode
+    if args.watch:
+        if args.pilot is not None:
+            raise ValueError("Pilot screening is not available in watch mode")
+        if not args.dry:
+            watch_denoise(input_dir,
+                          derivatives=derivatives,
+                          parcellation_paths=parcellation_paths,
+                          subject=args.subjects,
+                          session=args.sessions,
+                          task=args.tasks,
+                          pipelines_paths=pipelines_paths,
+                          high_pass=args.high_pass,
+                          low_pass=args.low_pass,
+                          base_dir=args.work_dir,
+                          n_procs=args.n_procs,
+                          motion_gate=args.motion_gate,
+                          dfc_window=args.dfc_window,
+                          dfc_step=args.dfc_step,
+                          dfc_taper=args.dfc_taper,
+                          seeds=seeds,
+                          seed_radius=args.seed_radius,
+                          denoise_threads=args.denoise_threads,
+                          parcel_space=args.engine == "cohort",
+                          cpu_budget=args.cpu_budget,
+                          poll_interval=args.watch_interval,
+                          stable_seconds=args.watch_stable,
+                          group_interval=args.watch_group_interval,
+                          exit_idle=args.watch_exit_idle,
+                          keep_intermediates=args.keep_intermediates,
+                          work_quota=args.work_quota,
+                          tsv_tables=args.tsv_tables,
+                          compcor=args.compcor,
+                          temporal_filter=args.temporal_filter,
+                          pool=pool)
+            if args.profiler is not None:
+                create_profile_summary(profiler_path, join(input_dir, 'derivatives', 'denoise'))
+        return 0
+    # pilot screening
+    screening_trace = None
+    if args.pilot is not None and not args.dry:
+        pipelines_paths, screening_trace = screen_pipelines(input_dir,
+                                                            derivatives=derivatives,
+                                                            parcellation_paths=parcellation_paths,
+                                                            subject=args.subjects,
+                                                            session=args.sessions,
+                                                            task=args.tasks,
+                                                            pipelines_paths=pipelines_paths,
+                                                            high_pass=args.high_pass,
+                                                            low_pass=args.low_pass,
+                                                            base_dir=args.work_dir,
+                                                            n_procs=args.n_procs,
+                                                            motion_gate=args.motion_gate,
+                                                            denoise_threads=args.denoise_threads,
+                                                            parcel_space=args.engine == "cohort",
+                                                            cpu_budget=args.cpu_budget,
+                                                            pilot_size=args.pilot,
+                                                            pilot_strategy=args.pilot_strategy,
+                                                            n_bootstrap=args.pilot_bootstrap,
+                                                            seed=args.pilot_seed,
+                                                            keep_intermediates=args.keep_intermediates,
+                                                            work_quota=args.work_quota,
+                                                            tsv_tables=args.tsv_tables,
+                                                            compcor=args.compcor,
+                                                            temporal_filter=args.temporal_filter,
+                                                            pool=pool)
+    # in-process engines
+    if args.engine in ("inprocess", "cohort"):
+        if not args.dry:
+            run_denoise(input_dir,
+                        derivatives=derivatives,
+                        parcellation_paths=parcellation_paths,
+                        subject=args.subjects,
+                        session=args.sessions,
+                        task=args.tasks,
+                        pipelines_paths=pipelines_paths,
+                        high_pass=args.high_pass,
+                        low_pass=args.low_pass,
+                        base_dir=args.work_dir,
+                        n_procs=args.n_procs,
+                        motion_gate=args.motion_gate,
+                        dfc_window=args.dfc_window,
+                        dfc_step=args.dfc_step,
+                        dfc_taper=args.dfc_taper,
+                        seeds=seeds,
+                        seed_radius=args.seed_radius,
+                        denoise_threads=args.denoise_threads,
+                        parcel_space=args.engine == "cohort",
+                        cpu_budget=args.cpu_budget,
+                        screening_trace=screening_trace,
+                        keep_intermediates=args.keep_intermediates,
+                        work_quota=args.work_quota,
+                        tsv_tables=args.tsv_tables,
+                        compcor=args.compcor,
+                        temporal_filter=args.temporal_filter,
+                        pool=pool)
+            if args.profiler is not None:
+                create_profile_summary(profiler_path, join(input_dir, 'derivatives', 'denoise'))
+        return 0
     # creating workflow
     workflow = init_denoise_wf(input_dir,
                                    derivatives=derivatives,
+                                   parcellation_paths=parcellation_paths,
                                    subject=args.subjects,
                                    session=args.sessions,
                                    task=args.tasks,
                                    pipelines_paths=pipelines_paths,
                                    high_pass=args.high_pass,
-                                   low_pass=args.low_pass)
+                                   low_pass=args.low_pass,
+                                   motion_gate=args.motion_gate,
+                                   dfc_window=args.dfc_window,
+                                   dfc_step=args.dfc_step,
+                                   dfc_taper=args.dfc_taper,
+                                   seeds=seeds,
+                                   seed_radius=args.seed_radius,
+                                   denoise_threads=args.denoise_threads,
+                                   screening_trace=screening_trace,
+                                   evict_intermediates=args.evict_intermediates and not args.keep_intermediates,
+                                   work_quota=args.work_quota,
+                                   tsv_tables=args.tsv_tables,
+                                   compcor=args.compcor,
+                                   temporal_filter=args.temporal_filter,
+                                   base_dir=args.work_dir)
     # creating graph from workflow
     if args.graph is not None:
         try:  # TODO: Look for pydot/dot and add to requirements
@@ -171,7 +525,17 @@ def main() -> None:
     
     # dry
     if not args.dry:
-        workflow.run()
+        if args.n_procs is not None and args.n_procs > 1:
+            workflow_args['n_procs'] = args.n_procs
+            workflow_args['cpu_budget'] = args.cpu_budget
+            workflow.run(plugin=ThreadBudgetMultiProcPlugin(plugin_args=workflow_args))
+        else:
+            set_thread_limit(threads_per_worker(args.cpu_budget))
+            workflow.run(plugin_args=workflow_args)
+        if not args.keep_intermediates:
+            drop_unused_designs(join(args.work_dir, 'design_cache'))
+        if args.profiler is not None:
+            create_profile_summary(profiler_path, join(input_dir, 'derivatives', 'denoise'))
     return 0
 
 if __name__ == "__main__":
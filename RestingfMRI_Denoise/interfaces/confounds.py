@@ -1,13 +1,18 @@
-from os.path import join
+from os.path import join, exists
 from glob import glob
+import numpy as np
 import pandas as pd
 import json
 from nipype.interfaces.base import (
     BaseInterface, BaseInterfaceInputSpec, traits, File, TraitedSpec, SimpleInterface,
-    InputMultiObject, ImageFile, Directory
+    InputMultiObject, ImageFile, Directory, InputMultiPath, OutputMultiPath,
+    OutputMultiObject, isdefined
     )
 from nipype.utils.filemanip import split_filename
 from RestingfMRI_Denoise.utils.confound_prep import *
+from RestingfMRI_Denoise.utils.instrumentation import StageRecorder
+from RestingfMRI_Denoise.utils.tables import save_table
+from RestingfMRI_Denoise.utils.compcor import compute_compcor, add_compcor_components, N_COMPONENTS, EROSION
 
 class ConfoundsInputSpec(BaseInterfaceInputSpec):
     pipeline = traits.Dict(
@@ -27,6 +32,9 @@ class ConfoundsInputSpec(BaseInterfaceInputSpec):
     entities = traits.Dict(
         usedefault=True,
         desc='Per-file entities to include in filename')
+    conf_invariants = traits.Dict(
+        desc="Pipeline independent confounds measures (output of ConfInvariants), "
+             "computed by Confounds if not provided")
     output_dir = File(          # needed to save data in other directory
         desc="Output path")     # TODO: Implement temp dir
 
@@ -45,45 +53,39 @@ class Confounds(SimpleInterface):
     output_spec = ConfoundsOutputSpec
     def _run_interface(self, runtime):
         pipeline_name = self.inputs.pipeline['name']
+        recorder = StageRecorder('Confounds', self.inputs.entities, pipeline_name)
         fname = self.inputs.conf_raw
         json_path = self.inputs.conf_json
         tmpAROMA = self.inputs.fmri_prep_aroma
-        conf_df_raw = pd.read_csv(fname, sep='\t') 
+        with recorder.stage('read_confounds'):
+            conf_df_raw = pd.read_csv(fname, sep='\t') 
         taskID = self.inputs.entities['task']
+        # Pipeline independent measures are usually computed once per run by ConfInvariants
+        if isdefined(self.inputs.conf_invariants):
+            conf_invariants = self.inputs.conf_invariants
+        else:
+            conf_invariants = get_conf_invariants(conf_df_raw, json_path, [self.inputs.pipeline], fname, taskID,
+                                                  tmpAROMA, recorder)
         #prepare for generating confounds after AROMA
         if self.inputs.pipeline['aroma']:
-            path, base, _ = split_filename(fname)  # Path can be removed later
-            cur_mask = glob(path + '/*' + taskID + '*space-MNI152NLin2009cAsym*brain*mask.nii*')[0]
-            AromaConf_file = join(path, f"{base}_AROMA.tsv")
-      
-            cur_segm = glob(fname.split('/ses-')[0]+'/anat/*MNI152NLin2009cAsym_res-2_dseg.nii.gz')[0]
-            path_segm, base_segm, _ = split_filename(cur_segm)
-            tmpAROMAwm = join(path_segm, f"{base_segm}_wm.nii.gz")
-            tmpAROMAcsf = join(path_segm, f"{base_segm}_csf.nii.gz")
-            conf_df_aroma = get_aroma_regressor(conf_df_raw, cur_mask, cur_segm, AromaConf_file, tmpAROMAwm, tmpAROMAcsf, tmpAROMA)
-            conf_df_raw = conf_df_aroma        
-        # Load aCompCor list
-        with open(json_path, 'r') as json_file:
-            js = json.load(json_file)
-        a_comp_cor_csf, a_comp_cor_wm = ([] for _ in range(2))
-        for i in js.keys():
-            if i.startswith('a_comp_cor'):
-                if js[i]['Mask'] == 'CSF' and js[i]['Retained']:
-                    a_comp_cor_csf.append(i)
-                if js[i]['Mask'] == 'WM' and js[i]['Retained']:
-                    a_comp_cor_wm.append(i)
-        a_comp_cor = a_comp_cor_csf[:5] + a_comp_cor_wm[:5]
+            conf_df_raw = add_aroma_signals(conf_df_raw, conf_invariants['aroma_conf'])
+        # CompCor components computed from BOLD replace fMRIPrep aCompCor columns
+        if self.inputs.pipeline['confounds']['acompcor'] and conf_invariants.get('compcor'):
+            conf_df_raw = add_compcor_components(conf_df_raw, conf_invariants['compcor'])
+        a_comp_cor = conf_invariants['a_comp_cor']
         # Preprocess confound table according to pipeline
-        conf_df_prep = prep_conf_df(conf_df_raw, self.inputs.pipeline, a_comp_cor)
+        with recorder.stage('prep_confounds'):
+            conf_df_prep = prep_conf_df(conf_df_raw, self.inputs.pipeline, a_comp_cor)
         # Create new filename and save
         path, base, _ = split_filename(fname)  # Path can be removed later
         fname_prep = join(self.inputs.output_dir, f"{base}_prep_pipeline-{pipeline_name}.tsv")  # use output path
-        conf_df_prep.to_csv(fname_prep, sep='\t', index=False)        
+        with recorder.stage('save'):
+            conf_df_prep.to_csv(fname_prep, sep='\t', index=False)        
         # Creates dictionary with summary measures
         n_spikes = conf_df_prep.filter(regex='spike', axis=1).sum().sum()
-        mean_fd = conf_df_raw["framewise_displacement"].mean()
-        max_fd = conf_df_raw["framewise_displacement"].max()
-        n_timepoints = len(conf_df_raw)
+        mean_fd = conf_invariants['mean_fd']
+        max_fd = conf_invariants['max_fd']
+        n_timepoints = conf_invariants['n_timepoints']
         try:
             session = self.inputs.entities['session']
         except KeyError:
@@ -97,13 +99,18 @@ class Confounds(SimpleInterface):
                         "n_spikes": [n_spikes],
                         "perc_spikes": [(n_spikes/n_timepoints)*100],
                         "n_conf": [len(conf_df_prep.columns)],
-                        "include": [inclusion_check(n_timepoints, mean_fd, max_fd, n_spikes, 0.2)]
+                        "include": [inclusion_check(n_timepoints, mean_fd, max_fd, n_spikes, MEAN_FD_TH)],
+                        "processed": [1]
                         }
         self._results['conf_prep'] = fname_prep
         self._results['conf_summary'] = conf_summary
         self._results['pipeline_name'] = self.inputs.pipeline['name']
         return runtime
 
+MEAN_FD_TH = 0.2
+MAX_FD_TH = 5
+SPIKES_TH = 0.40
+
 def inclusion_check(n_timepoints, mean_fd, max_fd, n_spikes, fd_th):
     """
     Checking if participant is recommended to be excluded from analysis
@@ -120,15 +127,297 @@ def inclusion_check(n_timepoints, mean_fd, max_fd, n_spikes, fd_th):
     returns 0 if subject should be excluded due to head motion
     or 1 if there is no reason to exclude subject based on submitted threshold.
     """
-    if mean_fd > fd_th:
+    if not motion_check(mean_fd, max_fd, fd_th):
+        return 0
+    elif n_spikes/n_timepoints > SPIKES_TH:
         return 0
-    elif max_fd > 5:
+    else:
+        return 1
+
+def motion_check(mean_fd, max_fd, fd_th):
+    """
+    Pipeline independent part of inclusion_check (spikes depend on pipeline).
+    Run failing this check is excluded by inclusion_check for every pipeline.
+    Inputs
+    -------
+    mean_fd: mean framewise_displacement (FD)
+    max_fd: maximum FD
+    fd_th: threshold for mean FD
+    Outputs
+    -------
+    returns 0 if subject should be excluded due to head motion
+    or 1 if there is no reason to exclude subject based on submitted threshold.
+    """
+    if mean_fd > fd_th:
         return 0
-    elif n_spikes/n_timepoints > 0.40:
+    elif max_fd > MAX_FD_TH:
         return 0
     else:
         return 1
 
+class MotionGateInputSpec(BaseInterfaceInputSpec):
+    fmri_prep = InputMultiPath(ImageFile)
+    fmri_prep_aroma = InputMultiPath(ImageFile)
+    brain_mask = traits.List(traits.Either(ImageFile, None))
+    conf_raw = InputMultiPath(File(exists=True))
+    conf_json = InputMultiPath(File(exists=True))
+    entities = InputMultiObject(traits.Dict)
+    fd_th = traits.Float(
+        MEAN_FD_TH,
+        usedefault=True,
+        desc="Threshold for mean FD")
+
+class MotionGateOutputSpec(TraitedSpec):
+    fmri_prep = OutputMultiPath(ImageFile)
+    fmri_prep_aroma = OutputMultiPath(ImageFile)
+    brain_mask = traits.List(traits.Either(ImageFile, None))
+    conf_raw = OutputMultiPath(File)
+    conf_json = OutputMultiPath(File)
+    entities = OutputMultiObject(traits.Dict)
+    excluded_summary = traits.List(
+        traits.Dict,
+        desc="Confounds summaries of runs excluded before denoising")
+    excluded_runs = traits.List(
+        traits.Str,
+        desc="Names of runs excluded before denoising")
+
+class MotionGate(SimpleInterface):
+    """
+    Evaluates pipeline independent motion criteria (mean and max FD) from raw
+    confounds once per run and passes only runs that can be included by
+    at least one pipeline to further (voxelwise) processing.
+    Excluded runs are returned as confounds summaries, so they can still be
+    recorded in group confounds summary.
+    """
+    input_spec = MotionGateInputSpec
+    output_spec = MotionGateOutputSpec
+    def _run_interface(self, runtime):
+        keys = ['fmri_prep', 'fmri_prep_aroma', 'brain_mask', 'conf_raw', 'conf_json', 'entities']
+        passed = {key: [] for key in keys}
+        excluded_summary, excluded_runs = [], []
+        for i, entities in enumerate(self.inputs.entities):
+            conf_df_raw = pd.read_csv(self.inputs.conf_raw[i], sep='\t')
+            mean_fd = conf_df_raw["framewise_displacement"].mean()
+            max_fd = conf_df_raw["framewise_displacement"].max()
+            if motion_check(mean_fd, max_fd, self.inputs.fd_th):
+                for key in keys:
+                    values = getattr(self.inputs, key)
+                    if isdefined(values) and len(values) > i:
+                        passed[key].append(values[i])
+                continue
+            excluded_summary.append({
+                "subject": [entities['subject']],
+                "session": [entities.get('session', 0)],
+                "task": [entities['task']],
+                "mean_fd": [mean_fd],
+                "max_fd": [max_fd],
+                "n_spikes": [np.nan],
+                "perc_spikes": [np.nan],
+                "n_conf": [np.nan],
+                "include": [0],
+                "processed": [0]
+            })
+            excluded_runs.append("_".join(f"{key}-{entities[key]}"
+                                          for key in ('subject', 'session', 'task') if key in entities))
+        if not passed['entities']:
+            raise ValueError("All runs were excluded due to head motion")
+        self._results.update(passed)
+        self._results['excluded_summary'] = excluded_summary
+        self._results['excluded_runs'] = excluded_runs
+        return runtime
+
+class ConfInvariantsInputSpec(BaseInterfaceInputSpec):
+    pipelines = traits.List(
+        traits.Dict,
+        desc="All denoising pipelines",
+        mandatory=True)
+    conf_raw = File(
+        exist=True,
+        desc="Confounds table",
+        mandatory=True)
+    conf_json = File(
+        exist=True,
+        desc="Details aCompCor",
+        mandatory=True)
+    fmri_prep_aroma = ImageFile(
+        desc='ICA-Aroma preprocessed fMRI file',
+        mandatory=False)
+    entities = traits.Dict(
+        usedefault=True,
+        desc='Per-file entities to include in filename')
+    compcor = File(
+        exists=True,
+        desc="CompCor components computed from BOLD (output of CompCor), "
+             "used instead of fMRIPrep aCompCor columns")
+
+class ConfInvariantsOutputSpec(TraitedSpec):
+    conf_invariants = traits.Dict(
+        desc="Pipeline independent confounds measures")
+
+class ConfInvariants(SimpleInterface):
+    """
+    Computes pipeline independent part of confounds preprocessing once per
+    run (FD summary, aCompCor selection, AROMA tissue signals and number of
+    outlier scans for each pipeline), shared by Confounds of all pipelines.
+    """
+    input_spec = ConfInvariantsInputSpec
+    output_spec = ConfInvariantsOutputSpec
+    def _run_interface(self, runtime):
+        recorder = StageRecorder('ConfInvariants', self.inputs.entities)
+        with recorder.stage('read_confounds'):
+            conf_df_raw = pd.read_csv(self.inputs.conf_raw, sep='\t')
+        tmpAROMA = self.inputs.fmri_prep_aroma if isdefined(self.inputs.fmri_prep_aroma) else None
+        compcor = self.inputs.compcor if isdefined(self.inputs.compcor) else None
+        self._results['conf_invariants'] = get_conf_invariants(conf_df_raw,
+                                                               self.inputs.conf_json,
+                                                               self.inputs.pipelines,
+                                                               self.inputs.conf_raw,
+                                                               self.inputs.entities['task'],
+                                                               tmpAROMA,
+                                                               recorder,
+                                                               compcor)
+        return runtime
+
+class CompCorInputSpec(BaseInterfaceInputSpec):
+    fmri_prep = ImageFile(
+        exists=True,
+        desc='Preprocessed fMRI file',
+        mandatory=True)
+    brain_mask = traits.Either(
+        ImageFile, None,
+        desc='Brain mask, tissue masks are restricted to it (None for run without mask)')
+    entities = traits.Dict(
+        desc="entities dictionary",
+        mandatory=True)
+    tr_dict = traits.Dict(
+        desc="dictionary of tr for all tasks",
+        mandatory=True)
+    temporal = traits.Bool(
+        False,
+        usedefault=True,
+        desc="Also compute tCompCor components")
+    n_components = traits.Int(
+        N_COMPONENTS,
+        usedefault=True,
+        desc="Number of components per mask")
+    erosion = traits.Int(
+        EROSION,
+        usedefault=True,
+        desc="Erosion of white matter and CSF masks in voxels")
+    output_dir = File(
+        desc="Output path")
+
+class CompCorOutputSpec(TraitedSpec):
+    compcor = File(
+        exists=True,
+        desc="CompCor components and cosine regressors table")
+
+class CompCor(SimpleInterface):
+    """
+    Computes anatomical (white matter and CSF) and optionally temporal
+    CompCor components from preprocessed BOLD once per run, for datasets
+    without fMRIPrep aCompCor columns or with different mask erosion.
+    Components table is cached in output_dir and shared by all aCompCor
+    pipelines (see utils.compcor).
+    """
+    input_spec = CompCorInputSpec
+    output_spec = CompCorOutputSpec
+    def _run_interface(self, runtime):
+        recorder = StageRecorder('CompCor', self.inputs.entities)
+        _, base, _ = split_filename(self.inputs.fmri_prep)
+        mode = 'temporal' if self.inputs.temporal else 'anatomical'
+        compcor = join(self.inputs.output_dir if isdefined(self.inputs.output_dir) else runtime.cwd,
+                       f"{base}_compcor-{mode}_n-{self.inputs.n_components}_erosion-{self.inputs.erosion}.tsv")
+        if not exists(compcor):
+            with recorder.stage('compcor'):
+                compute_compcor(self.inputs.fmri_prep,
+                                self.inputs.tr_dict[self.inputs.entities['task']],
+                                compcor,
+                                brain_mask=self.inputs.brain_mask if isdefined(self.inputs.brain_mask) else None,
+                                temporal=self.inputs.temporal,
+                                n_components=self.inputs.n_components,
+                                erosion=self.inputs.erosion)
+        self._results['compcor'] = compcor
+        return runtime
+
+class GroupMotionInputSpec(BaseInterfaceInputSpec):
+    conf_invariants = traits.List(
+        traits.Dict,
+        desc="Outputs of ConfInvariants for all runs",
+        mandatory=True)
+    entities = InputMultiObject(traits.Dict)
+    excluded_summary = traits.List(
+        traits.Dict,
+        desc="Confounds summaries of runs excluded before denoising")
+    output_dir = File(
+        desc="Output path")
+    tsv = traits.Bool(
+        False,
+        usedefault=True,
+        desc="Also export table as TSV")
+
+class GroupMotionOutputSpec(TraitedSpec):
+    group_motion_summary = File(
+        exists=True,
+        desc="Motion summary of all runs")
+    motion_plot = File(
+        exists=True,
+        desc="Motion criterion plot")
+    exclude_list = traits.List(
+        traits.Str,
+        desc="List of subjects to exclude")
+
+class GroupMotion(SimpleInterface):
+    """
+    Motion summary, motion criterion plot and list of excluded subjects for
+    the whole cohort. Run is excluded if it fails inclusion_check for any
+    pipeline, so spikes criterion uses maximal number of outlier scans
+    across pipelines.
+    """
+    input_spec = GroupMotionInputSpec
+    output_spec = GroupMotionOutputSpec
+    def _run_interface(self, runtime):
+        from RestingfMRI_Denoise.utils.plotting import motion_plot
+        import seaborn as sns
+        recorder = StageRecorder('GroupMotion')
+        summaries = []
+        for conf_invariants, entities in zip(self.inputs.conf_invariants, self.inputs.entities):
+            n_spikes = max(conf_invariants['n_spikes'].values())
+            n_timepoints = conf_invariants['n_timepoints']
+            summaries.append({
+                "subject": [entities['subject']],
+                "session": [entities.get('session', 0)],
+                "task": [entities['task']],
+                "mean_fd": [conf_invariants['mean_fd']],
+                "max_fd": [conf_invariants['max_fd']],
+                "n_spikes": [n_spikes],
+                "perc_spikes": [(n_spikes/n_timepoints)*100],
+                "include": [min(inclusion_check(n_timepoints, conf_invariants['mean_fd'], conf_invariants['max_fd'],
+                                                n, MEAN_FD_TH)
+                                for n in conf_invariants['n_spikes'].values())],
+                "processed": [1]
+            })
+        if isdefined(self.inputs.excluded_summary):
+            summaries += self.inputs.excluded_summary
+        group_motion_summary = pd.concat([pd.DataFrame.from_dict(summary) for summary in summaries],
+                                         ignore_index=True)
+        group_motion_summary = group_motion_summary[["subject", "session", "task", "mean_fd", "max_fd",
+                                                     "n_spikes", "perc_spikes", "include", "processed"]]
+        fname = save_table(group_motion_summary, join(self.inputs.output_dir, "group_motion_summary"),
+                           self.inputs.tsv)
+        with recorder.stage('motion_plot'):
+            colour = ["#fe6863", "#00a074"]
+            sns.set_palette(colour)
+            fig = motion_plot(group_motion_summary)
+            fname_plot = join(self.inputs.output_dir, "motion_criterion.svg")
+            fig.savefig(fname_plot, dpi=300)
+        exclude_list = sorted(set(f"sub-{x}" for x in
+                                  group_motion_summary[group_motion_summary['include'] == 0]['subject']))
+        self._results['group_motion_summary'] = fname
+        self._results['motion_plot'] = fname_plot
+        self._results['exclude_list'] = exclude_list
+        return runtime
+
 class GroupConfoundsInputSpec(BaseInterfaceInputSpec):
     conf_summary = traits.List(
         exists=True,
@@ -136,6 +425,13 @@ class GroupConfoundsInputSpec(BaseInterfaceInputSpec):
     output_dir = File(          # needed to save data in other directory
         desc="Output path")     # TODO: Implement temp dir
     pipeline_name = traits.List(mandatory=True)
+    excluded_summary = traits.List(
+        traits.Dict,
+        desc="Confounds summaries of runs excluded before denoising")
+    tsv = traits.Bool(
+        False,
+        usedefault=True,
+        desc="Also export table as TSV")
 
 class GroupConfoundsOutputSpec(TraitedSpec):
     group_conf_summary = File(
@@ -148,8 +444,11 @@ class GroupConfounds(SimpleInterface):
     def _run_interface(self, runtime):
         group_conf_summary = pd.DataFrame()
         for summary, pipeline_name in zip(self.inputs.conf_summary, self.inputs.pipeline_name):
-            group_conf_summary = group_conf_summary.append(pd.DataFrame.from_dict(summary))
-        fname = join(self.inputs.output_dir, f"{pipeline_name}_group_conf_summary.tsv")
-        group_conf_summary.to_csv(fname, sep='\t', index=False)
+            group_conf_summary = pd.concat([group_conf_summary, pd.DataFrame.from_dict(summary)])
+        if isdefined(self.inputs.excluded_summary):
+            for summary in self.inputs.excluded_summary:
+                group_conf_summary = pd.concat([group_conf_summary, pd.DataFrame.from_dict(summary)])
+        fname = save_table(group_conf_summary, join(self.inputs.output_dir, f"{pipeline_name}_group_conf_summary"),
+                           self.inputs.tsv)
         self._results['group_conf_summary'] = fname
         return runtime
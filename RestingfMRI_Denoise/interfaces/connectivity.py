@@ -7,7 +7,7 @@ from nipype.interfaces.base import (
     InputMultiPath, OutputMultiPath, File, Directory,
     traits, isdefined
     )
-from nipype.utils.filemanip import split_filename
+from nipype.utils.filemanip import split_filename, ensure_list
 import nibabel as nb
 from nilearn.input_data import NiftiLabelsMasker
 from nilearn.connectome import ConnectivityMeasure
@@ -16,27 +16,47 @@ from nilearn.image import load_img
 from nilearn.image import resample_to_img
 from nilearn.image import resample_img
 from nilearn.plotting import plot_matrix
+import matplotlib.pyplot as plt
 
 from RestingfMRI_Denoise.utils.quality_measures import create_carpetplot
+from RestingfMRI_Denoise.utils.instrumentation import StageRecorder
+from RestingfMRI_Denoise.utils.time_series import extract_time_series
+from RestingfMRI_Denoise.utils.connectivity_metrics import (
+    METRICS, TRIU_OFFSET, connectivity_metrics, to_upper_triangle)
+from RestingfMRI_Denoise.utils.dynamic_connectivity import sliding_window_correlation, save_dynamic_connectivity
+from RestingfMRI_Denoise.utils.connectivity_store import (
+    store_path, append_runs, read_connectivity, read_time_series, read_n_regions)
+from RestingfMRI_Denoise.utils.seed_maps import (
+    SEED_RADIUS, CHUNK_MB, parse_seed, seed_to_voxel_correlation, save_seed_map)
+from RestingfMRI_Denoise.parcellation import get_atlas_names, atlas_suffix
 
 class ConnectivityInputSpec(BaseInterfaceInputSpec):
     fmri_denoised = File(exists=True,
                          desc='Denoised fMRI file',
                          mandatory=True)
-    parcellation = File(exists=True,
-                        desc='Parcellation file',
-                        mandatory=False)
+    parcellation = InputMultiPath(File(exists=True),
+                                  desc='Parcellation file(s), time series of all parcellations '
+                                       'are extracted in single pass over denoised data',
+                                  mandatory=False)
     output_dir = File(desc='Output path')
+    entities = traits.Dict(desc='Per-file entities used to tag profiling records')
+    pipeline_name = traits.Str(desc='Name of denoising strategy used to tag profiling records')
+    store_dir = Directory(desc='Directory of connectivity stores (see utils.connectivity_store), '
+                               'connectivity and time series are appended if set (requires entities '
+                               'and pipeline_name)')
 
 class ConnectivityOutputSpec(TraitedSpec):
-    corr_mat = File(exists=True,
-                    desc='Connectivity matrix',
+    corr_mat = OutputMultiPath(File(exists=True),
+                    desc='Connectivity matrix (one per parcellation)',
+                    mandatory=True)
+    carpet_plot = OutputMultiPath(File(exists=True),
+                    desc='Carpet plot (one per parcellation)',
                     mandatory=True)
-    carpet_plot = File(exists=True,
-                    desc='Carpet plot',
+    matrix_plot = OutputMultiPath(File(exists=True),
+                    desc='Connectivity matrix plot (one per parcellation)',
                     mandatory=True)
-    matrix_plot = File(exists=True,
-                    desc='Carpet plot',
+    time_series = OutputMultiPath(File(exists=True),
+                    desc='Parcel time series (one per parcellation)',
                     mandatory=True)
 
 class Connectivity(SimpleInterface):
@@ -45,22 +65,90 @@ class Connectivity(SimpleInterface):
     def _run_interface(self, runtime):
         fname = self.inputs.fmri_denoised
         _, base, _ = split_filename(fname)
-        conn_file = f'{self.inputs.output_dir}/{base}_conn_mat.npy'
-        carpet_plot_file = join(self.inputs.output_dir, f'{base}_carpet_plot.png')
-        matrix_plot_file = join(self.inputs.output_dir, f'{base}_matrix_plot.png')
-        if not os.path.isfile(conn_file):
-            bold_img = fname
-            masker = NiftiLabelsMasker(labels_img=self.inputs.parcellation, detrend=True, standardize=True)
-            time_series = masker.fit_transform(bold_img, confounds=None)
-            corr_measure = ConnectivityMeasure(kind='correlation')
-            corr_mat = corr_measure.fit_transform([time_series])[0]
-            create_carpetplot(time_series, carpet_plot_file)
-            mplot = plot_matrix(corr_mat,  vmin=-1, vmax=1)
-            mplot.figure.savefig(matrix_plot_file)
-            np.save(conn_file, corr_mat)  
-        self._results['corr_mat'] = conn_file
-        self._results['carpet_plot'] = carpet_plot_file
-        self._results['matrix_plot'] = matrix_plot_file
+        parcellation = self.inputs.parcellation
+        suffixes = [atlas_suffix(name) for name in get_atlas_names(parcellation)]
+        conn_files = [f'{self.inputs.output_dir}/{base}{suffix}_conn_mat.npy' for suffix in suffixes]
+        carpet_plot_files = [join(self.inputs.output_dir, f'{base}{suffix}_carpet_plot.png') for suffix in suffixes]
+        matrix_plot_files = [join(self.inputs.output_dir, f'{base}{suffix}_matrix_plot.png') for suffix in suffixes]
+        time_series_files = [join(self.inputs.output_dir, f'{base}{suffix}_time_series.npy') for suffix in suffixes]
+        if not all(os.path.isfile(file) for file in conn_files + time_series_files):
+            recorder = StageRecorder('Connectivity',
+                                     self.inputs.entities if isdefined(self.inputs.entities) else None,
+                                     self.inputs.pipeline_name if isdefined(self.inputs.pipeline_name) else None)
+            with recorder.stage('extract_time_series', n_atlases=len(parcellation)):
+                atlases_time_series = extract_time_series(fname, parcellation, detrend=True, standardize=True)
+            for i, time_series in enumerate(atlases_time_series):
+                with recorder.stage('correlation'):
+                    corr_measure = ConnectivityMeasure(kind='correlation')
+                    corr_mat = corr_measure.fit_transform([time_series])[0]
+                with recorder.stage('plot'):
+                    create_carpetplot(time_series, carpet_plot_files[i])
+                    mplot = plot_matrix(corr_mat,  vmin=-1, vmax=1)
+                    mplot.figure.savefig(matrix_plot_files[i])
+                    plt.close(mplot.figure)
+                with recorder.stage('save'):
+                    np.save(conn_files[i], corr_mat)
+                    np.save(time_series_files[i], time_series)
+        if isdefined(self.inputs.store_dir):
+            for atlas_name, conn_file, time_series_file in zip(get_atlas_names(parcellation), conn_files,
+                                                               time_series_files):
+                append_runs(store_path(self.inputs.store_dir, self.inputs.pipeline_name, atlas_name),
+                            [self.inputs.entities], [np.load(conn_file)], [np.load(time_series_file)])
+        self._results['corr_mat'] = conn_files
+        self._results['carpet_plot'] = carpet_plot_files
+        self._results['matrix_plot'] = matrix_plot_files
+        self._results['time_series'] = time_series_files
+        return runtime
+
+class SeedConnectivityInputSpec(BaseInterfaceInputSpec):
+    fmri_denoised = File(exists=True,
+                         desc='Denoised fMRI file',
+                         mandatory=True)
+    seeds = traits.List(traits.Str,
+                        desc="Seed masks or coordinates as 'NAME:x,y,z' (see utils.seed_maps.parse_seed)",
+                        mandatory=True)
+    seed_radius = traits.Float(SEED_RADIUS,
+                               usedefault=True,
+                               desc='Radius (mm) of spherical seeds defined by coordinates')
+    chunk_mb = traits.Int(CHUNK_MB,
+                          usedefault=True,
+                          desc='Size (MB) of slab of denoised data held in memory')
+    output_dir = File(desc='Output path')
+    entities = traits.Dict(desc='Per-file entities used to tag profiling records')
+    pipeline_name = traits.Str(desc='Name of denoising strategy used to tag profiling records')
+
+class SeedConnectivityOutputSpec(TraitedSpec):
+    seed_maps = OutputMultiPath(File(exists=True),
+                    desc='Seed-to-voxel correlation maps (one per seed)',
+                    mandatory=True)
+
+class SeedConnectivity(SimpleInterface):
+    """
+    Seed-to-voxel correlation maps of all seeds computed in two passes over
+    denoised data decompressed once and read in z-slabs (see
+    utils.seed_maps.seed_to_voxel_correlation).
+    """
+    input_spec = SeedConnectivityInputSpec
+    output_spec = SeedConnectivityOutputSpec
+    def _run_interface(self, runtime):
+        fname = self.inputs.fmri_denoised
+        _, base, _ = split_filename(fname)
+        names = [parse_seed(seed)[0] for seed in self.inputs.seeds]
+        seed_map_files = [join(self.inputs.output_dir, f'{base}_seed-{name}_corr_map.nii.gz') for name in names]
+        if not all(os.path.isfile(file) for file in seed_map_files):
+            recorder = StageRecorder('SeedConnectivity',
+                                     self.inputs.entities if isdefined(self.inputs.entities) else None,
+                                     self.inputs.pipeline_name if isdefined(self.inputs.pipeline_name) else None)
+            with recorder.stage('seed_to_voxel', n_seeds=len(names)):
+                # Uncompressed copy of denoised image is written next to outputs (node directory)
+                seed_maps = seed_to_voxel_correlation(fname, self.inputs.seeds,
+                                                      self.inputs.seed_radius, self.inputs.chunk_mb,
+                                                      self.inputs.output_dir if isdefined(self.inputs.output_dir)
+                                                      else runtime.cwd)
+            with recorder.stage('save'):
+                for name, seed_map_file in zip(names, seed_map_files):
+                    save_seed_map(seed_maps[name], fname, seed_map_file)
+        self._results['seed_maps'] = seed_map_files
         return runtime
 
 class GroupConnectivityInputSpec(BaseInterfaceInputSpec):
@@ -69,25 +157,184 @@ class GroupConnectivityInputSpec(BaseInterfaceInputSpec):
                     mandatory=True)
     output_dir = File(desc='Output path')
     pipeline_name = traits.List(mandatory=True)
+    atlas_names = traits.List(traits.Str, [""],
+                              usedefault=True,
+                              desc='Names of parcellations (output of get_atlas_names)')
+    entities = traits.List(traits.Dict,
+                           desc='Per-run entities, used to select runs in connectivity store')
+    store_dir = Directory(desc='Directory of connectivity stores, matrices are read from stores '
+                               'instead of corr_mat files if set (requires entities), '
+                               'store keeps float32 correlations')
 
 class GroupConnectivityOutputSpec(TraitedSpec):
-    group_corr_mat = File(exists=True,
-                    desc='Connectivity matrix',
+    group_corr_mat = OutputMultiPath(File(exists=True),
+                    desc='Connectivity matrix (one per parcellation)',
                     mandatory=True)
     pipeline_name = traits.Str(mandatory=True)
 
 class GroupConnectivity(SimpleInterface):
+    """
+    Stacks connectivity matrices of all runs of a pipeline. Matrices read
+    from connectivity store (store_dir) are float32 correlations cast to
+    float64, quality measures computed from them differ from those of
+    float64 corr_mat files by float32 rounding (relative error about 1e-7).
+    """
     input_spec = GroupConnectivityInputSpec
     output_spec = GroupConnectivityOutputSpec
     def _run_interface(self, runtime):
-        n_corr_mat = len(self.inputs.corr_mat)
-        n_rois = 200
-        group_corr_mat = np.zeros((n_corr_mat, n_rois, n_rois))
-        for i, file in enumerate(self.inputs.corr_mat):
-            group_corr_mat[i, :, :] = np.load(file)
         pipeline_name = self.inputs.pipeline_name[0]
-        group_corr_file = join(self.inputs.output_dir, f'{pipeline_name}_group_corr_mat.npy')
-        np.save(group_corr_file, group_corr_mat)
-        self._results['group_corr_mat'] = group_corr_file
+        corr_mat = [ensure_list(files) for files in self.inputs.corr_mat]  # runs x atlases
+        group_corr_files = []
+        for j, atlas_name in enumerate(self.inputs.atlas_names):
+            if isdefined(self.inputs.store_dir):
+                group_corr_mat = read_connectivity(store_path(self.inputs.store_dir, pipeline_name, atlas_name),
+                                                   self.inputs.entities, matrices=True).astype(np.float64)
+            else:
+                group_corr_mat = np.stack([np.load(files[j]) for files in corr_mat])
+            group_corr_file = join(self.inputs.output_dir,
+                                   f'{pipeline_name}{atlas_suffix(atlas_name)}_group_corr_mat.npy')
+            np.save(group_corr_file, group_corr_mat)
+            group_corr_files.append(group_corr_file)
+        self._results['group_corr_mat'] = group_corr_files
         self._results['pipeline_name'] = pipeline_name
         return runtime
+
+class GroupConnectivityMetricsInputSpec(BaseInterfaceInputSpec):
+    time_series = traits.List(exists=True,
+                    desc='Parcel time series of all runs (output of Connectivity)',
+                    mandatory=True)
+    output_dir = File(desc='Output path')
+    pipeline_name = traits.List(mandatory=True)
+    atlas_names = traits.List(traits.Str, [""],
+                              usedefault=True,
+                              desc='Names of parcellations (output of get_atlas_names)')
+    entities = traits.List(traits.Dict,
+                           desc='Per-run entities, used to name runs in output file')
+    store_dir = Directory(desc='Directory of connectivity stores, time series are read from stores '
+                               'instead of time_series files if set (requires entities)')
+    metrics = traits.List(traits.Enum(*METRICS), list(METRICS),
+                          usedefault=True,
+                          desc='Connectivity metrics to compute')
+
+class GroupConnectivityMetricsOutputSpec(TraitedSpec):
+    conn_metrics = OutputMultiPath(File(exists=True),
+                    desc='Connectivity metrics of all runs (one .npz per parcellation)')
+
+class GroupConnectivityMetrics(SimpleInterface):
+    """
+    Computes correlation, Ledoit-Wolf covariance, partial correlation and
+    tangent space connectivity of all runs of a pipeline at once (tangent
+    reference is estimated once per group). Matrices are stored as float32
+    upper triangles (without diagonal for correlation and partial
+    correlation, see utils.connectivity_metrics.TRIU_OFFSET) in .npz file
+    with one array of shape (n_runs, n_edges) per metric.
+    """
+    input_spec = GroupConnectivityMetricsInputSpec
+    output_spec = GroupConnectivityMetricsOutputSpec
+    def _run_interface(self, runtime):
+        pipeline_name = self.inputs.pipeline_name[0]
+        recorder = StageRecorder('GroupConnectivityMetrics', pipeline=pipeline_name)
+        time_series = [ensure_list(files) for files in self.inputs.time_series]  # runs x atlases
+        runs = []
+        if isdefined(self.inputs.entities):
+            runs = ["_".join(f"{key}-{entities[key]}" for key in ('subject', 'session', 'task') if key in entities)
+                    for entities in self.inputs.entities]
+        conn_metrics_files = []
+        for j, atlas_name in enumerate(self.inputs.atlas_names):
+            with recorder.stage('load', atlas=atlas_name):
+                if isdefined(self.inputs.store_dir):
+                    atlas_time_series = [run_time_series.astype(np.float64) for run_time_series in read_time_series(
+                        store_path(self.inputs.store_dir, pipeline_name, atlas_name), self.inputs.entities)]
+                else:
+                    atlas_time_series = [np.load(files[j]) for files in time_series]
+            with recorder.stage('metrics', atlas=atlas_name):
+                matrices = connectivity_metrics(atlas_time_series, self.inputs.metrics)
+            arrays = {metric: to_upper_triangle(matrices[metric], TRIU_OFFSET[metric])
+                      for metric in self.inputs.metrics}
+            if 'tangent_mean' in matrices:
+                arrays['tangent_mean'] = to_upper_triangle(matrices['tangent_mean'])
+            conn_metrics_file = join(self.inputs.output_dir,
+                                     f'{pipeline_name}{atlas_suffix(atlas_name)}_group_conn_metrics.npz')
+            with recorder.stage('save', atlas=atlas_name):
+                np.savez(conn_metrics_file,
+                         n_regions=atlas_time_series[0].shape[1],
+                         runs=np.array(runs),
+                         **arrays)
+            conn_metrics_files.append(conn_metrics_file)
+        self._results['conn_metrics'] = conn_metrics_files
+        return runtime
+
+class DynamicConnectivityInputSpec(BaseInterfaceInputSpec):
+    time_series = traits.List(exists=True,
+                    desc='Parcel time series of all runs (output of Connectivity)',
+                    mandatory=True)
+    output_dir = File(desc='Output path')
+    pipeline_name = traits.List(mandatory=True)
+    atlas_names = traits.List(traits.Str, [""],
+                              usedefault=True,
+                              desc='Names of parcellations (output of get_atlas_names)')
+    entities = traits.List(traits.Dict,
+                           desc='Per-run entities, used to name runs in output file')
+    store_dir = Directory(desc='Directory of connectivity stores, time series are read from stores '
+                               'instead of time_series files if set (requires entities)')
+    window = traits.Int(mandatory=True,
+                        desc='Window length in volumes')
+    step = traits.Int(1,
+                      usedefault=True,
+                      desc='Shift between consecutive windows in volumes')
+    taper = traits.Str('rectangular',
+                       usedefault=True,
+                       desc="Window taper, 'rectangular' or window name accepted by scipy.signal.get_window")
+
+class DynamicConnectivityOutputSpec(TraitedSpec):
+    dynamic_conn = OutputMultiPath(File(exists=True),
+                    desc='Windowed correlations of all runs (one HDF5 file per parcellation)')
+
+class DynamicConnectivity(SimpleInterface):
+    """
+    Sliding-window correlation of all runs of a pipeline, stored as
+    window x edge tensors in chunked HDF5 file together with edge-wise mean
+    and variability (see utils.dynamic_connectivity.save_dynamic_connectivity).
+    """
+    input_spec = DynamicConnectivityInputSpec
+    output_spec = DynamicConnectivityOutputSpec
+    def _sliding_windows(self, atlas_time_series, recorder, atlas_name):
+        for run_time_series in atlas_time_series:
+            with recorder.stage('sliding_window', atlas=atlas_name):
+                dfc = sliding_window_correlation(run_time_series,
+                                                 self.inputs.window,
+                                                 self.inputs.step,
+                                                 self.inputs.taper)
+            yield dfc
+
+    def _run_interface(self, runtime):
+        pipeline_name = self.inputs.pipeline_name[0]
+        recorder = StageRecorder('DynamicConnectivity', pipeline=pipeline_name)
+        time_series = [ensure_list(files) for files in self.inputs.time_series]  # runs x atlases
+        if isdefined(self.inputs.entities):
+            runs = ["_".join(f"{key}-{entities[key]}" for key in ('subject', 'session', 'task') if key in entities)
+                    for entities in self.inputs.entities]
+        else:
+            runs = [f"run-{i}" for i in range(len(time_series))]
+        dynamic_conn_files = []
+        for j, atlas_name in enumerate(self.inputs.atlas_names):
+            if isdefined(self.inputs.store_dir):
+                path = store_path(self.inputs.store_dir, pipeline_name, atlas_name)
+                n_regions = read_n_regions(path)
+                atlas_time_series = (run_time_series.astype(np.float64)
+                                     for run_time_series in read_time_series(path, self.inputs.entities))
+            else:
+                # Header only, parcel count is known before the first run is computed
+                n_regions = np.load(time_series[0][j], mmap_mode='r').shape[1] if time_series else 0
+                atlas_time_series = (np.load(files[j]) for files in time_series)
+            dynamic_conn_file = join(self.inputs.output_dir,
+                                     f'{pipeline_name}{atlas_suffix(atlas_name)}_dynamic_conn.h5')
+            # Each run is written before the next one is computed, stage includes sliding_window stages
+            with recorder.stage('save', atlas=atlas_name):
+                save_dynamic_connectivity(dynamic_conn_file, runs,
+                                          self._sliding_windows(atlas_time_series, recorder, atlas_name),
+                                          self.inputs.window,
+                                          self.inputs.step, self.inputs.taper, n_regions)
+            dynamic_conn_files.append(dynamic_conn_file)
+        self._results['dynamic_conn'] = dynamic_conn_files
+        return runtime
@@ -7,7 +7,7 @@ from pathlib import Path
 from nipype.utils.filemanip import split_filename
 from nipype.interfaces.base import (
     BaseInterfaceInputSpec, TraitedSpec, SimpleInterface,
-    ImageFile, File, Directory, traits
+    ImageFile, File, Directory, traits, isdefined
     )
 import nibabel as nb
 from nilearn import datasets
@@ -15,6 +15,11 @@ from nilearn.image import load_img
 from nilearn.image import clean_img, smooth_img
 from nilearn.image import resample_to_img
 from nilearn.image import resample_img
+from RestingfMRI_Denoise.utils.instrumentation import StageRecorder
+from RestingfMRI_Denoise.utils.parallel_clean import smooth_img_chunked, clean_img_chunked
+from RestingfMRI_Denoise.utils.design_dedup import effective_settings, denoise_fingerprint, cached_design
+from RestingfMRI_Denoise.utils.lifecycle import work_quota
+from RestingfMRI_Denoise.utils.temporal_filter import TEMPORAL_FILTERS
 
 class DenoiseInputSpec(BaseInterfaceInputSpec):
     fmri_prep = ImageFile(
@@ -26,6 +31,11 @@ class DenoiseInputSpec(BaseInterfaceInputSpec):
         desc='ICA-Aroma preprocessed fMRI file',
         mandatory=False
     )
+    brain_mask = traits.Either(
+        ImageFile(exists=True), None,
+        desc='Brain mask, if given only in-mask voxels are denoised (None for run without mask)',
+        mandatory=False
+    )
     conf_prep = File(
         exists=True,
         desc="Confound file",
@@ -52,6 +62,12 @@ class DenoiseInputSpec(BaseInterfaceInputSpec):
     low_pass = traits.Float(
         desc="Low-pass filter"
     )
+    temporal_filter = traits.Enum(
+        *TEMPORAL_FILTERS,
+        usedefault=True,
+        desc="Temporal filter engine: 'butterworth' (nilearn) or 'fft' "
+             "(precomputed frequency response applied with real FFTs)"
+    )
     ica_aroma = traits.Bool(
         mandatory=False,
         desc='ICA-Aroma files exists'
@@ -60,6 +76,25 @@ class DenoiseInputSpec(BaseInterfaceInputSpec):
         mandatory=False,
         desc='Optional smoothing'
     )
+    n_threads = traits.Int(
+        1,
+        usedefault=True,
+        desc='Number of threads smoothing and cleaning chunks of image, '
+             'result does not depend on number of threads'
+    )
+    design_cache_dir = Directory(
+        exists=True,
+        desc='Cache of denoised images, pipelines with identical design '
+             'matrix and filter settings for a run are denoised once'
+    )
+    work_dir = Directory(
+        exists=True,
+        desc='Work directory whose size is limited by work_quota'
+    )
+    work_quota = traits.Float(
+        desc='Quota of work directory in GB, denoising waits while running '
+             'jobs would exceed it'
+    )
 
 class DenoiseOutputSpec(TraitedSpec):
     fmri_denoised = File(
@@ -77,60 +112,78 @@ class Denoise(SimpleInterface):
         _, base, _ = split_filename(self.inputs.fmri_prep)
         denoised_file = f'{self.inputs.output_dir}/{base}_denoised_pipeline-{pipeline_name}.nii.gz'
         if not os.path.isfile(denoised_file):
-            smoothing = self.inputs.smoothing
-            pipeline_aroma = self.inputs.pipeline['aroma']
-            pipeline_acompcor = self.inputs.pipeline['confounds']['acompcor']
-            img = nb.load(self.inputs.fmri_prep)
-            fname = self.inputs.fmri_prep
-            #brain mask
-            path, base, _ = split_filename(fname)  # Path can be removed later
-#            ori_mask = glob(path + '/*rest*space-MNI152NLin2009cAsym*brain*mask.nii*')[0]
-#             if pipeline_aroma:
-#                 if not self.inputs.fmri_prep_aroma:
-#                     raise ValueError("No ICA-AROMA files found")
-#                 img = nb.load(self.inputs.fmri_prep_aroma)
-#                 cur_mask = resample_to_img(ori_mask, self.inputs.fmri_prep_aroma, interpolation='nearest')
-#             else: cur_mask = ori_mask
+            recorder = StageRecorder('Denoise', self.inputs.entities, pipeline_name)
             # Handle possibility of null pipeline
-            try:
-                conf = pd.read_csv(self.inputs.conf_prep,
-                                   delimiter='\t'
-                                   #low_memory=False,
-                                   #engine='python'
-                                   )
-                conf = conf.values
-            except pd.errors.EmptyDataError:
-                conf = None
+            with recorder.stage('read_confounds'):
+                try:
+                    conf = pd.read_csv(self.inputs.conf_prep,
+                                       delimiter='\t'
+                                       #low_memory=False,
+                                       #engine='python'
+                                       )
+                    conf = conf.values
+                except pd.errors.EmptyDataError:
+                    conf = None
             # Determine proper TR
             task = self.inputs.entities['task']
             if task in self.inputs.tr_dict:
                 tr = self.inputs.tr_dict[task]
             else:
                 raise KeyError(f'{task} TR not found in tr_dict')
-            if smoothing and not pipeline_aroma:
-               img = smooth_img(img, fwhm=6)
-            
-            if pipeline_acompcor:
-                denoised_img = clean_img(
-                    img,
-                    confounds=conf,
-                    high_pass=self.inputs.high_pass,
-                    t_r=tr
-                    #mask_img = cur_mask
-                )
+            settings = effective_settings(self.inputs.pipeline, self.inputs.smoothing,
+                                          self.inputs.high_pass, self.inputs.low_pass,
+                                          self.inputs.temporal_filter)
+            if isdefined(self.inputs.design_cache_dir):
+                # Pipelines with identical design for this run share one denoised image
+                brain_mask = self.inputs.brain_mask if isdefined(self.inputs.brain_mask) else None
+                fingerprint = denoise_fingerprint(self.inputs.fmri_prep, brain_mask, conf, tr, settings)
+                with cached_design(self.inputs.design_cache_dir, fingerprint, denoised_file) as reused:
+                    if not reused:
+                        self._admitted_denoise(conf, tr, settings, denoised_file, recorder)
             else:
-                denoised_img = clean_img(
-                    img,
-                    confounds=conf,
-                    high_pass=self.inputs.high_pass,
-                    low_pass=self.inputs.low_pass,
-                    t_r=tr
-                    #mask_img = cur_mask
-                )            
-            nb.save(denoised_img, denoised_file)
+                self._admitted_denoise(conf, tr, settings, denoised_file, recorder)
         self._results['fmri_denoised'] = denoised_file
         return runtime
 
+    def _admitted_denoise(self, conf, tr, settings, denoised_file, recorder):
+        quota = self.inputs.work_quota if isdefined(self.inputs.work_quota) else None
+        cache_dir = self.inputs.design_cache_dir if isdefined(self.inputs.design_cache_dir) else None
+        # Denoised image takes about as much space as compressed input
+        with work_quota(self.inputs.work_dir, quota, os.path.getsize(self.inputs.fmri_prep), cache_dir):
+            self._denoise(conf, tr, settings, denoised_file, recorder)
+
+    def _denoise(self, conf, tr, settings, denoised_file, recorder):
+        with recorder.stage('load'):
+            img = nb.load(self.inputs.fmri_prep)
+            if recorder.enabled:
+                # Data are read here only to attribute reading time to load stage,
+                # otherwise they are read lazily by the first stage using them
+                img = nb.Nifti1Image(np.asanyarray(img.dataobj), img.affine, img.header)
+        if settings['smoothing']:
+            with recorder.stage('smooth', n_threads=self.inputs.n_threads):
+                img = smooth_img_chunked(img, fwhm=6, n_threads=self.inputs.n_threads)
+
+        mask = None
+        if isdefined(self.inputs.brain_mask) and self.inputs.brain_mask is not None:
+            with recorder.stage('load_mask'):
+                mask_img = nb.load(self.inputs.brain_mask)
+                if mask_img.shape[:3] != img.shape[:3] or not np.allclose(mask_img.affine, img.affine):
+                    mask_img = resample_to_img(mask_img, img, interpolation='nearest')
+                mask = np.asanyarray(mask_img.dataobj) > 0
+        with recorder.stage('clean', n_threads=self.inputs.n_threads):
+            denoised_img = clean_img_chunked(
+                img,
+                confounds=conf,
+                n_threads=self.inputs.n_threads,
+                mask=mask,
+                temporal_filter=settings['temporal_filter'],
+                high_pass=settings['high_pass'],
+                low_pass=settings['low_pass'],
+                t_r=tr
+            )
+        with recorder.stage('save'):
+            nb.save(denoised_img, denoised_file)
+
 # --- TESTS
 if __name__ == '__main__':
     ### INPUTS #################################################################
@@ -0,0 +1,36 @@
+from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, TraitedSpec, traits
+from RestingfMRI_Denoise.utils.lifecycle import evict
+
+
+class EvictIntermediateInputSpec(BaseInterfaceInputSpec):
+    in_file = traits.Str(
+        mandatory=True,
+        desc='Bulky intermediate file (e.g. denoised image) removed once '
+             'all its consumers have finished'
+    )
+    connectivity = traits.Any(
+        desc='Output of Connectivity, connected to run after consumer'
+    )
+    sink = traits.Any(
+        desc='Output of derivatives sink, connected to run after consumer'
+    )
+    seed_maps = traits.Any(
+        desc='Output of SeedConnectivity, connected to run after consumer'
+    )
+
+
+class EvictIntermediateOutputSpec(TraitedSpec):
+    freed_bytes = traits.Int(
+        desc='Number of freed bytes'
+    )
+
+
+class EvictIntermediate(SimpleInterface):
+    """Removes intermediate file from work dir after its downstream
+    consumers (connected to consumer inputs) have finished."""
+    input_spec = EvictIntermediateInputSpec
+    output_spec = EvictIntermediateOutputSpec
+
+    def _run_interface(self, runtime):
+        self._results['freed_bytes'] = evict([self.inputs.in_file])
+        return runtime
@@ -8,6 +8,53 @@ from nipype.interfaces.base import (
     traits, isdefined, TraitedSpec,
     Directory, File, Str, ImageFile,
     InputMultiObject, OutputMultiObject, OutputMultiPath, InputMultiPath)
+from RestingfMRI_Denoise.utils.preflight import preflight
+from RestingfMRI_Denoise.utils.compcor import COMPCOR_MODES
+
+# BIDS layouts by dataset, used only if enabled (e.g. by daemon)
+_layout_cache = None
+
+
+def enable_layout_cache() -> None:
+    """Keeps BIDS index of every dataset between BIDSGrab runs of current
+    process, index is rebuilt when directory tree changes."""
+    global _layout_cache
+    if _layout_cache is None:
+        _layout_cache = {}
+
+
+def _tree_signature(bids_dir, derivatives) -> tuple:
+    """Modification times of all directories of dataset and derivatives
+    (they change when files are added, removed or renamed)."""
+    signature = []
+    for root in [bids_dir, *derivatives]:
+        for dirpath, dirnames, _ in os.walk(root):
+            if dirpath == bids_dir and 'derivatives' in dirnames:
+                dirnames.remove('derivatives')
+            signature.append((dirpath, os.stat(dirpath).st_mtime_ns))
+    return tuple(signature)
+
+
+def get_layout(bids_dir, derivatives):
+    """BIDSLayout of dataset with derivatives, cached if layout cache is
+    enabled (see enable_layout_cache).
+    Args:
+        bids_dir: str
+            BIDS dataset root directory.
+        derivatives: list
+            Paths to derivatives directories.
+    Returns:
+        layout: bids.layout.layout.BIDSLayout
+    """
+    from bids import BIDSLayout
+    if _layout_cache is None:
+        return BIDSLayout(root=bids_dir, validate=True, derivatives=derivatives)
+    key = (bids_dir, tuple(derivatives))
+    signature = _tree_signature(bids_dir, derivatives)
+    if key not in _layout_cache or _layout_cache[key][0] != signature:
+        _layout_cache[key] = (signature, BIDSLayout(root=bids_dir, validate=True, derivatives=derivatives))
+    return _layout_cache[key][1]
+
 
 class BIDSGrabInputSpec(BaseInterfaceInputSpec):
     bids_dir = Directory(
@@ -40,10 +87,18 @@ class BIDSGrabInputSpec(BaseInterfaceInputSpec):
         mandatory=False,
         desc='ICA-Aroma files'
     )
+    skip_incomplete = traits.Bool(
+        False,
+        usedefault=True,
+        desc='Skip runs with missing confounds or ICA-Aroma files '
+             'instead of raising FileNotFoundError'
+    )
 
 class BIDSGrabOutputSpec(TraitedSpec):
     fmri_prep = OutputMultiPath(ImageFile)
     fmri_prep_aroma = OutputMultiPath(ImageFile)
+    # Plain list, so runs without mask (None) stay aligned with other outputs
+    brain_mask = traits.List(traits.Either(ImageFile, None))
     conf_raw = OutputMultiPath(File)
     conf_json = OutputMultiPath(File)  
     entities = OutputMultiObject(traits.Dict)
@@ -63,6 +118,10 @@ class BIDSGrab(SimpleInterface):
             extensions ".nii" or ".nii.gz", suffix "bold" and extension "prep"
             corresponding to preprocessed images.
         fmri_prep_aroma: ...
+        brain_mask: list of files
+            List containing paths to brain masks (desc "brain", suffix "mask")
+            in the space of preprocessed functional files, None for runs
+            without mask (these are denoised without mask).
         conf_raw: list of files
             List containing paths to confound regressors files. Elements of conf_raw
             list correspond to fmri_prep elements such that each regressor file is
@@ -82,7 +141,6 @@ class BIDSGrab(SimpleInterface):
 
     def _run_interface(self, runtime):
         import json
-        from bids import BIDSLayout
 
         def validate_derivatives(bids_dir, derivatives):
             """ Validate derivatives argument provided by the user.
@@ -175,11 +233,7 @@ class BIDSGrab(SimpleInterface):
             derivatives=self.inputs.derivatives
         )
 
-        layout = BIDSLayout(
-            root=self.inputs.bids_dir,
-            validate=True,
-            derivatives=derivatives
-        )
+        layout = get_layout(self.inputs.bids_dir, derivatives)
 
         # Validate optional arguments
         filter_base = {}
@@ -212,6 +266,12 @@ class BIDSGrab(SimpleInterface):
             'suffix': 'bold',
             'desc': 'smoothAROMAnonaggr',
         }
+        filter_mask = {
+            'extension': ['nii', 'nii.gz'],
+            'suffix': 'mask',
+            'desc': 'brain',
+            'space': 'MNI152NLin2009cAsym'
+        }
         filter_conf = {
             'extension': 'tsv',
             #'suffix': 'regressors',
@@ -223,15 +283,25 @@ class BIDSGrab(SimpleInterface):
             'desc': 'confounds',
         }
 
+        def missing(message):
+            """Skips incomplete run (e.g. still being preprocessed) if
+            skip_incomplete is set, otherwise raises FileNotFoundError."""
+            if self.inputs.skip_incomplete:
+                print(f"Warning: {message}, run is skipped")
+            else:
+                raise FileNotFoundError(message)
+
         filter_fmri.update(filter_base)
-        fmri_prep, fmri_prep_aroma, conf_raw, conf_json, entities = ([] for _ in
-                                                                     range(5))
+        fmri_prep, fmri_prep_aroma, brain_mask, conf_raw, conf_json, entities = ([] for _ in
+                                                                                 range(6))
         tr_dict = {} 
         for fmri_file in layout.get(**filter_fmri):
             # Extract TRs             
-            example_file = fmri_file  
-            task = layout.get_metadata(example_file.path)['TaskName']
-            tr_dict[task] = layout.get_metadata(example_file.path)['RepetitionTime']
+            # (missing TR is reported for all runs at once by Preflight)
+            metadata = layout.get_metadata(fmri_file.path)
+            task = metadata.get('TaskName', fmri_file.get_entities().get('task'))
+            if tr_dict.get(task) is None:
+                tr_dict[task] = metadata.get('RepetitionTime')
 
             entity_bold = fmri_file.get_entities()
             # Look for corresponding confounds file
@@ -247,9 +317,8 @@ class BIDSGrab(SimpleInterface):
             conf_json_file = layout.get(**filter_conf_json)
 
             if not conf_file:
-                raise FileNotFoundError(
-                    f"Regressor file not found for file {fmri_file.path}"
-                )
+                missing(f"Regressor file not found for file {fmri_file.path}")
+                continue
             else:
                 # Add entity only if both files are available
                 if len(conf_file) > 1:
@@ -261,9 +330,8 @@ class BIDSGrab(SimpleInterface):
                 conf_file = conf_file[0]
 
             if not conf_json_file:
-                raise FileNotFoundError(
-                    f"Regressor file not found for file {fmri_file.path}"
-                )
+                missing(f"Regressor file not found for file {fmri_file.path}")
+                continue
             else:
                 # Add entity only if both files are available
                 if len(conf_json_file) > 1:
@@ -279,9 +347,8 @@ class BIDSGrab(SimpleInterface):
             fmri_aroma_file = layout.get(**filter_fmri_aroma)
 
             if not fmri_aroma_file:
-                raise FileNotFoundError(
-                    f"ICA-Aroma file not found for file {fmri_file.path}"
-                )
+                missing(f"ICA-Aroma file not found for file {fmri_file.path}")
+                continue
 
             else:
                 # Add entity only if both files are available
@@ -293,15 +360,34 @@ class BIDSGrab(SimpleInterface):
                 # TODO: find proper warning (logging?)
 
                 fmri_aroma_file = fmri_aroma_file[0]
-                fmri_prep_aroma.append(fmri_aroma_file.path)
+
+            filter_mask.update(filter_entities)
+            mask_file = layout.get(**filter_mask)
+
+            if not mask_file:
+                # Mask only restricts denoising to brain voxels, run is denoised without it
+                print(f"Warning: Brain mask not found for file {fmri_file.path}, "
+                      f"all voxels are denoised")
+                mask_file = None
+            else:
+                if len(mask_file) > 1:
+                    print(
+                        f"Warning: Multiple brain masks found for file {fmri_file.path}.\n"
+                        f"Selecting {mask_file[0].path}"
+                    )
+
+                mask_file = mask_file[0].path
 
             fmri_prep.append(fmri_file.path)
+            fmri_prep_aroma.append(fmri_aroma_file.path)
+            brain_mask.append(mask_file)
             conf_raw.append(conf_file.path)
             conf_json.append(conf_json_file.path)
             entities.append(filter_entities)
 
         self._results['fmri_prep'] = fmri_prep
         self._results['fmri_prep_aroma'] = fmri_prep_aroma
+        self._results['brain_mask'] = brain_mask
         self._results['conf_raw'] = conf_raw
         self._results['conf_json'] = conf_json
         self._results['entities'] = entities
@@ -310,6 +396,64 @@ class BIDSGrab(SimpleInterface):
         return runtime
 
 
+class PreflightInputSpec(BaseInterfaceInputSpec):
+    fmri_prep = InputMultiPath(ImageFile)
+    fmri_prep_aroma = InputMultiPath(ImageFile)
+    brain_mask = traits.List(traits.Either(ImageFile, None))
+    conf_raw = InputMultiPath(File(exists=True))
+    conf_json = InputMultiPath(File(exists=True))
+    entities = InputMultiObject(traits.Dict)
+    tr_dict = traits.Dict()
+    pipelines = traits.List(
+        traits.Dict,
+        mandatory=True,
+        desc='Selected denoising pipelines')
+    parcellation = InputMultiPath(
+        File(exists=True),
+        mandatory=True,
+        desc='Parcellations which images must cover')
+    compcor = traits.Enum(
+        *COMPCOR_MODES,
+        usedefault=True,
+        desc='Source of aCompCor components (fMRIPrep columns or computed from BOLD)')
+
+class PreflightOutputSpec(TraitedSpec):
+    fmri_prep = OutputMultiPath(ImageFile)
+    fmri_prep_aroma = OutputMultiPath(ImageFile)
+    brain_mask = traits.List(traits.Either(ImageFile, None))
+    conf_raw = OutputMultiPath(File)
+    conf_json = OutputMultiPath(File)
+    entities = OutputMultiObject(traits.Dict)
+    warnings = traits.List(
+        traits.Dict,
+        desc='Problems which do not stop denoising (e.g. mask resampling)')
+
+class Preflight(SimpleInterface):
+    """
+    Validates all grabbed runs before any denoising job is scheduled
+    (see utils.preflight): functional image grid against atlases, TR,
+    confounds columns required by selected pipelines and agreement of
+    number of volumes and confounds rows. Only headers, sidecars and
+    confounds table rows are read; runs are checked concurrently.
+    Raises PreflightError listing problems of all runs, otherwise passes
+    runs through unchanged.
+    """
+    input_spec = PreflightInputSpec
+    output_spec = PreflightOutputSpec
+
+    def _run_interface(self, runtime):
+        keys = ['fmri_prep', 'fmri_prep_aroma', 'brain_mask', 'conf_raw', 'conf_json', 'entities']
+        values = {key: getattr(self.inputs, key) if isdefined(getattr(self.inputs, key)) else []
+                  for key in keys}
+        runs = [{**{key: values[key][i] if len(values[key]) > i else None for key in keys},
+                 'tr_dict': self.inputs.tr_dict}
+                for i in range(len(values['entities']))]
+        report = preflight(runs, self.inputs.pipelines, self.inputs.parcellation, compcor=self.inputs.compcor)
+        self._results.update(values)
+        self._results['warnings'] = report.to_dict('records')
+        return runtime
+
+
 class BIDSDataSinkInputSpec(BaseInterfaceInputSpec):
     base_directory = Directory(
         mandatory=True,
@@ -335,7 +479,10 @@ class BIDSDataSink(IOBase):
         os.makedirs(base_dir, exist_ok=True)
 
         out_files = []
-        for entity, in_file in zip(self.inputs.entities, self.inputs.in_file):
+        entities = self.inputs.entities
+        if len(entities) == 1:  # e.g. connectivity matrices of several atlases for one run
+            entities = entities * len(self.inputs.in_file)
+        for entity, in_file in zip(entities, self.inputs.in_file):
             sub_num = entity['subject']
             session_num = entity[
                 'session']
@@ -11,7 +11,9 @@ from nipype.interfaces.base import (
     traits, isdefined
     )
 from nilearn.connectome import sym_matrix_to_vec, vec_to_sym_matrix
-from RestingfMRI_Denoise.utils.plotting import motion_plot
+from RestingfMRI_Denoise.utils.instrumentation import StageRecorder
+from RestingfMRI_Denoise.parcellation import atlas_suffix
+from RestingfMRI_Denoise.utils.tables import save_table, read_table
 
 class QualityMeasuresInputSpec(BaseInterfaceInputSpec):
     group_corr_mat = File(exists=True,
@@ -25,6 +27,9 @@ class QualityMeasuresInputSpec(BaseInterfaceInputSpec):
                            mandatory=True)
     output_dir = File(desc='Output path')
     pipeline_name = traits.Str(mandatory=True)
+    atlas_name = traits.Str("",
+                            usedefault=True,
+                            desc='Name of parcellation, added to output filenames if not empty')
 
 class QualityMeasuresOutputSpec(TraitedSpec):
     fc_fd_summary = traits.List(
@@ -37,24 +42,23 @@ class QualityMeasuresOutputSpec(TraitedSpec):
         exists=True,
         desc="Weights of individual edges after "
              "removing subjects with high motion")
-    exclude_list = traits.List(
-        exists=True,
-        desc="List of subjects to exclude")
 
 class QualityMeasures(SimpleInterface):
     input_spec = QualityMeasuresInputSpec
     output_spec = QualityMeasuresOutputSpec
     def _run_interface(self, runtime):
-        # Loading data
-        group_corr_mat = np.load(self.inputs.group_corr_mat)  # array with matrices for all runs
-        group_conf_summary = pd.read_csv(self.inputs.group_conf_summary, sep='\t')  # motion summary for all runs
         pipeline_name = self.inputs.pipeline_name
-        distance_vector = sym_matrix_to_vec(np.load(self.inputs.distance_matrix))  # load distance matrix
-        # Plotting motion
-        colour = ["#fe6863", "#00a074"]
-        sns.set_palette(colour)
-        fig = motion_plot(group_conf_summary)
-        fig.savefig(join(self.inputs.output_dir, f"motion_criterion_{pipeline_name}.svg"), dpi=300)
+        atlas_name = self.inputs.atlas_name
+        recorder = StageRecorder('QualityMeasures', pipeline=pipeline_name)
+        # Loading data
+        with recorder.stage('load'):
+            group_corr_mat = np.load(self.inputs.group_corr_mat)  # array with matrices for all runs
+            group_conf_summary = read_table(self.inputs.group_conf_summary)  # motion summary for all runs
+            distance_vector = sym_matrix_to_vec(np.load(self.inputs.distance_matrix))  # load distance matrix
+        # Motion plot and exclude list are pipeline independent (GroupMotion)
+        # Runs excluded by motion gate have no connectivity matrix
+        if 'processed' in group_conf_summary:
+            group_conf_summary = group_conf_summary[group_conf_summary['processed'] == 1].reset_index(drop=True)
         # Creating vectors with subject filter
         all_sub_no = len(group_conf_summary)
         icluded_sub = group_conf_summary["include"]
@@ -73,23 +77,27 @@ class QualityMeasures(SimpleInterface):
         edges_weight = {}
         edges_weight_clean = {}
         for key, value in included.items():
-            for i in range(n_edges):
-                corr = pearsonr(group_corr_vec[value[0], i], group_conf_summary['mean_fd'].values[value[0]])
-                fc_fd_corr[i] = corr[0]  # Pearson's r values
-                fc_fd_pval[i] = corr[1]  # p-values
-            fc_fd_corr = np.nan_to_num(fc_fd_corr)  # TODO: write exception
-            # Calculate correlation between FC-FD r values and distance vector
-            distance_dependence = pearsonr(fc_fd_corr, distance_vector)[0]
+            with recorder.stage('qc_fc', subjects=value[3], atlas=atlas_name):
+                for i in range(n_edges):
+                    corr = pearsonr(group_corr_vec[value[0], i], group_conf_summary['mean_fd'].values[value[0]])
+                    fc_fd_corr[i] = corr[0]  # Pearson's r values
+                    fc_fd_pval[i] = corr[1]  # p-values
+                fc_fd_corr = np.nan_to_num(fc_fd_corr)  # TODO: write exception
+                # Calculate correlation between FC-FD r values and distance vector
+                distance_dependence = pearsonr(fc_fd_corr, distance_vector)[0]
             # Store summary measure
-            fc_fd_summary.append({"pipeline": pipeline_name,
-                                  "perc_fc_fd_uncorr": np.sum(fc_fd_pval < 0.05) / len(fc_fd_pval) * 100,
-                                  "pearson_fc_fd": np.median(fc_fd_corr),
-                                  "distance_dependence": distance_dependence,
-                                  "tdof_loss": group_conf_summary["n_conf"].mean(),
-                                  "cleaned": value[1],
-                                  "subjects": value[3],
-                                  "sub_no": value[2]
-                                  })
+            summary = {"pipeline": pipeline_name,
+                       "perc_fc_fd_uncorr": np.sum(fc_fd_pval < 0.05) / len(fc_fd_pval) * 100,
+                       "pearson_fc_fd": np.median(fc_fd_corr),
+                       "distance_dependence": distance_dependence,
+                       "tdof_loss": group_conf_summary["n_conf"].mean(),
+                       "cleaned": value[1],
+                       "subjects": value[3],
+                       "sub_no": value[2]
+                       }
+            if atlas_name:
+                summary["atlas"] = atlas_name
+            fc_fd_summary.append(summary)
             # For cleaned dataset
             if value[1]:
                 edges_weight_clean = {pipeline_name: group_corr_vec[value[0]].mean(axis=0)}
@@ -97,37 +105,34 @@ class QualityMeasures(SimpleInterface):
             if not value[1]:
                 edges_weight = {pipeline_name: group_corr_vec[value[0]].mean(axis=0)}
             # Plotting FC and FC-FD correlation matrices
-            fc_fd_corr_mat = vec_to_sym_matrix(fc_fd_corr)
-            fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 6))
-            fig1 = ax1.imshow(group_corr_mat[value[0]].mean(axis=0), vmin=-1, vmax=1, cmap="RdBu_r")
-            ax1.set_title(f"{pipeline_name}: mean FC")
-            fig.colorbar(fig1, ax=ax1)
-            fig2 = ax2.imshow(fc_fd_corr_mat, vmin=-1, vmax=1, cmap="RdBu_r")
-            ax2.set_title(f"{pipeline_name}: FC-FD correlation")
-            fig.colorbar(fig2, ax=ax2)
-            fig.suptitle(f"{pipeline_name}: {key}")
-            fig.savefig(join(self.inputs.output_dir, f"FC_FD_corr_mat_{pipeline_name}_{value[3].lower()}.png"),
-                        dpi=300)
-            #exclude_list = [f"sub-{x + 1:02}" for x in
-            exclude_list = [f"sub-{x}" for x in
-                            group_conf_summary[group_conf_summary['include'] == 1]['subject']]
+            with recorder.stage('fc_fd_plot', subjects=value[3]):
+                fc_fd_corr_mat = vec_to_sym_matrix(fc_fd_corr)
+                fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 6))
+                fig1 = ax1.imshow(group_corr_mat[value[0]].mean(axis=0), vmin=-1, vmax=1, cmap="RdBu_r")
+                ax1.set_title(f"{pipeline_name}: mean FC")
+                fig.colorbar(fig1, ax=ax1)
+                fig2 = ax2.imshow(fc_fd_corr_mat, vmin=-1, vmax=1, cmap="RdBu_r")
+                ax2.set_title(f"{pipeline_name}: FC-FD correlation")
+                fig.colorbar(fig2, ax=ax2)
+                fig.suptitle(f"{pipeline_name}: {key}")
+                fig.savefig(join(self.inputs.output_dir,
+                                 f"FC_FD_corr_mat_{pipeline_name}{atlas_suffix(atlas_name)}_{value[3].lower()}.png"),
+                            dpi=300)
+                plt.close(fig)
             self._results["fc_fd_summary"] = fc_fd_summary
             self._results["edges_weight"] = edges_weight
             self._results["edges_weight_clean"] = edges_weight_clean
-            self._results["exclude_list"] = exclude_list
         return runtime
 
 class MergeGroupQualityMeasuresOutputSpec(TraitedSpec):
     fc_fd_summary = traits.List()
     edges_weight = traits.List()
     edges_weight_clean = traits.List()
-    exclude_list = traits.Set(traits.Str())
 
 class MergeGroupQualityMeasuresInputSpec(BaseInterfaceInputSpec):
     fc_fd_summary = traits.List()
     edges_weight = traits.List()
     edges_weight_clean = traits.List()
-    exclude_list = traits.List(default=[])
 
 class MergeGroupQualityMeasures(SimpleInterface):
     input_spec = MergeGroupQualityMeasuresInputSpec
@@ -136,7 +141,6 @@ class MergeGroupQualityMeasures(SimpleInterface):
         self._results['fc_fd_summary'] = self.inputs.fc_fd_summary
         self._results['edges_weight'] = self.inputs.edges_weight
         self._results['edges_weight_clean'] = self.inputs.edges_weight_clean
-        self._results['exclude_list'] = set(chain(*chain(*self.inputs.exclude_list)))
         return runtime
     
 class PipelinesQualityMeasuresInputSpec(BaseInterfaceInputSpec):
@@ -149,59 +153,85 @@ class PipelinesQualityMeasuresInputSpec(BaseInterfaceInputSpec):
     edges_weight_clean = traits.List( # TODO: Fix me
         exists=True,
         desc="Weights of individual edges")
+    atlas_names = traits.List(
+        traits.Str, [""],
+        usedefault=True,
+        desc="Names of parcellations (output of get_atlas_names)")
     output_dir = File(          # needed to save data in other directory
         desc="Output path")     # TODO: Implement temp dir
+    tsv = traits.Bool(
+        False,
+        usedefault=True,
+        desc="Also export tables as TSV")
 
 class PipelinesQualityMeasuresOutputSpec(TraitedSpec):
-    pipelines_fc_fd_summary = File(
-        exists=True,
+    pipelines_fc_fd_summary = OutputMultiPath(File(
+        exists=True),
         desc="Group QC-FC quality measures")
-    pipelines_edges_weight = File(
-        exists=True,
+    pipelines_edges_weight = OutputMultiPath(File(
+        exists=True),
         desc="Group weights of individual edges")
-    pipelines_edges_weight_clean = File(
-        exists=True,
+    pipelines_edges_weight_clean = OutputMultiPath(File(
+        exists=True),
         desc="Group weights of individual edges")
-    plot_pipeline_edges_density = File(
-        exists=True,
+    plot_pipeline_edges_density = OutputMultiPath(File(
+        exists=True),
         desc="Density of edge weights (all subjects)"
     )
-    plot_pipelines_edges_density_no_high_motion = File(
-        exist=True,
+    plot_pipelines_edges_density_no_high_motion = OutputMultiPath(File(
+        exist=True),
         desc="Density of edge weights (no high motion)"
     )
-    plot_pipelines_fc_fd_pearson = File(
-        exist=True
+    plot_pipelines_fc_fd_pearson = OutputMultiPath(File(
+        exist=True)
     )
-    plot_pipelines_fc_fd_uncorr = File(
-        exist=True
+    plot_pipelines_fc_fd_uncorr = OutputMultiPath(File(
+        exist=True)
     )
-    plot_pipelines_distance_dependence = File(
-        exist=True
+    plot_pipelines_distance_dependence = OutputMultiPath(File(
+        exist=True)
     )
-    plot_pipelines_tdof_loss = File(
-        exist=True
+    plot_pipelines_tdof_loss = OutputMultiPath(File(
+        exist=True)
     )
 
 class PipelinesQualityMeasures(SimpleInterface):
+    """
+    Merges quality measures of all pipelines, separately for each
+    parcellation (inputs are nested as pipelines x parcellations).
+    """
     input_spec = PipelinesQualityMeasuresInputSpec
     output_spec = PipelinesQualityMeasuresOutputSpec
     def _run_interface(self, runtime):
+        keys = ['pipelines_fc_fd_summary', 'pipelines_edges_weight', 'pipelines_edges_weight_clean',
+                'plot_pipeline_edges_density', 'plot_pipelines_edges_density_no_high_motion',
+                'plot_pipelines_fc_fd_pearson', 'plot_pipelines_fc_fd_uncorr',
+                'plot_pipelines_distance_dependence', 'plot_pipelines_tdof_loss']
+        results = {key: [] for key in keys}
+        for j, atlas_name in enumerate(self.inputs.atlas_names):
+            outputs = self._atlas_quality_measures(j, atlas_suffix(atlas_name))
+            for key in keys:
+                results[key].append(outputs[key])
+        self._results.update(results)
+        return runtime
+
+    def _atlas_quality_measures(self, j, suffix):
         # Convert merged quality measures to pd.DataFrame
         pipelines_fc_fd_summary = pd.DataFrame(
-            list(chain.from_iterable(list(chain.from_iterable(self.inputs.fc_fd_summary)))))
+            list(chain.from_iterable(summary[j] for summary in self.inputs.fc_fd_summary)))
         pipelines_edges_weight = pd.DataFrame()
         pipelines_edges_weight_clean = pd.DataFrame()
-        for edges in zip(self.inputs.edges_weight):
-            pipelines_edges_weight = pd.concat([pipelines_edges_weight, pd.DataFrame(edges[0][0])], axis=1)
-        for edges_clean in zip(self.inputs.edges_weight_clean):
-            pipelines_edges_weight_clean = pd.concat([pipelines_edges_weight_clean, pd.DataFrame(edges_clean[0][0])], axis=1)
-        fname1 = join(self.inputs.output_dir, f"pipelines_fc_fd_summary.tsv")
-        fname2 = join(self.inputs.output_dir, f"pipelines_edges_weight.tsv")
-        fname3 = join(self.inputs.output_dir, f"pipelines_edges_weight_clean.tsv")
-        pipelines_fc_fd_summary.to_csv(fname1, sep='\t', index=False)
-        pipelines_edges_weight.to_csv(fname2, sep='\t', index=False)
-        pipelines_edges_weight_clean.to_csv(fname3, sep='\t', index=False)
+        for edges in self.inputs.edges_weight:
+            pipelines_edges_weight = pd.concat([pipelines_edges_weight, pd.DataFrame(edges[j])], axis=1)
+        for edges_clean in self.inputs.edges_weight_clean:
+            pipelines_edges_weight_clean = pd.concat([pipelines_edges_weight_clean,
+                                                      pd.DataFrame(edges_clean[j])], axis=1)
+        fname1 = save_table(pipelines_fc_fd_summary,
+                            join(self.inputs.output_dir, f"pipelines_fc_fd_summary{suffix}"), self.inputs.tsv)
+        fname2 = save_table(pipelines_edges_weight,
+                            join(self.inputs.output_dir, f"pipelines_edges_weight{suffix}"), self.inputs.tsv)
+        fname3 = save_table(pipelines_edges_weight_clean,
+                            join(self.inputs.output_dir, f"pipelines_edges_weight_clean{suffix}"), self.inputs.tsv)
         # ----------------------
         # Plot quality measures
         # ----------------------
@@ -210,14 +240,14 @@ class PipelinesQualityMeasures(SimpleInterface):
         sns.kdeplot(data=pipelines_edges_weight, shade=True)
         plt.axvline(0, 0, 2, color='gray', linestyle='dashed', linewidth=1.5)
         plt.title("Density of edge weights (all subjects)")
-        plot_pipeline_edges_density = f"{self.inputs.output_dir}/pipelines_edges_density.svg"
+        plot_pipeline_edges_density = f"{self.inputs.output_dir}/pipelines_edges_density{suffix}.svg"
         fig1.savefig(plot_pipeline_edges_density, dpi=300,  bbox_inches='tight')
         
         fig1_2, ax = plt.subplots(1, 1)
         sns.kdeplot(data=pipelines_edges_weight_clean, shade=True)
         plt.axvline(0, 0, 2, color='gray', linestyle='dashed', linewidth=1.5)
         plt.title("Density of edge weights (no high motion)")
-        plot_pipelines_edges_density_no_high_motion = f"{self.inputs.output_dir}/pipelines_edges_density_no_high_motion.svg"
+        plot_pipelines_edges_density_no_high_motion = f"{self.inputs.output_dir}/pipelines_edges_density_no_high_motion{suffix}.svg"
         fig1_2.savefig(plot_pipelines_edges_density_no_high_motion, dpi=300,  bbox_inches='tight')
 
 
@@ -229,7 +259,7 @@ class PipelinesQualityMeasures(SimpleInterface):
                     data=pipelines_fc_fd_summary,
                     orient="h").set(xlabel="QC-FC (Pearson's r)",
                                     ylabel='Pipeline')
-        plot_pipelines_fc_fd_pearson = f"{self.inputs.output_dir}/pipelines_fc_fd_pearson.svg"
+        plot_pipelines_fc_fd_pearson = f"{self.inputs.output_dir}/pipelines_fc_fd_pearson{suffix}.svg"
         fig2.savefig(plot_pipelines_fc_fd_pearson, dpi=300, bbox_inches="tight")
         # Boxplot (% correlated edges)
         fig3 = sns.catplot(x="perc_fc_fd_uncorr",
@@ -239,7 +269,7 @@ class PipelinesQualityMeasures(SimpleInterface):
                     data=pipelines_fc_fd_summary,
                     orient="h").set(xlabel="QC-FC uncorrected (%)",
                                     ylabel='Pipeline')
-        plot_pipelines_fc_fd_uncorr = f"{self.inputs.output_dir}/pipelines_fc_fd_uncorr.svg"
+        plot_pipelines_fc_fd_uncorr = f"{self.inputs.output_dir}/pipelines_fc_fd_uncorr{suffix}.svg"
         fig3.savefig(plot_pipelines_fc_fd_uncorr, dpi=300, bbox_inches="tight")
         # Boxplot (Pearson's r FC-DC with distance)
         fig4 = sns.catplot(x="distance_dependence",
@@ -249,7 +279,7 @@ class PipelinesQualityMeasures(SimpleInterface):
                     data=pipelines_fc_fd_summary,
                     orient="h").set(xlabel="Distance-dependence",
                                     ylabel='Pipeline')        
-        plot_pipelines_distance_dependence = f"{self.inputs.output_dir}/pipelines_distance_dependence.svg"
+        plot_pipelines_distance_dependence = f"{self.inputs.output_dir}/pipelines_distance_dependence{suffix}.svg"
         fig4.savefig(plot_pipelines_distance_dependence, dpi=300, bbox_inches="tight")
         # Boxplot (fDOF-loss)
         fig5 = sns.catplot(x="tdof_loss",
@@ -258,15 +288,15 @@ class PipelinesQualityMeasures(SimpleInterface):
                            data=pipelines_fc_fd_summary,
                            orient="h").set(xlabel="fDOF-loss",
                                            ylabel='Pipeline')
-        plot_pipelines_tdof_loss = f"{self.inputs.output_dir}/pipelines_tdof_loss.svg"
+        plot_pipelines_tdof_loss = f"{self.inputs.output_dir}/pipelines_tdof_loss{suffix}.svg"
         fig5.savefig(plot_pipelines_tdof_loss, dpi=300, bbox_inches="tight")
-        self._results['pipelines_fc_fd_summary'] = fname1
-        self._results['pipelines_edges_weight'] = fname2
-        self._results['pipelines_edges_weight_clean'] = fname3
-        self._results['plot_pipeline_edges_density'] = plot_pipeline_edges_density
-        self._results['plot_pipelines_distance_dependence'] = plot_pipelines_distance_dependence
-        self._results['plot_pipelines_edges_density_no_high_motion'] = plot_pipelines_edges_density_no_high_motion
-        self._results['plot_pipelines_fc_fd_pearson'] = plot_pipelines_fc_fd_pearson
-        self._results['plot_pipelines_fc_fd_uncorr'] = plot_pipelines_fc_fd_uncorr
-        self._results['plot_pipelines_tdof_loss'] = plot_pipelines_fc_fd_uncorr
-        return runtime
+        plt.close('all')
+        return {'pipelines_fc_fd_summary': fname1,
+                'pipelines_edges_weight': fname2,
+                'pipelines_edges_weight_clean': fname3,
+                'plot_pipeline_edges_density': plot_pipeline_edges_density,
+                'plot_pipelines_distance_dependence': plot_pipelines_distance_dependence,
+                'plot_pipelines_edges_density_no_high_motion': plot_pipelines_edges_density_no_high_motion,
+                'plot_pipelines_fc_fd_pearson': plot_pipelines_fc_fd_pearson,
+                'plot_pipelines_fc_fd_uncorr': plot_pipelines_fc_fd_uncorr,
+                'plot_pipelines_tdof_loss': plot_pipelines_fc_fd_uncorr}
@@ -1,4 +1,4 @@
-from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec
+from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, InputMultiPath, isdefined
 from traits.trait_types import List, Dict, Directory, File, Str
 from RestingfMRI_Denoise.utils.report import create_report
 
@@ -7,22 +7,26 @@ class ReportCreatorInputSpec(BaseInterfaceInputSpec):
     pipelines_names = List(Str(), mandatory=True)
     group_data_dir = Directory(exists=True)
     excluded_subjects = List(Str(), value=())
-    plot_pipeline_edges_density = File(
-        exists=True,
+    motion_gated_runs = List(Str(), value=())
+    atlas_names = List(Str(), value=[""])
+    screening_trace = File(exists=True,
+                           desc="Decision trace of pilot screening of pipelines")
+    plot_pipeline_edges_density = InputMultiPath(File(
+        exists=True),
         desc="Density of edge weights (all subjects)"
     )
-    plot_pipelines_edges_density_no_high_motion = File(
-        exist=True,
+    plot_pipelines_edges_density_no_high_motion = InputMultiPath(File(
+        exist=True),
         desc="Density of edge weights (no high motion)"
     )
-    plot_pipelines_fc_fd_pearson = File(
-        exist=True
+    plot_pipelines_fc_fd_pearson = InputMultiPath(File(
+        exist=True)
     )
-    plot_pipelines_fc_fd_uncorr = File(
-        exist=True
+    plot_pipelines_fc_fd_uncorr = InputMultiPath(File(
+        exist=True)
     )
-    plot_pipelines_distance_dependence = File(
-        exist=True
+    plot_pipelines_distance_dependence = InputMultiPath(File(
+        exist=True)
     )
 
 class ReportCreator(SimpleInterface):
@@ -30,5 +34,8 @@ class ReportCreator(SimpleInterface):
     def _run_interface(self, runtime):
         create_report(self.inputs.group_data_dir,
                       self.inputs.pipelines,
-                      self.inputs.excluded_subjects)
+                      self.inputs.excluded_subjects,
+                      self.inputs.motion_gated_runs,
+                      self.inputs.atlas_names,
+                      self.inputs.screening_trace if isdefined(self.inputs.screening_trace) else None)
         return runtime
@@ -1,5 +1,7 @@
 import glob
 import os
+import numpy as np
+import nibabel as nb
 from nilearn import datasets
 
 def get_parcelation_file_path(name: str) -> str:
@@ -9,9 +11,76 @@ def get_parcelation_file_path(name: str) -> str:
         return path
     else:
         raise ValueError(f"File '{path}' is not part of denoise valid parcelation!")
-    
-def get_distance_matrix_file_path() -> str:
-    ret = glob.glob(os.path.join(os.path.dirname(__file__), "*.npy"))
-    if len(ret) != 1:
-        raise ValueError("Unexpected number of parcelation files")
-    return ret[0]
+
+def get_parcellation_name(path: str) -> str:
+    """
+    Name of parcellation used in filenames (file name without extension).
+    :param path: path to parcellation file
+    :return: name of parcellation
+    """
+    name = os.path.basename(path)
+    for ext in ('.nii.gz', '.nii'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def get_atlas_names(parcellation_paths) -> list:
+    """
+    Names of atlases used as _atlas-<name> suffix of output files.
+    For single parcellation name is empty, so legacy filenames are kept.
+    :param parcellation_paths: path or list of paths to parcellation files
+    :return: list of names
+    """
+    if isinstance(parcellation_paths, str):
+        parcellation_paths = [parcellation_paths]
+    if len(parcellation_paths) == 1:
+        return [""]
+    return [get_parcellation_name(path) for path in parcellation_paths]
+
+def atlas_suffix(atlas_name: str) -> str:
+    return f"_atlas-{atlas_name}" if atlas_name else ""
+
+def compute_distance_matrix(parcellation: str, out_file: str) -> str:
+    """
+    Computes euclidean distance (in mm) between centroids of parcels.
+    :param parcellation: path to parcellation file
+    :param out_file: path to output .npy file
+    :return: out_file
+    """
+    img = nb.load(parcellation)
+    labels = np.asarray(img.dataobj).astype(int)
+    voxels = np.nonzero(labels)
+    labels = labels[voxels]
+    coords = nb.affines.apply_affine(img.affine, np.array(voxels).T)
+    present, index, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    centroids = np.zeros((len(present), 3))
+    np.add.at(centroids, index, coords)
+    centroids /= counts[:, np.newaxis]
+    distance = np.linalg.norm(centroids[:, np.newaxis] - centroids[np.newaxis], axis=-1)
+    np.save(out_file, distance)
+    return out_file
+
+def get_distance_matrix_file_path(parcellation: str = None, output_dir: str = None) -> str:
+    """
+    Distance matrix for parcellation. Bundled matrix is used for bundled
+    parcellation, for other parcellations matrix is computed from parcel
+    centroids and saved in output_dir.
+    :param parcellation: path to parcellation file, default bundled parcellation
+    :param output_dir: directory for computed distance matrix
+    :return: path to distance matrix
+    """
+    if parcellation is None:
+        ret = glob.glob(os.path.join(os.path.dirname(__file__), "*.npy"))
+        if len(ret) != 1:
+            raise ValueError("Unexpected number of parcelation files")
+        return ret[0]
+    name = get_parcellation_name(parcellation)
+    bundled = os.path.join(os.path.dirname(__file__), name.split('_order')[0] + "_distance.npy")
+    if os.path.exists(bundled):
+        return bundled
+    if output_dir is None:
+        raise ValueError(f"Distance matrix for '{name}' is not bundled, output_dir is required")
+    out_file = os.path.join(output_dir, f"{name}_distance.npy")
+    if not os.path.exists(out_file):
+        compute_distance_matrix(parcellation, out_file)
+    return out_file
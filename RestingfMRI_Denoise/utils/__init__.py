@@ -1,7 +1,51 @@
+_logged_nodes = set()
+
+
 def profiler_callback(node, status):
-    from nipype.utils.profiler import log_nodes_cb
-    if status != 'end': 
+    """
+    Extension of nipype.utils.profiler.log_nodes_cb that additionally stores
+    node type (name of MapNode for its subnodes) and pipeline name
+    (taken from PipelineSelector iterable) of each finished node, and
+    effective number of BLAS/OpenMP threads of worker (see thread_budget).
+    MapNodes are logged as one record per subnode unless the plugin already
+    reported subnodes separately (e.g. MultiProc).
+    """
+    import re
+    import json
+    import logging
+    from os.path import join
+    if status != 'end':
         return
+    try:
+        output_dir = node.output_dir()
+    except Exception:
+        output_dir = ""
+    pipeline = re.search(r'pipeline-(.+?)\.json', output_dir)
+    pipeline = pipeline.group(1) if pipeline is not None else ""
     if isinstance(node.result.runtime, list):
-        return
-    return log_nodes_cb(node, status)
\ No newline at end of file
+        runtimes = [(f"_{node.name}{i}", f"{node._id}.{i}", runtime,
+                     join(output_dir, 'mapflow', f"_{node.name}{i}"))
+                    for i, runtime in enumerate(node.result.runtime)]
+    else:
+        runtimes = [(node.name, node._id, node.result.runtime, output_dir)]
+    for name, node_id, runtime, node_dir in runtimes:
+        if node_dir in _logged_nodes:
+            continue
+        _logged_nodes.add(node_dir)
+        status_dict = {
+            "name": name,
+            "id": node_id,
+            "node_type": re.sub(r'^_|\d+$', '', name),
+            "pipeline": pipeline,
+            "start": getattr(runtime, "startTime", None),
+            "finish": getattr(runtime, "endTime", None),
+            "duration": getattr(runtime, "duration", None),
+            "runtime_threads": getattr(runtime, "cpu_percent", "N/A"),
+            "runtime_memory_gb": getattr(runtime, "mem_peak_gb", "N/A"),
+            "estimated_memory_gb": node.mem_gb,
+            "num_threads": node.n_procs,
+            "blas_threads": getattr(runtime, "environ", {}).get("RESTINGFMRI_DENOISE_BLAS_THREADS", "N/A"),
+        }
+        if status_dict["start"] is None or status_dict["finish"] is None:
+            status_dict["error"] = True
+        logging.getLogger("callback").debug(json.dumps(status_dict))
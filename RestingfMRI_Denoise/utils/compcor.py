@@ -0,0 +1,196 @@
+import logging
+from os.path import join, dirname
+from glob import glob
+import numpy as np
+import pandas as pd
+import nibabel as nb
+from scipy import ndimage
+from sklearn.utils.extmath import randomized_svd
+from nilearn.image import resample_to_img
+
+COMPCOR_MODES = ('fmriprep', 'anatomical', 'temporal')
+# Components per mask, as many as aCompCor columns selected from fMRIPrep (get_a_comp_cor)
+N_COMPONENTS = 5
+# Period (s) of slowest cosine kept by high-pass filter (fMRIPrep default)
+HIGH_PASS_PERIOD = 128.
+# Labels of fMRIPrep discrete segmentation (dseg)
+TISSUE_LABELS = {'csf': 3, 'wm': 2}
+# Erosion (voxels) of tissue masks on BOLD grid limiting partial volume with grey matter
+EROSION = 1
+# Fraction of brain voxels with the highest temporal variance used by tCompCor (fMRIPrep default)
+TCOMPCOR_FRACTION = 0.02
+# Randomized SVD: extra random vectors and power iterations (accuracy of leading components)
+N_OVERSAMPLES = 10
+N_POWER_ITERATIONS = 4
+CHUNK_MB = 256
+
+
+def find_segmentation(fmri_prep: str) -> str:
+    """fMRIPrep discrete tissue segmentation in MNI152NLin2009cAsym space of
+    subject of run (session anatomy is preferred).
+    Raises:
+        FileNotFoundError: If segmentation is not found.
+    """
+    func_dir = dirname(fmri_prep)
+    candidates = []
+    for anat_dir in (join(dirname(func_dir), 'anat'), join(fmri_prep.split('/ses-')[0], 'anat')):
+        candidates += sorted(glob(join(anat_dir, '*space-MNI152NLin2009cAsym*_dseg.nii*')))
+    if not candidates:
+        raise FileNotFoundError(f"MNI152NLin2009cAsym tissue segmentation (dseg) not found for {fmri_prep}")
+    return candidates[0]
+
+
+def on_grid(path: str, img) -> np.array:
+    """Image resampled to voxel grid of img (nearest neighbour)."""
+    target = nb.Nifti1Image(np.zeros(img.shape[:3], dtype=np.int8), img.affine)
+    return np.asarray(resample_to_img(path, target, interpolation='nearest').dataobj)
+
+
+def tissue_masks(segmentation: str, img, brain: np.array, erosion: int = EROSION) -> dict:
+    """Eroded white matter and CSF masks on voxel grid of img.
+    Masks that erosion would leave with fewer voxels than components are
+    used without erosion.
+    Args:
+        segmentation (str): Path to fMRIPrep discrete segmentation.
+        img (nb.Nifti1Image): Image defining voxel grid.
+        brain (np.array): Boolean brain mask on voxel grid of img.
+        erosion (int): Erosion in voxels.
+    Returns:
+        dict: Tissue name to boolean array of shape img.shape[:3].
+    """
+    labels = on_grid(segmentation, img)
+    masks = {}
+    for tissue, label in TISSUE_LABELS.items():
+        mask = (labels == label) & brain
+        eroded = ndimage.binary_erosion(mask, iterations=erosion) if erosion else mask
+        if eroded.sum() < N_COMPONENTS:
+            logging.getLogger('nipype.interface').warning(
+                f"Eroded {tissue} mask of {segmentation} has {eroded.sum()} voxels, using mask without erosion")
+            eroded = mask
+        masks[tissue] = eroded
+    return masks
+
+
+def cosine_basis(n_volumes: int, t_r: float, period: float = HIGH_PASS_PERIOD) -> np.array:
+    """Constant and discrete cosine drift regressors with period longer than
+    period (same basis as fMRIPrep cosine columns).
+    Returns:
+        np.array: Shape (n_volumes, n_regressors), first column constant.
+    """
+    n_cosines = int(np.floor(2 * n_volumes * t_r / period))
+    times = np.arange(n_volumes) + .5
+    basis = [np.full(n_volumes, 1 / np.sqrt(n_volumes))]
+    basis += [np.sqrt(2 / n_volumes) * np.cos(np.pi * times * k / n_volumes) for k in range(1, n_cosines + 1)]
+    return np.stack(basis, axis=1)
+
+
+def masked_time_series(img, masks: list, chunk_mb: int = CHUNK_MB) -> list:
+    """Time series of voxels of every mask read in blocks of consecutive
+    volumes of img (whole image is never held in memory). Volumes are
+    contiguous in NIfTI file, so blocks are read in single forward pass;
+    gzipped image loaded with keep_file_open=True is decompressed once
+    (z-slabs span the whole file and decompress it again for every slab).
+    Returns:
+        list: float32 array (n_volumes, n_voxels) for every mask.
+    """
+    nx, ny, nz, nt = img.shape
+    volumes = max(1, int(chunk_mb * 2 ** 20 // (nx * ny * nz * 4)))
+    series = [np.empty((nt, int(mask.sum())), dtype=np.float32) for mask in masks]
+    for t in range(0, nt, volumes):
+        block = np.asarray(img.dataobj[..., t:t + volumes], dtype=np.float32)
+        for time_series, mask in zip(series, masks):
+            time_series[t:t + block.shape[3]] = block[mask].T
+    return series
+
+
+def high_pass(time_series: np.array, basis: np.array) -> np.array:
+    """Removes mean and drifts (columns of basis) from voxel time series,
+    in place and in float32."""
+    q, _ = np.linalg.qr(basis)
+    q = q.astype(np.float32)
+    time_series -= q @ (q.T @ time_series)
+    return time_series
+
+
+def principal_components(time_series: np.array, n_components: int = N_COMPONENTS) -> np.array:
+    """Leading temporal components of (filtered) voxel time series estimated
+    with randomized truncated SVD: cost grows with number of voxels times
+    number of volumes times number of components, instead of the square of
+    number of volumes of full SVD.
+    Args:
+        time_series (np.array): float32 array (n_volumes, n_voxels).
+        n_components (int): Number of components.
+    Returns:
+        np.array: Shape (n_volumes, n_components) with unit norm columns.
+    """
+    n_components = min(n_components, *time_series.shape)
+    if n_components == 0:
+        return np.zeros((time_series.shape[0], 0), dtype=np.float32)
+    u, _, _ = randomized_svd(time_series, n_components, n_oversamples=N_OVERSAMPLES,
+                             n_iter=N_POWER_ITERATIONS, random_state=0)
+    return u
+
+
+def compute_compcor(fmri_prep: str, t_r: float, output_file: str, brain_mask: str = None,
+                    segmentation: str = None, temporal: bool = False, n_components: int = N_COMPONENTS,
+                    erosion: int = EROSION) -> str:
+    """Computes anatomical (white matter and CSF) and optionally temporal
+    CompCor components from preprocessed BOLD: masked voxel time series are
+    high-pass filtered with cosine basis and their leading components are
+    estimated with randomized SVD, all in float32.
+    Components are saved with cosine regressors they were computed after,
+    so pipelines regress both (as with fMRIPrep aCompCor).
+    Args:
+        fmri_prep (str): Path to preprocessed fMRI image.
+        t_r (float): Repetition time.
+        output_file (str): Path to components table (tsv).
+        brain_mask (str): Path to brain mask or None.
+        segmentation (str): Path to tissue segmentation, found next to
+            preprocessed image if None (see find_segmentation).
+        temporal (bool): Also compute tCompCor components from voxels of
+            brain with the highest temporal variance.
+        n_components (int): Number of components per mask.
+        erosion (int): Erosion of tissue masks in voxels.
+    Returns:
+        str: output_file with compcor_csf_*, compcor_wm_*,
+            compcor_temporal_* and cosine* columns.
+    """
+    # File is kept open, so blocks of volumes continue decompression where previous block ended
+    img = nb.load(fmri_prep, keep_file_open=True)
+    brain = np.ones(img.shape[:3], dtype=bool) if brain_mask is None else on_grid(brain_mask, img) > 0
+    masks = tissue_masks(segmentation or find_segmentation(fmri_prep), img, brain, erosion)
+    if temporal:
+        masks['temporal'] = brain
+    names = list(masks)
+    basis = cosine_basis(img.shape[3], t_r)
+    components = {}
+    for name, time_series in zip(names, masked_time_series(img, [masks[name] for name in names])):
+        time_series = high_pass(time_series, basis)
+        if name == 'temporal':
+            variance = time_series.var(axis=0)
+            n_voxels = max(n_components, int(np.ceil(TCOMPCOR_FRACTION * len(variance))))
+            time_series = time_series[:, np.argsort(variance)[::-1][:n_voxels]]
+            time_series /= np.maximum(time_series.std(axis=0), np.finfo(np.float32).tiny)
+        for i, component in enumerate(principal_components(time_series, n_components).T):
+            components[f'compcor_{name}_{i:02d}'] = component
+    for i, cosine in enumerate(basis[:, 1:].T):
+        components[f'cosine{i:02d}'] = cosine
+    pd.DataFrame(components).to_csv(output_file, sep='\t', index=False)
+    return output_file
+
+
+def read_compcor(compcor_file: str) -> tuple:
+    """Components table written by compute_compcor and names of CompCor
+    components used as aCompCor regressors."""
+    table = pd.read_csv(compcor_file, sep='\t')
+    return table, [column for column in table.columns if column.startswith('compcor_')]
+
+
+def add_compcor_components(conf_df_raw: pd.DataFrame, compcor_file: str) -> pd.DataFrame:
+    """Adds components computed by compute_compcor to confounds table and
+    replaces fMRIPrep cosine regressors with cosine basis of components."""
+    table, _ = read_compcor(compcor_file)
+    conf_df_raw = conf_df_raw.drop(columns=conf_df_raw.filter(regex='^cosine').columns)
+    for column in table.columns:
+        conf_df_raw[column] = table[column].to_numpy()
+    return conf_df_raw
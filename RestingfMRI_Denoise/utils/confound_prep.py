@@ -2,11 +2,14 @@ import numpy as np
 import pandas as pd
 from glob import glob
 import os
+import json
 from nipype.utils.filemanip import split_filename
 from nilearn.input_data import NiftiLabelsMasker
 from nilearn.image import resample_to_img
 from nilearn.image import load_img
 from nilearn.image import resample_img
+from RestingfMRI_Denoise.utils.instrumentation import StageRecorder
+from RestingfMRI_Denoise.utils.compcor import read_compcor
 
 
 def calc_temp_deriv(signal):
@@ -81,32 +84,141 @@ def get_spikes_regressors(conf_df_raw, pipeline):
     return spikes_df
 
 
-def get_aroma_regressor(conf_df_raw, cur_mask, cur_segm, AromaConf_file, tmpAROMAwm, tmpAROMAcsf, tmpAROMA):
+def get_aroma_files(fname, task):
+    """Locates brain mask and segmentation used for AROMA tissue signals and
+    names of files derived from them.
+    Args:
+        fname (str): Path to raw confounds table.
+        task (str): Task name.
+    Returns:
+        tuple: brain mask, segmentation, AROMA confounds table, white matter
+            mask and csf mask paths.
+    """
+    path, base, _ = split_filename(fname)
+    cur_mask = glob(path + '/*' + task + '*space-MNI152NLin2009cAsym*brain*mask.nii*')[0]
+    AromaConf_file = os.path.join(path, f"{base}_AROMA.tsv")
+    cur_segm = glob(fname.split('/ses-')[0]+'/anat/*MNI152NLin2009cAsym_res-2_dseg.nii.gz')[0]
+    path_segm, base_segm, _ = split_filename(cur_segm)
+    tmpAROMAwm = os.path.join(path_segm, f"{base_segm}_wm.nii.gz")
+    tmpAROMAcsf = os.path.join(path_segm, f"{base_segm}_csf.nii.gz")
+    return cur_mask, cur_segm, AromaConf_file, tmpAROMAwm, tmpAROMAcsf
+
+
+def get_aroma_signals(cur_mask, cur_segm, AromaConf_file, tmpAROMAwm, tmpAROMAcsf, tmpAROMA,
+                      recorder=None):
+    """Extracts csf, white matter and global signal from ICA-AROMA denoised
+    data and stores them in AromaConf_file (skipped if file exists).
+    Returns:
+        str: AromaConf_file.
+    """
+    if recorder is None:
+        recorder = StageRecorder('get_aroma_regressor')
     if not os.path.isfile(AromaConf_file):
         from nipype.interfaces.fsl.maths import Threshold
         from nipype.interfaces.fsl.utils import ImageMeants
-        Threshold(in_file=cur_segm, thresh=1.5, out_file=tmpAROMAwm,  args=' -uthr 2.5 -bin').run()
-        Threshold(in_file=cur_segm, thresh=2.5, out_file=tmpAROMAcsf, args=' -uthr 3.5 -bin').run()
+        with recorder.stage('threshold_tissues'):
+            Threshold(in_file=cur_segm, thresh=1.5, out_file=tmpAROMAwm,  args=' -uthr 2.5 -bin').run()
+            Threshold(in_file=cur_segm, thresh=2.5, out_file=tmpAROMAcsf, args=' -uthr 3.5 -bin').run()
         dirname = os.path.dirname(__file__)
         from pathlib import Path
         path = Path(dirname)
         parentdir = path.parent.absolute()
         cur_template = os.path.join(parentdir,'templates/mni_icbm152_nlin_asym_09c/mni_icbm152_t1_tal_nlin_asym_09c.nii')
         rescale_index = 2
-        template_file_rescaled = resample_img(cur_template, target_affine=np.eye(3)*rescale_index, interpolation='nearest')
-        resampled_stat_img = resample_to_img(tmpAROMA, template_file_rescaled)
-        wmts = NiftiLabelsMasker(labels_img=tmpAROMAwm, detrend=False, standardize=False).fit_transform(resampled_stat_img)
-        csfts= NiftiLabelsMasker(labels_img=tmpAROMAcsf, detrend=False, standardize=False).fit_transform(resampled_stat_img) 
-        gsts = NiftiLabelsMasker(labels_img=cur_mask, detrend=False, standardize=False).fit_transform(resampled_stat_img)
+        with recorder.stage('resample'):
+            template_file_rescaled = resample_img(cur_template, target_affine=np.eye(3)*rescale_index, interpolation='nearest')
+            resampled_stat_img = resample_to_img(tmpAROMA, template_file_rescaled)
+        with recorder.stage('extract_signals'):
+            wmts = NiftiLabelsMasker(labels_img=tmpAROMAwm, detrend=False, standardize=False).fit_transform(resampled_stat_img)
+            csfts= NiftiLabelsMasker(labels_img=tmpAROMAcsf, detrend=False, standardize=False).fit_transform(resampled_stat_img) 
+            gsts = NiftiLabelsMasker(labels_img=cur_mask, detrend=False, standardize=False).fit_transform(resampled_stat_img)
         AROMAconfounds = np.concatenate((csfts, wmts, gsts), axis=1)
-        np.savetxt(AromaConf_file, AROMAconfounds, header='CSF\tWhiteMatter\tGlobalSignal',comments='',delimiter='\t')
+        with recorder.stage('save'):
+            np.savetxt(AromaConf_file, AROMAconfounds, header='CSF\tWhiteMatter\tGlobalSignal',comments='',delimiter='\t')
+    return AromaConf_file
 
+
+def add_aroma_signals(conf_df_raw, AromaConf_file):
+    """Replaces csf, white matter and global signal in confounds table with
+    signals extracted from ICA-AROMA denoised data.
+    Args:
+        conf_df_raw (pd.DataFrame): Contains unprocessed confounds.
+        AromaConf_file (str): Output of get_aroma_signals.
+    Returns:
+        pd.DataFrame: Confounds table with replaced signals.
+    """
     AROMAconfounds_df = pd.read_csv(AromaConf_file,sep='\t')
     conf_df_aroma = conf_df_raw
     conf_df_aroma[['csf','white_matter','global_signal']] = AROMAconfounds_df[['CSF','WhiteMatter','GlobalSignal']]
     return conf_df_aroma
 
-            
+
+def get_aroma_regressor(conf_df_raw, cur_mask, cur_segm, AromaConf_file, tmpAROMAwm, tmpAROMAcsf, tmpAROMA,
+                        recorder=None):
+    get_aroma_signals(cur_mask, cur_segm, AromaConf_file, tmpAROMAwm, tmpAROMAcsf, tmpAROMA, recorder)
+    return add_aroma_signals(conf_df_raw, AromaConf_file)
+
+
+def get_a_comp_cor(json_path):
+    """Selects retained aCompCor regressors (first 5 csf and first 5 white
+    matter components) from fMRIPrep confounds description.
+    Args:
+        json_path (str): Path to confounds json.
+    Returns:
+        list: Names of aCompCor regressors.
+    """
+    with open(json_path, 'r') as json_file:
+        js = json.load(json_file)
+    a_comp_cor_csf, a_comp_cor_wm = ([] for _ in range(2))
+    for i in js.keys():
+        if i.startswith('a_comp_cor'):
+            if js[i]['Mask'] == 'CSF' and js[i]['Retained']:
+                a_comp_cor_csf.append(i)
+            if js[i]['Mask'] == 'WM' and js[i]['Retained']:
+                a_comp_cor_wm.append(i)
+    return a_comp_cor_csf[:5] + a_comp_cor_wm[:5]
+
+
+def get_conf_invariants(conf_df_raw, conf_json, pipelines, fname=None, task=None, fmri_prep_aroma=None,
+                        recorder=None, compcor=None):
+    """Computes parts of confounds preprocessing that do not depend on
+    pipeline, so they can be shared by all pipelines.
+    Args:
+        conf_df_raw (pd.DataFrame): Contains unprocessed confounds.
+        conf_json (str): Path to confounds json.
+        pipelines (list): Denoising pipelines specifications, used to count
+            outlier scans and to decide if AROMA signals are needed.
+        fname (str): Path to raw confounds table (needed for AROMA signals).
+        task (str): Task name (needed for AROMA signals).
+        fmri_prep_aroma (str): ICA-AROMA denoised fMRI file.
+        compcor (str): CompCor components computed from BOLD (see
+            utils.compcor), used instead of fMRIPrep aCompCor columns.
+    Returns:
+        dict: mean_fd, max_fd, n_timepoints, a_comp_cor (list of aCompCor
+            regressors), n_spikes (number of outlier scans for each pipeline),
+            aroma_conf (path to AROMA signals table or None) and compcor.
+    """
+    if recorder is None:
+        recorder = StageRecorder('get_conf_invariants')
+    aroma_conf = None
+    if any(pipeline['aroma'] for pipeline in pipelines):
+        with recorder.stage('aroma_regressors'):
+            cur_mask, cur_segm, AromaConf_file, tmpAROMAwm, tmpAROMAcsf = get_aroma_files(fname, task)
+            aroma_conf = get_aroma_signals(cur_mask, cur_segm, AromaConf_file, tmpAROMAwm, tmpAROMAcsf,
+                                           fmri_prep_aroma, recorder.for_interface('get_aroma_regressor'))
+    with recorder.stage('acompcor_selection'):
+        a_comp_cor = read_compcor(compcor)[1] if compcor else get_a_comp_cor(conf_json)
+    n_spikes = {pipeline['name']: int(calc_outliers(conf_df_raw, pipeline).sum()) if pipeline['spikes'] else 0
+                for pipeline in pipelines}
+    return {"mean_fd": float(conf_df_raw["framewise_displacement"].mean()),
+            "max_fd": float(conf_df_raw["framewise_displacement"].max()),
+            "n_timepoints": len(conf_df_raw),
+            "a_comp_cor": a_comp_cor,
+            "n_spikes": n_spikes,
+            "aroma_conf": aroma_conf,
+            "compcor": compcor}
+
+
 def get_confounds_regressors(conf_df_raw, pipeline, a_comp_cor):
     """Prepare confound regressors given the method specified in pipeline.
     Args:
@@ -0,0 +1,161 @@
+import numpy as np
+
+METRICS = ('correlation', 'covariance', 'partial_correlation', 'tangent')
+# Diagonal of correlation matrices is constant, so it is not stored
+TRIU_OFFSET = {'correlation': 1, 'covariance': 0, 'partial_correlation': 1, 'tangent': 0}
+
+
+def _standardize(time_series):
+    """Centers and scales each column to unit variance (as
+    nilearn.signal.standardize_signal with standardize=True)."""
+    time_series = time_series - time_series.mean(axis=1, keepdims=True)
+    std = time_series.std(axis=1, keepdims=True)
+    std[std < np.finfo(np.float64).eps] = 1.
+    return time_series / std
+
+
+def ledoit_wolf(time_series):
+    """Ledoit-Wolf shrunk covariance of many runs at once (same estimate as
+    sklearn.covariance.LedoitWolf).
+    Args:
+        time_series (np.array): Shape (n_runs, n_timepoints, n_regions).
+    Returns:
+        np.array: Covariance matrices, shape (n_runs, n_regions, n_regions).
+    """
+    n_timepoints, n_regions = time_series.shape[1:]
+    X = time_series - time_series.mean(axis=1, keepdims=True)
+    emp_cov = np.matmul(X.transpose(0, 2, 1), X) / n_timepoints
+    emp_cov_trace = np.einsum('nii->ni', emp_cov)
+    mu = emp_cov_trace.sum(axis=1) / n_regions
+    beta_ = ((X ** 2).sum(axis=2) ** 2).sum(axis=1)
+    delta_ = (emp_cov ** 2).sum(axis=(1, 2))
+    beta = (beta_ / n_timepoints - delta_) / (n_regions * n_timepoints)
+    delta = (delta_ - 2. * mu * emp_cov_trace.sum(axis=1) + n_regions * mu ** 2) / n_regions
+    beta = np.minimum(beta, delta)
+    shrinkage = np.divide(beta, delta, out=np.zeros_like(beta), where=beta != 0)
+    shrunk_cov = (1. - shrinkage)[:, np.newaxis, np.newaxis] * emp_cov
+    shrunk_cov[:, np.arange(n_regions), np.arange(n_regions)] += (shrinkage * mu)[:, np.newaxis]
+    return shrunk_cov
+
+
+def _grouped_ledoit_wolf(time_series, standardize=False):
+    """Applies ledoit_wolf to runs grouped by number of timepoints."""
+    covariances = [None] * len(time_series)
+    lengths = [len(run) for run in time_series]
+    for length in set(lengths):
+        index = [i for i, run_length in enumerate(lengths) if run_length == length]
+        batch = np.stack([time_series[i] for i in index]).astype(np.float64)
+        if standardize:
+            batch = _standardize(batch)
+        for i, covariance in zip(index, ledoit_wolf(batch)):
+            covariances[i] = covariance
+    return np.stack(covariances)
+
+
+def cov_to_corr(covariances):
+    d = np.sqrt(np.einsum('nii->ni', covariances))
+    correlations = covariances / d[:, :, np.newaxis] / d[:, np.newaxis, :]
+    n_regions = covariances.shape[1]
+    correlations[:, np.arange(n_regions), np.arange(n_regions)] = 1.
+    return correlations
+
+
+def prec_to_partial(precisions):
+    partial = -cov_to_corr(precisions)
+    n_regions = precisions.shape[1]
+    partial[:, np.arange(n_regions), np.arange(n_regions)] = 1.
+    return partial
+
+
+def _map_eigenvalues(function, matrices):
+    """Applies function to eigenvalues of stacked symmetric matrices."""
+    eigenvalues, eigenvectors = np.linalg.eigh(matrices)
+    return np.matmul(eigenvectors * function(eigenvalues)[..., np.newaxis, :],
+                     np.swapaxes(eigenvectors, -1, -2))
+
+
+def geometric_mean(matrices, max_iter=30, tol=1e-7):
+    """Geometric mean of symmetric positive definite matrices (gradient
+    descent of nilearn.connectome.connectivity_matrices._geometric_mean,
+    with whitening and logarithms of all matrices computed at once).
+    Args:
+        matrices (np.array): Shape (n_runs, n_regions, n_regions).
+    Returns:
+        np.array: Geometric mean, shape (n_regions, n_regions).
+    """
+    gmean = matrices.mean(axis=0)
+    norm_old = np.inf
+    step = 1.
+    for _ in range(max_iter):
+        vals_gmean, vecs_gmean = np.linalg.eigh(gmean)
+        gmean_inv_sqrt = (vecs_gmean / np.sqrt(vals_gmean)) @ vecs_gmean.T
+        logs_mean = _map_eigenvalues(np.log, gmean_inv_sqrt @ matrices @ gmean_inv_sqrt).mean(axis=0)
+        if np.any(np.isnan(logs_mean)):
+            raise FloatingPointError("Nan value after logarithm operation.")
+        norm = np.linalg.norm(logs_mean)
+        gmean_sqrt = (vecs_gmean * np.sqrt(vals_gmean)) @ vecs_gmean.T
+        gmean = gmean_sqrt @ _map_eigenvalues(lambda x: np.exp(x * step), logs_mean) @ gmean_sqrt
+        if norm < norm_old:
+            norm_old = norm
+        elif norm > norm_old:
+            step = step / 2.
+            norm = norm_old
+        if tol is not None and norm / gmean.size < tol:
+            break
+    return gmean
+
+
+def connectivity_metrics(time_series, metrics=METRICS) -> dict:
+    """Computes connectivity matrices of all runs at once, with the same
+    definitions as nilearn ConnectivityMeasure (Ledoit-Wolf covariance
+    estimator): correlation, covariance, partial_correlation and tangent.
+    Reference of tangent space is geometric mean of covariances of all runs.
+    Args:
+        time_series (list): np.array of shape (n_timepoints, n_regions) for
+            each run, number of timepoints may differ between runs.
+        metrics (tuple): Names of metrics to compute.
+    Returns:
+        dict: np.array of shape (n_runs, n_regions, n_regions) for each
+            metric and tangent_mean (geometric mean) if tangent is computed.
+    """
+    unknown = set(metrics) - set(METRICS)
+    if unknown:
+        raise ValueError(f"Unknown connectivity metrics: {sorted(unknown)}, allowed: {METRICS}")
+    results = {}
+    if 'correlation' in metrics:
+        results['correlation'] = cov_to_corr(_grouped_ledoit_wolf(time_series, standardize=True))
+    if set(metrics) - {'correlation'}:
+        covariances = _grouped_ledoit_wolf(time_series)
+        if 'covariance' in metrics:
+            results['covariance'] = covariances
+        if 'partial_correlation' in metrics:
+            results['partial_correlation'] = prec_to_partial(np.linalg.inv(covariances))
+        if 'tangent' in metrics:
+            results['tangent_mean'] = geometric_mean(covariances)
+            whitening = _map_eigenvalues(lambda x: 1. / np.sqrt(x), results['tangent_mean'])
+            results['tangent'] = _map_eigenvalues(np.log, whitening @ covariances @ whitening)
+    return results
+
+
+def to_upper_triangle(matrices, offset=0):
+    """Stores upper triangle of (stacked) symmetric matrices as float32.
+    Args:
+        matrices (np.array): Shape (..., n_regions, n_regions).
+        offset (int): 0 to keep diagonal, 1 to discard it.
+    Returns:
+        np.array: Shape (..., n_edges).
+    """
+    rows, cols = np.triu_indices(matrices.shape[-1], k=offset)
+    return matrices[..., rows, cols].astype(np.float32)
+
+
+def from_upper_triangle(vectors, n_regions, offset=0, diagonal=1.):
+    """Inverse of to_upper_triangle (diagonal is filled with diagonal value
+    if it was discarded)."""
+    rows, cols = np.triu_indices(n_regions, k=offset)
+    matrices = np.zeros(vectors.shape[:-1] + (n_regions, n_regions), dtype=vectors.dtype)
+    matrices[..., rows, cols] = vectors
+    matrices[..., cols, rows] = vectors
+    if offset:
+        matrices[..., np.arange(n_regions), np.arange(n_regions)] = diagonal
+    return matrices
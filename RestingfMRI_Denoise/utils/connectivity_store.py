@@ -0,0 +1,156 @@
+import fcntl
+from os.path import join
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import h5py
+from RestingfMRI_Denoise.parcellation import atlas_suffix
+from RestingfMRI_Denoise.utils.connectivity_metrics import to_upper_triangle, from_upper_triangle
+from RestingfMRI_Denoise.utils.dynamic_connectivity import EDGES_CHUNK
+
+INDEX_KEYS = ('subject', 'session', 'task')
+# Rows of connectivity vectors and volumes of time series per chunk
+RUNS_CHUNK = 64
+VOLUMES_CHUNK = 256
+
+
+def store_path(store_dir: str, pipeline_name: str, atlas_name: str = "") -> str:
+    """Path to connectivity store of pipeline and parcellation."""
+    return join(store_dir, f'{pipeline_name}{atlas_suffix(atlas_name)}_connectivity.h5')
+
+
+def entity_key(entities: dict) -> tuple:
+    return tuple(str(entities.get(key, '')) for key in INDEX_KEYS)
+
+
+@contextmanager
+def _locked(path):
+    """Exclusive lock of store shared by all worker processes (HDF5 files
+    do not support concurrent writers)."""
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _create(store, n_regions):
+    string = h5py.string_dtype()
+    n_edges = n_regions * (n_regions - 1) // 2
+    store.attrs['n_regions'] = n_regions
+    index = store.create_group('index')
+    for key in INDEX_KEYS:
+        index.create_dataset(key, shape=(0,), maxshape=(None,), dtype=string, chunks=(RUNS_CHUNK,))
+    store.create_dataset('conn', shape=(0, n_edges), maxshape=(None, n_edges), dtype=np.float32,
+                         chunks=(RUNS_CHUNK, max(1, min(n_edges, EDGES_CHUNK))))
+    store.create_dataset('time_series', shape=(0, n_regions), maxshape=(None, n_regions), dtype=np.float32,
+                         chunks=(VOLUMES_CHUNK, n_regions))
+    for name in ('ts_start', 'ts_length'):
+        store.create_dataset(name, shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(RUNS_CHUNK,))
+
+
+def _keys(store) -> list:
+    index = store['index']
+    return list(zip(*[index[key].asstr()[:] for key in INDEX_KEYS]))
+
+
+def append_runs(path: str, entities: list, corr_mats: list, time_series: list) -> str:
+    """Adds connectivity of runs to store. Runs are keyed by (subject,
+    session, task): a run already present is replaced in place, so
+    appending the same runs again (rerun of Connectivity, resume from
+    checkpoint) leaves the store unchanged. Safe to call from concurrent
+    worker processes.
+    Layout: /index/{subject,session,task} (one row per run), /conn
+    (runs x edges, upper triangle without diagonal) and /time_series
+    (volumes of all runs x regions, rows ts_start:ts_start + ts_length of
+    run), all float32 and chunked.
+    Args:
+        path (str): Store path (see store_path).
+        entities (list): Entities of runs.
+        corr_mats (list): Correlation matrices of runs.
+        time_series (list): Parcel time series of runs (volumes x regions).
+    Returns:
+        str: path
+    """
+    with _locked(path), h5py.File(path, 'a') as store:
+        if 'conn' not in store:
+            _create(store, corr_mats[0].shape[0])
+        rows = {key: row for row, key in enumerate(_keys(store))}
+        conn, ts = store['conn'], store['time_series']
+        for run_entities, corr_mat, run_time_series in zip(entities, corr_mats, time_series):
+            key, n_volumes = entity_key(run_entities), len(run_time_series)
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = len(rows)
+                for name in ('conn', 'ts_start', 'ts_length', *[f'index/{name}' for name in INDEX_KEYS]):
+                    store[name].resize(row + 1, axis=0)
+                for name, value in zip(INDEX_KEYS, key):
+                    store['index'][name][row] = value
+                store['ts_length'][row] = -1
+            start, length = store['ts_start'][row], store['ts_length'][row]
+            if length != n_volumes:
+                if length >= 0 and start + length == ts.shape[0]:
+                    # Last segment is resized in place
+                    ts.resize(start + n_volumes, axis=0)
+                elif length < n_volumes:
+                    # New segment, shorter segment of rerun is left unused
+                    store['ts_start'][row] = ts.shape[0]
+                    ts.resize(ts.shape[0] + n_volumes, axis=0)
+                store['ts_length'][row] = n_volumes
+            start = store['ts_start'][row]
+            conn[row] = to_upper_triangle(np.asarray(corr_mat), 1)
+            ts[start:start + n_volumes] = np.asarray(run_time_series, dtype=np.float32)
+    return path
+
+
+def read_n_regions(path: str) -> int:
+    """Number of regions of parcellation of store."""
+    with h5py.File(path, 'r') as store:
+        return int(store.attrs['n_regions'])
+
+
+def read_index(path: str) -> pd.DataFrame:
+    """Entities of runs in store, row number is the run index of /conn."""
+    with h5py.File(path, 'r') as store:
+        return pd.DataFrame(_keys(store), columns=list(INDEX_KEYS))
+
+
+def _rows(store, entities) -> list:
+    rows = {key: row for row, key in enumerate(_keys(store))}
+    if entities is None:
+        return list(range(len(rows)))
+    try:
+        return [rows[entity_key(run_entities)] for run_entities in entities]
+    except KeyError as err:
+        raise KeyError(f"Run {dict(zip(INDEX_KEYS, err.args[0]))} not found in connectivity store") from None
+
+
+def read_connectivity(path: str, entities: list = None, matrices: bool = False) -> np.array:
+    """Connectivity of selected runs read from store.
+    Args:
+        path (str): Store path (see store_path).
+        entities (list): Entities of runs in requested order, all runs if
+            None.
+        matrices (bool): Return full correlation matrices instead of upper
+            triangles.
+    Returns:
+        np.array: Shape (n_runs, n_edges) or (n_runs, n_regions, n_regions).
+    """
+    with h5py.File(path, 'r') as store:
+        rows = _rows(store, entities)
+        # h5py selections must be increasing
+        unique = sorted(set(rows))
+        vectors = store['conn'][unique][np.searchsorted(unique, rows)] if rows \
+            else np.zeros((0, store['conn'].shape[1]), dtype=np.float32)
+        n_regions = int(store.attrs['n_regions'])
+    return from_upper_triangle(vectors, n_regions, offset=1) if matrices else vectors
+
+
+def read_time_series(path: str, entities: list = None) -> list:
+    """Parcel time series of selected runs read from store (see
+    read_connectivity)."""
+    with h5py.File(path, 'r') as store:
+        starts, lengths, ts = store['ts_start'][:], store['ts_length'][:], store['time_series']
+        return [ts[starts[row]:starts[row] + lengths[row]] for row in _rows(store, entities)]
+
@@ -0,0 +1,322 @@
+import json
+from os.path import getsize, splitext
+import numpy as np
+import pandas as pd
+import nibabel as nb
+from RestingfMRI_Denoise.utils.design_dedup import effective_settings
+from RestingfMRI_Denoise.utils.pipeline_grid import shared_stages
+from RestingfMRI_Denoise.utils.instrumentation import stage_log_path
+from RestingfMRI_Denoise.utils.profile_summary import read_json_lines
+
+GB = 2 ** 30
+NS = 1e-9
+# Share of voxels of fMRIPrep MNI152NLin2009cAsym grid inside brain mask
+BRAIN_FRACTION = 0.25
+# Size of gzipped float32 data relative to raw bytes (noise-like signals compress poorly)
+GZIP_RATIO = 0.9
+# Resident memory of worker with nipype, nilearn and matplotlib imported
+BASE_MEMORY = 0.4 * GB
+PLOT_BYTES = 200 * 2 ** 10
+# Node directory of nipype engine (inputs, results pickle, report)
+NODE_BYTES = 100 * 2 ** 10
+# Upper bound of number of regressors of preprocessed confounds
+CONF_PREP_COLUMNS = 40
+# Share of brain voxels in eroded white matter and CSF masks of CompCor
+TISSUE_FRACTION = 0.3
+# Cleaning time (ns) per in-mask voxel and volume of temporal filter engines (see utils.temporal_filter)
+CLEAN_NS = {'butterworth': 100, 'fft': 40}
+# Stages instrumented with StageRecorder, calibrated from stage logs
+CALIBRATED_STAGES = ('CompCor', 'Confounds', 'Denoise', 'Connectivity', 'SeedConnectivity')
+# Stages of in-process engines computed once per distinct design (see utils.pipeline_grid.shared_stages)
+SHARED_STAGES = ('Confounds', 'Denoise', 'CohortDenoise')
+
+
+def run_label(entities: dict) -> str:
+    return "_".join(f"{key}-{entities[key]}" for key in ('subject', 'session', 'task')
+                    if key in entities and not pd.isna(entities[key]))
+
+
+def run_inventory(runs: list) -> pd.DataFrame:
+    """Sizes of selected runs read from NIfTI headers and confounds tables
+    (image data is not loaded).
+    Args:
+        runs: Runs grabbed from BIDS dataset (see executor.grab_runs).
+    Returns:
+        pd.DataFrame: One row per run with grid size, number of volumes,
+            bytes per voxel of loaded data and number of confounds rows.
+    """
+    rows = []
+    for run in runs:
+        header = nb.load(run['fmri_prep']).header
+        shape = header.get_data_shape()
+        slope, inter = header.get_slope_inter()
+        # Scaled integer data is loaded as float64
+        scaled = (slope is not None and slope != 1) or (inter is not None and inter != 0)
+        with open(run['conf_raw'], 'r') as conf_file:
+            n_columns = len(conf_file.readline().split('\t'))
+            n_rows = sum(1 for _ in conf_file)
+        rows.append({'run': run_label(run['entities']),
+                     'n_voxels': int(np.prod(shape[:3])),
+                     'n_volumes': shape[3] if len(shape) > 3 else 1,
+                     'itemsize': 8 if scaled else header.get_data_dtype().itemsize,
+                     'bold_bytes': getsize(run['fmri_prep']),
+                     'conf_rows': n_rows,
+                     'conf_columns': n_columns,
+                     'masked': bool(run.get('brain_mask'))})
+    return pd.DataFrame(rows)
+
+
+def count_parcels(parcellation_paths: list) -> list:
+    """Number of labels of each parcellation (atlases are small, so their
+    data is read)."""
+    return [len(np.setdiff1d(np.unique(np.asanyarray(nb.load(path).dataobj)), [0]))
+            for path in parcellation_paths]
+
+
+def store_bytes(run, n_parcels: list) -> int:
+    """Float32 connectivity vector and time series of run in connectivity
+    stores (see utils.connectivity_store)."""
+    return sum((n * (n - 1) // 2 + run.n_volumes * n) * 4 for n in n_parcels)
+
+
+def job_cost(stage: str, run, pipeline: dict, context: dict) -> tuple:
+    """Default cost model of one job of stage.
+    Args:
+        stage: Stage name (see estimate_cost).
+        run: Row of run_inventory (None for group stages).
+        pipeline: Pipeline dictionary (None for per-run stages).
+        context: Settings of estimate (n_parcels, n_runs, n_seeds, smoothing,
+            temporal_filter).
+    Returns:
+        tuple: CPU seconds, peak memory, bytes written to work dir and
+            bytes written to derivatives.
+    """
+    n_parcels = context['n_parcels']
+    if run is not None:
+        voxel_volumes = run.n_voxels * run.n_volumes
+        brain_volumes = voxel_volumes * (BRAIN_FRACTION if run.masked else 1.)
+        conf_memory = run.conf_rows * run.conf_columns * 8 * 4
+    if stage == 'ConfInvariants':
+        return 2., BASE_MEMORY + conf_memory, 0, 0
+    if stage == 'CompCor':
+        # masked voxels of every mask are kept in float32, randomized SVD of (volumes x voxels) matrices
+        masked = brain_volumes * (TISSUE_FRACTION + context['compcor_temporal'])
+        cpu = voxel_volumes * 20 * NS + masked * 300 * NS
+        table = run.n_volumes * CONF_PREP_COLUMNS * 20
+        return cpu, BASE_MEMORY + 256 * 2 ** 20 + masked * 4 * 2, table, 0
+    if stage == 'Confounds':
+        conf_prep = run.conf_rows * CONF_PREP_COLUMNS * 20
+        return 1., BASE_MEMORY + conf_memory, conf_prep, conf_prep
+    if stage == 'Denoise':
+        smoothing = effective_settings(pipeline, context['smoothing'], None, None)['smoothing']
+        # load, gzip of output, smoothing of whole grid and cleaning of in-mask voxels
+        clean = CLEAN_NS[context['temporal_filter']]
+        cpu = voxel_volumes * (20 + 80 + 40 * smoothing) * NS + brain_volumes * clean * NS
+        memory = voxel_volumes * (run.itemsize + 8 * smoothing + 4) + brain_volumes * 16
+        denoised = brain_volumes * 4 * GZIP_RATIO
+        return cpu, BASE_MEMORY + memory, denoised, denoised
+    if stage == 'Connectivity':
+        matrices = sum(n * n * 8 + 2 * PLOT_BYTES for n in n_parcels)
+        time_series = sum(run.n_volumes * n * 8 for n in n_parcels)
+        return (3 + voxel_volumes * 30 * NS, BASE_MEMORY + voxel_volumes * 12, matrices + time_series,
+                matrices + store_bytes(run, n_parcels))
+    if stage == 'SeedConnectivity':
+        n_seeds = context['n_seeds']
+        maps = n_seeds * run.n_voxels * 4 * GZIP_RATIO
+        cpu = voxel_volumes * (20 + 10 * n_seeds) * NS + n_seeds * run.n_voxels * 80 * NS
+        return cpu, BASE_MEMORY + voxel_volumes * 12, maps, maps
+    if stage == 'RegionSignals':
+        signals = run.n_volumes * sum(n_parcels) * 8
+        return voxel_volumes * 30 * NS, BASE_MEMORY + voxel_volumes * (run.itemsize + 4), signals, 0
+    if stage == 'CohortDenoise':
+        matrices = sum(n * n * 8 for n in n_parcels)
+        time_series = sum(run.n_volumes * n * 8 for n in n_parcels)
+        cpu = run.n_volumes * sum(n_parcels) * CONF_PREP_COLUMNS * 20 * NS
+        return cpu, BASE_MEMORY + 4 * time_series, matrices + time_series, matrices + store_bytes(run, n_parcels)
+    if stage == 'GroupQC':
+        n_runs, edges = context['n_runs'], sum(n * (n - 1) // 2 for n in n_parcels)
+        # stacked correlation matrices and metrics of all runs, edge weights tables (binary) and plots
+        group = sum(2 * n_runs * n * n * 8 for n in n_parcels) + 2 * edges * 8 + 6 * PLOT_BYTES
+        return 2 + n_runs * edges * 200 * NS, BASE_MEMORY + n_runs * edges * 8 * 3, 0, group
+    if stage == 'Report':
+        n_pipelines = context['n_pipelines']
+        return 10 + 2 * n_pipelines, BASE_MEMORY, 0, (4 * n_pipelines + 5) * PLOT_BYTES
+    raise ValueError(f"Unknown stage '{stage}'")
+
+
+def engine_stages(engine: str, seeds: bool = False, compcor: bool = False) -> list:
+    """Stages of engine with their scope ('run', 'pair' of run and
+    pipeline, 'pipeline' or 'group')."""
+    per_run = [('CompCor', 'run')] if compcor else []
+    if engine == 'cohort':
+        per_run += [('ConfInvariants', 'run'), ('Confounds', 'pair'), ('RegionSignals', 'run'),
+                    ('CohortDenoise', 'pair')]
+    else:
+        per_run += [('ConfInvariants', 'run'), ('Confounds', 'pair'), ('Denoise', 'pair'),
+                    ('Connectivity', 'pair')]
+        if seeds:
+            per_run.append(('SeedConnectivity', 'pair'))
+    return per_run + [('GroupQC', 'pipeline'), ('Report', 'group')]
+
+
+def read_stage_logs(paths: list) -> pd.DataFrame:
+    """Reads stage-level records (PROFILER_stages.jsonl); paths of profiler
+    logs are replaced by stage logs stored next to them."""
+    logs = [path if splitext(path)[1] == '.jsonl' else stage_log_path(path) for path in paths]
+    records = [read_json_lines(path) for path in logs]
+    records = [frame for frame in records if not frame.empty]
+    return pd.concat(records, ignore_index=True) if records else pd.DataFrame()
+
+
+def calibrate(stages: pd.DataFrame, inventory: pd.DataFrame, pipelines: list, context: dict) -> dict:
+    """Scales of default cost model fitted to stage records of runs present
+    in inventory (e.g. profiled pilot of the same cohort).
+    CPU time is scaled by ratio of measured to modelled total, memory by the
+    largest ratio of measured peak of the stage to modelled peak.
+    Args:
+        stages: Stage records (see read_stage_logs).
+        inventory: Output of run_inventory.
+        pipelines: Pipeline dictionaries, matched to records by name.
+        context: Settings of estimate.
+    Returns:
+        dict: Stage to tuple (cpu scale, memory scale, number of jobs used).
+    """
+    if stages.empty or 'interface' not in stages:
+        return {}
+    stages = stages.copy()
+    stages['run'] = stages.apply(run_label, axis=1)
+    if 'pipeline' not in stages:
+        stages['pipeline'] = ""
+    stages['pipeline'] = stages['pipeline'].fillna("")
+    if 'process_peak_rss_mb' not in stages:
+        stages['process_peak_rss_mb'] = np.nan
+    # Older logs stored high-water mark of the whole process as peak_rss_mb,
+    # which overestimates stages run in reused workers
+    stages['peak_rss_mb'] = stages['peak_rss_mb'].where(stages['process_peak_rss_mb'].notna())
+    runs = inventory.set_index('run')
+    by_name = {pipeline['name']: pipeline for pipeline in pipelines}
+    default_pipeline = {'aroma': False, 'confounds': {'acompcor': False}}
+    scales = {}
+    for stage in CALIBRATED_STAGES:
+        records = stages[(stages['interface'] == stage) & stages['run'].isin(runs.index)]
+        if stage == 'Denoise' and not records.empty:
+            # jobs reusing denoised image of equivalent design did not clean data
+            cleaned = records.groupby(['run', 'pipeline'])['stage'].transform(lambda names: (names == 'clean').any())
+            records = records[cleaned.astype(bool)]
+        if records.empty:
+            continue
+        jobs = records.groupby(['run', 'pipeline']).agg(cpu_time=('cpu_time', 'sum'),
+                                                         peak_rss_mb=('peak_rss_mb', 'max')).reset_index()
+        modelled = [job_cost(stage, runs.loc[job.run], by_name.get(job.pipeline, default_pipeline), context)
+                    for job in jobs.itertuples()]
+        cpu = np.array([cost[0] for cost in modelled])
+        memory = np.array([cost[1] for cost in modelled])
+        memory_ratio = (jobs['peak_rss_mb'].values * 2 ** 20 / memory)
+        scales[stage] = (jobs['cpu_time'].sum() / cpu.sum(),
+                         np.nanmax(memory_ratio) if np.isfinite(memory_ratio).any() else 1.,
+                         len(jobs))
+    return scales
+
+
+def estimate_cost(runs: list, pipelines: list, parcellation_paths: list, engine: str = 'nipype',
+                  n_workers: int = 1, seeds: list = None, smoothing: bool = True,
+                  keep_intermediates: bool = False, compcor: str = 'fmriprep', temporal_filter: str = 'butterworth',
+                  stage_logs: list = ()) -> tuple:
+    """Estimates CPU time, peak memory and written bytes of every stage
+    without running it.
+    Args:
+        runs: Runs grabbed from BIDS dataset (see executor.grab_runs).
+        pipelines: Pipeline dictionaries.
+        parcellation_paths: Paths to parcellations.
+        engine: Execution engine ('nipype', 'inprocess' or 'cohort').
+        n_workers: Number of parallel workers.
+        seeds: Seeds of seed-to-voxel maps or None.
+        smoothing: Smoothing of denoised images.
+        keep_intermediates: Denoised images are kept in work dir, otherwise
+            only images of running jobs occupy it (see utils.lifecycle).
+        compcor: Source of aCompCor components, components computed from
+            BOLD add CompCor stage (see utils.compcor).
+        temporal_filter: Temporal filter engine of Denoise.
+        stage_logs: Stage logs of earlier runs used for calibration.
+    Returns:
+        tuple: pd.DataFrame with one row per stage and dictionary of totals.
+    """
+    inventory = run_inventory(runs)
+    context = {'n_parcels': count_parcels(parcellation_paths),
+               'n_runs': len(runs),
+               'n_pipelines': len(pipelines),
+               'n_seeds': len(seeds) if seeds else 0,
+               'smoothing': smoothing,
+               'compcor_temporal': compcor == 'temporal',
+               'temporal_filter': temporal_filter}
+    scales = calibrate(read_stage_logs(list(stage_logs)), inventory, pipelines, context) if stage_logs else {}
+    shared = shared_stages(pipelines)
+    rows = []
+    compcor_stage = compcor != 'fmriprep' and any(pipeline['confounds']['acompcor'] for pipeline in pipelines)
+    for stage, scope in engine_stages(engine, bool(seeds), compcor_stage):
+        if scope == 'run':
+            jobs = [(run, None) for run in inventory.itertuples()]
+        elif scope == 'pair':
+            jobs = [(run, pipeline) for pipeline in pipelines for run in inventory.itertuples()]
+        elif scope == 'pipeline':
+            jobs = [(None, pipeline) for pipeline in pipelines]
+        else:
+            jobs = [(None, None)]
+        costs = np.array([job_cost(stage, run, pipeline, context) for run, pipeline in jobs]).reshape(-1, 4)
+        if stage in SHARED_STAGES and engine != 'nipype':
+            # Pairs of pipelines with the same design link outputs of representative pipeline
+            linked = np.array([shared[pipeline['name']]['design'] != pipeline['name'] for _, pipeline in jobs])
+            costs[linked, 0] = costs[linked, 2] = 0
+        cpu_scale, memory_scale, n_calibration = scales.get(stage, (1., 1., 0))
+        work = costs[:, 2].sum()
+        if stage == 'Denoise' and not keep_intermediates:
+            work = costs[:, 2].max() * min(n_workers, len(jobs))
+        work += NODE_BYTES * len(jobs) if engine == 'nipype' else 0
+        rows.append({'stage': stage,
+                     'scope': scope,
+                     'n_jobs': len(jobs),
+                     'cpu_hours': costs[:, 0].sum() * cpu_scale / 3600,
+                     'mean_cpu_s': costs[:, 0].mean() * cpu_scale if len(jobs) else 0.,
+                     'peak_memory_gb': costs[:, 1].max() * memory_scale / GB if len(jobs) else 0.,
+                     'work_dir_gb': work / GB,
+                     'derivatives_gb': costs[:, 3].sum() / GB,
+                     'calibration_jobs': n_calibration})
+    table = pd.DataFrame(rows)
+    parallel = table['scope'].isin(['run', 'pair', 'pipeline'])
+    totals = {'engine': engine,
+              'n_runs': len(runs),
+              'n_pipelines': len(pipelines),
+              'n_workers': n_workers,
+              'cpu_hours': table['cpu_hours'].sum(),
+              'wall_hours': table.loc[parallel, 'cpu_hours'].sum() / max(n_workers, 1)
+                            + table.loc[~parallel, 'cpu_hours'].sum(),
+              'peak_node_memory_gb': table['peak_memory_gb'].max(),
+              'peak_memory_gb': table.loc[parallel, 'peak_memory_gb'].max() * max(n_workers, 1),
+              'work_dir_gb': table['work_dir_gb'].sum(),
+              'derivatives_gb': table['derivatives_gb'].sum(),
+              'calibrated_stages': sorted(set(scales) & set(table['stage']))}
+    return table, totals
+
+
+def format_estimate(table: pd.DataFrame, totals: dict) -> str:
+    """Human readable table of estimate_cost outputs."""
+    lines = [f"Estimated cost: {totals['n_runs']} runs x {totals['n_pipelines']} pipelines, "
+             f"engine {totals['engine']}, {totals['n_workers']} workers",
+             table.to_string(index=False, float_format=lambda value: f'{value:.3f}'),
+             f"CPU time: {totals['cpu_hours']:.2f} h, wall time: {totals['wall_hours']:.2f} h",
+             f"Peak memory: {totals['peak_node_memory_gb']:.2f} GB per node, "
+             f"{totals['peak_memory_gb']:.2f} GB with all workers busy",
+             f"Disk: {totals['work_dir_gb']:.2f} GB in work dir, {totals['derivatives_gb']:.2f} GB in derivatives"]
+    if totals['calibrated_stages']:
+        lines.append(f"Calibrated from stage logs: {', '.join(totals['calibrated_stages'])}")
+    else:
+        lines.append("Default cost model (no stage logs of selected runs for calibration)")
+    lines.append("Disk usage is an upper bound: pipelines sharing design are denoised once, "
+                 "work dir of denoised images is the peak of running jobs unless they are kept.")
+    return "\n".join(lines)
+
+
+def save_estimate(table: pd.DataFrame, totals: dict, path: str) -> None:
+    with open(path, 'w') as json_file:
+        json.dump({'stages': table.to_dict(orient='records'), 'totals': totals}, json_file, indent=2,
+                  default=lambda value: value.item())  # numpy scalars
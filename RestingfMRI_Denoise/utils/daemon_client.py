@@ -0,0 +1,64 @@
+#Thin client of RestingfMRI_Denoise daemon (workflows.daemon)
+#Uses only standard library, so submitting job does not pay for importing
+#nipype, nilearn and matplotlib.
+import os
+import sys
+import json
+import socket
+import argparse
+
+
+def request(socket_path: str, message: dict) -> dict:
+    """
+    Sends one JSON request to daemon and waits for its response.
+    :param socket_path: path to UNIX socket of daemon
+    :param message: request, e.g. {'command': 'denoise', 'argv': [...]}
+    :return: response dictionary with status key ('ok' or 'error')
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(message) + '\n').encode())
+        with sock.makefile('r') as stream:
+            line = stream.readline()
+    if not line:
+        raise ConnectionError(f"Daemon at {socket_path} closed connection without response")
+    return json.loads(line)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Submits job to RestingfMRI_Denoise daemon. Arguments after socket are the same as "
+                    "arguments of RestingfMRI_Denoise, jobs are executed one by one in order of submission. "
+                    "Options --ping and --shutdown must precede socket.")
+    parser.add_argument("socket",
+                        help="Path to UNIX socket of daemon.")
+    parser.add_argument("--ping",
+                        help="Check that daemon is running.",
+                        action="store_true")
+    parser.add_argument("--shutdown",
+                        help="Stop daemon after currently running job.",
+                        action="store_true")
+    parser.add_argument("args",
+                        nargs=argparse.REMAINDER,
+                        help="Arguments of RestingfMRI_Denoise (e.g. bids_dir -sub 01 -p pipeline-24HMP_8Phys).")
+    return parser
+
+
+def main(argv: list = None) -> int:
+    args = get_parser().parse_args(argv)
+    if args.ping:
+        message = {'command': 'ping'}
+    elif args.shutdown:
+        message = {'command': 'shutdown'}
+    else:
+        message = {'command': 'denoise', 'argv': args.args, 'cwd': os.getcwd()}
+    response = request(args.socket, message)
+    if response['status'] != 'ok':
+        print(response.get('error', ''), file=sys.stderr)
+        return 1
+    print(json.dumps({key: value for key, value in response.items() if key != 'status'}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+import os
+import shutil
+import fcntl
+import hashlib
+from os.path import join, exists, abspath
+from contextlib import contextmanager
+import numpy as np
+from nipype.utils.filemanip import split_filename
+
+
+def effective_settings(pipeline, smoothing, high_pass, low_pass, temporal_filter='butterworth') -> dict:
+    """Filter and smoothing settings actually applied by Denoise to pipeline
+    (low-pass filter is skipped for aCompCor pipelines, smoothing for AROMA
+    pipelines)."""
+    return {'smoothing': bool(smoothing and not pipeline['aroma']),
+            'high_pass': high_pass,
+            'low_pass': None if pipeline['confounds']['acompcor'] else low_pass,
+            'temporal_filter': temporal_filter}
+
+
+def denoise_fingerprint(fmri_prep, brain_mask, confounds, t_r, settings) -> str:
+    """Fingerprint of denoising problem solved by Denoise.
+    Pipelines with equal fingerprint for the same run (e.g. spike regressors
+    selecting no volumes of low-motion run) give identical denoised images.
+    Args:
+        fmri_prep (str): Path to preprocessed fMRI image.
+        brain_mask (str): Path to brain mask or None.
+        confounds (np.array): Final design matrix or None (no confounds).
+        t_r (float): Repetition time.
+        settings (dict): Output of effective_settings.
+    Returns:
+        str: Hexadecimal sha256 digest.
+    """
+    digest = hashlib.sha256()
+    for path in (fmri_prep, brain_mask):
+        if path:
+            stat = os.stat(path)
+            digest.update(f'{abspath(path)}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+        else:
+            digest.update(b'None;')
+    digest.update(repr((float(t_r), sorted(settings.items()))).encode())
+    if confounds is not None:
+        confounds = np.ascontiguousarray(confounds, dtype=np.float64)
+        digest.update(repr(confounds.shape).encode())
+        digest.update(confounds.tobytes())
+    return digest.hexdigest()
+
+
+def representatives(fingerprints) -> list:
+    """Index of first item with the same fingerprint for each item."""
+    first = {}
+    return [first.setdefault(fingerprint, i) for i, fingerprint in enumerate(fingerprints)]
+
+
+def link_or_copy(src, dst) -> None:
+    if exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+@contextmanager
+def cached_design(cache_dir, fingerprint, out_file):
+    """Content-addressed cache of denoised images shared by pipelines with
+    the same fingerprint, safe for concurrent processes (cache entry is
+    guarded by file lock).
+    Yields True if out_file was linked from cache, otherwise False and the
+    caller is expected to write out_file, which is then stored in cache.
+    """
+    _, _, ext = split_filename(out_file)
+    cached = join(cache_dir, fingerprint + ext)
+    with open(join(cache_dir, f'{fingerprint}.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if exists(cached):
+                link_or_copy(cached, out_file)
+                yield True
+            else:
+                yield False
+                if exists(out_file):
+                    link_or_copy(out_file, cached)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,116 @@
+import numpy as np
+import h5py
+from scipy.signal import fftconvolve, get_window
+
+EDGES_CHUNK = 4096
+
+
+def get_taper(window: int, taper: str = 'rectangular') -> np.array:
+    """Window weights.
+    Args:
+        window (int): Window length in volumes.
+        taper (str): 'rectangular' or name of window accepted by
+            scipy.signal.get_window (e.g. 'hamming', 'hann', 'tukey').
+    Returns:
+        np.array: Weights of length window.
+    """
+    if taper == 'rectangular':
+        return np.ones(window)
+    return get_window(taper, window, fftbins=False)
+
+
+def _window_sums(series, weights, step):
+    """Weighted sums of series over all windows.
+    Rectangular windows are computed as differences of cumulative sums,
+    tapered windows as FFT convolution with the taper, so cost does not
+    depend on window length.
+    Args:
+        series (np.array): Shape (n_timepoints, n_series).
+        weights (np.array): Window weights.
+        step (int): Shift between consecutive windows in volumes.
+    Returns:
+        np.array: Shape (n_windows, n_series).
+    """
+    window = len(weights)
+    if np.all(weights == weights[0]):
+        cumsum = np.zeros((len(series) + 1, series.shape[1]))
+        np.cumsum(series, axis=0, out=cumsum[1:])
+        starts = np.arange(0, len(series) - window + 1, step)
+        return weights[0] * (cumsum[starts + window] - cumsum[starts])
+    return fftconvolve(series, weights[::-1, np.newaxis], mode='valid', axes=0)[::step]
+
+
+def sliding_window_correlation(time_series, window, step=1, taper='rectangular'):
+    """Windowed (weighted) Pearson correlation of all pairs of regions.
+    Args:
+        time_series (np.array): Shape (n_timepoints, n_regions).
+        window (int): Window length in volumes.
+        step (int): Shift between consecutive windows in volumes.
+        taper (str): Window weights, see get_taper.
+    Returns:
+        np.array: Shape (n_windows, n_edges), upper triangle (without
+            diagonal) of correlation matrix of each window.
+    """
+    n_timepoints, n_regions = time_series.shape
+    if window > n_timepoints:
+        raise ValueError(f"Window ({window}) is longer than time series ({n_timepoints})")
+    weights = get_taper(window, taper)
+    weights = weights / weights.sum()
+    # Standardised series limit cancellation errors in sums of products
+    x = time_series - time_series.mean(axis=0)
+    std = x.std(axis=0)
+    x = x / np.where(std > 0, std, 1.)
+    mean = _window_sums(x, weights, step)
+    var = _window_sums(x ** 2, weights, step) - mean ** 2
+    sd = np.sqrt(np.clip(var, 0, None))
+    rows, cols = np.triu_indices(n_regions, k=1)
+    dfc = np.zeros((len(mean), len(rows)), dtype=np.float32)
+    for start in range(0, len(rows), EDGES_CHUNK):
+        i, j = rows[start:start + EDGES_CHUNK], cols[start:start + EDGES_CHUNK]
+        cov = _window_sums(x[:, i] * x[:, j], weights, step) - mean[:, i] * mean[:, j]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dfc[:, start:start + EDGES_CHUNK] = np.nan_to_num(cov / (sd[:, i] * sd[:, j]))
+    return dfc
+
+
+def edge_variability(dfc):
+    """Standard deviation of Fisher z-transformed windowed correlations of
+    each edge."""
+    return np.arctanh(np.clip(dfc, -0.999999, 0.999999)).std(axis=0).astype(np.float32)
+
+
+def save_dynamic_connectivity(fname, runs, dfc_runs, window, step, taper, n_regions):
+    """Stores windowed correlations in chunked HDF5 file.
+    Layout: /runs/<run>/dfc (n_windows x n_edges, chunked by windows and
+    edges), /runs/<run>/edge_mean and /runs/<run>/edge_variability, and
+    group datasets /edge_mean and /edge_variability (n_runs x n_edges).
+    Runs are written as they are consumed from dfc_runs, so it can be a
+    generator computing one run at a time.
+    Args:
+        fname (str): Output file.
+        runs (list): Names of runs.
+        dfc_runs (iterable): Output of sliding_window_correlation of each
+            run (in order of runs).
+        window (int): Window length in volumes.
+        step (int): Shift between consecutive windows in volumes.
+        taper (str): Window taper.
+        n_regions (int): Number of regions of parcellation.
+    Returns:
+        str: fname
+    """
+    n_edges = n_regions * (n_regions - 1) // 2
+    with h5py.File(fname, 'w') as store:
+        store.attrs.update({'window': window, 'step': step, 'taper': taper, 'n_regions': n_regions})
+        store.create_dataset('run_names', data=np.array(runs, dtype='S'))
+        group = store.create_group('runs')
+        edge_mean = store.create_dataset('edge_mean', shape=(len(runs), n_edges), dtype=np.float32)
+        edge_std = store.create_dataset('edge_variability', shape=(len(runs), n_edges), dtype=np.float32)
+        for row, (run, dfc) in enumerate(zip(runs, dfc_runs)):
+            run_group = group.create_group(run)
+            run_group.create_dataset('dfc', data=dfc,
+                                     chunks=(min(len(dfc), 64), min(dfc.shape[1], EDGES_CHUNK)))
+            edge_mean[row] = dfc.mean(axis=0)
+            edge_std[row] = edge_variability(dfc)
+            run_group.create_dataset('edge_mean', data=edge_mean[row])
+            run_group.create_dataset('edge_variability', data=edge_std[row])
+    return fname
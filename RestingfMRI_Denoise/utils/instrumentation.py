@@ -0,0 +1,156 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from os.path import splitext
+
+STAGE_LOG_ENV = "RESTINGFMRI_DENOISE_STAGE_LOG"
+# Seconds between samples of resident memory during stage
+RSS_SAMPLE_INTERVAL = 0.02
+
+
+def stage_log_path(profiler_path: str) -> str:
+    """
+    Returns path of stage-level log stored next to nipype profiler log.
+    :param profiler_path: path to nipype callback log
+    :return: path to JSON lines file with stage records
+    """
+    return splitext(profiler_path)[0] + "_stages.jsonl"
+
+
+def enable_stage_log(path: str) -> None:
+    """
+    Enables stage instrumentation for current process and all workers spawned
+    afterwards (path is passed through environment variable).
+    :param path: path to JSON lines output file
+    """
+    os.environ[STAGE_LOG_ENV] = path
+
+
+def disable_stage_log() -> None:
+    os.environ.pop(STAGE_LOG_ENV, None)
+
+
+def is_enabled() -> bool:
+    return bool(os.environ.get(STAGE_LOG_ENV))
+
+
+def _rss_mb() -> float:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        return float('nan')
+
+
+def _process_peak_rss_mb() -> float:
+    # High-water mark of the whole process, includes stages run before in reused worker
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+class _RssSampler:
+    """
+    Samples resident memory of current process in background thread, so that
+    peak of a single stage is known also in workers reused across stages.
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start = self.peak = _rss_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss_mb())
+
+    def __enter__(self) -> '_RssSampler':
+        if self.peak == self.peak:  # psutil available (not NaN)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.peak = max(self.peak, _rss_mb())
+
+
+def _write_record(path: str, record: dict) -> None:
+    # Single write on O_APPEND descriptor keeps lines intact across workers
+    line = (json.dumps(record) + "\n").encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class StageRecorder:
+    """
+    Records wall time, CPU time and memory of internal stages of interface.
+    peak_rss_mb is the largest resident memory sampled during the stage,
+    process_peak_rss_mb the high-water mark of the process so far.
+    Records are written as JSON lines to the file given by
+    RESTINGFMRI_DENOISE_STAGE_LOG environment variable. When variable is
+    not set stage() is a no-op context manager.
+    Args:
+        interface: name of instrumented interface or function
+        entities: BIDS entities of processed run (subject, session, task)
+        pipeline: name of denoising pipeline
+    """
+
+    def __init__(self, interface: str, entities: dict = None, pipeline: str = None):
+        self.interface = interface
+        self.tags = {}
+        for key in ('subject', 'session', 'task'):
+            if entities and key in entities:
+                self.tags[key] = entities[key]
+        if pipeline is not None:
+            self.tags['pipeline'] = pipeline
+
+    def for_interface(self, interface: str) -> 'StageRecorder':
+        """Returns recorder with the same tags for different interface."""
+        recorder = StageRecorder(interface)
+        recorder.tags = dict(self.tags)
+        return recorder
+
+    @property
+    def enabled(self) -> bool:
+        """Whether stages are recorded (RESTINGFMRI_DENOISE_STAGE_LOG is set)."""
+        return is_enabled()
+
+    @contextmanager
+    def stage(self, name: str, **extra):
+        path = os.environ.get(STAGE_LOG_ENV)
+        if not path:
+            yield
+            return
+        start_time = time.time()
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        sampler = _RssSampler()
+        try:
+            with sampler:
+                yield
+        finally:
+            rss_end = _rss_mb()
+            record = {"interface": self.interface,
+                      "stage": name,
+                      "start": start_time,
+                      "duration": time.perf_counter() - start,
+                      "cpu_time": time.process_time() - cpu_start,
+                      "rss_start_mb": sampler.start,
+                      "rss_end_mb": rss_end,
+                      "rss_delta_mb": rss_end - sampler.start,
+                      "peak_rss_mb": sampler.peak,
+                      "process_peak_rss_mb": _process_peak_rss_mb(),
+                      "pid": os.getpid()}
+            record.update(self.tags)
+            record.update(extra)
+            _write_record(path, record)
@@ -0,0 +1,139 @@
+import os
+import time
+import fcntl
+import logging
+from os.path import join, exists, isfile
+from contextlib import contextmanager
+
+GB = 2 ** 30
+# Seconds between checks of paused job
+QUOTA_POLL = 10.
+LEASES_DIR = '.leases'
+
+
+def disk_usage(path) -> int:
+    """Bytes allocated by files under path, hardlinked files (e.g. design
+    cache entries) are counted once."""
+    seen, total = set(), 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.lstat(join(root, name))
+            except FileNotFoundError:  # removed by other worker
+                continue
+            if stat.st_ino not in seen:
+                seen.add(stat.st_ino)
+                total += stat.st_blocks * 512
+    return total
+
+
+def evict(paths) -> int:
+    """Removes intermediate files whose consumers have finished.
+    Returns:
+        int: Number of freed bytes (files hardlinked elsewhere free nothing).
+    """
+    freed = 0
+    for path in paths:
+        if not isfile(path):
+            continue
+        stat = os.stat(path)
+        os.remove(path)
+        if stat.st_nlink == 1:
+            freed += stat.st_blocks * 512
+    return freed
+
+
+def drop_unused_designs(cache_dir) -> int:
+    """Removes design cache entries (see design_dedup.cached_design) not
+    linked by any denoised image, i.e. kept only for possible reuse.
+    Entries locked by running denoising jobs are skipped."""
+    freed = 0
+    if not cache_dir or not exists(cache_dir):
+        return freed
+    for name in os.listdir(cache_dir):
+        fingerprint, ext = name.split('.', 1)
+        if ext == 'lock':
+            continue
+        with open(join(cache_dir, f'{fingerprint}.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            try:
+                path = join(cache_dir, name)
+                if exists(path) and os.stat(path).st_nlink == 1:
+                    freed += evict([path])
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    return freed
+
+
+def _reservations(leases_dir) -> tuple:
+    """Number of running heavy jobs and bytes reserved by them, leases of
+    dead processes are removed."""
+    running, reserved = 0, 0
+    for name in os.listdir(leases_dir):
+        pid = int(name.split('-')[0])
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            os.remove(join(leases_dir, name))
+            continue
+        except PermissionError:  # process of other user is alive
+            pass
+        try:
+            with open(join(leases_dir, name), 'r') as lease:
+                reserved += int(lease.read() or 0)
+        except FileNotFoundError:  # job has just finished
+            continue
+        running += 1
+    return running, reserved
+
+
+@contextmanager
+def work_quota(work_dir, quota_gb, reserve, cache_dir=None, poll=QUOTA_POLL):
+    """Admission of heavy job under work dir quota, shared by all worker
+    processes through lease files guarded by file lock.
+    Job starts when used space, space reserved by running heavy jobs and
+    its own reservation fit into quota; otherwise unused design cache
+    entries are dropped and the job waits until running jobs finish and
+    evict their intermediates. Job which is the only one running is never
+    paused, so workers cannot wait for each other forever.
+    Args:
+        work_dir (str): Work directory.
+        quota_gb (float): Quota in GB, None disables admission.
+        reserve (int): Expected number of bytes written by the job.
+        cache_dir (str): Design cache directory.
+        poll (float): Seconds between checks of paused job.
+    """
+    if quota_gb is None:
+        yield
+        return
+    leases_dir = join(work_dir, LEASES_DIR)
+    os.makedirs(leases_dir, exist_ok=True)
+    lease = join(leases_dir, f'{os.getpid()}-{time.monotonic_ns()}')
+    quota, paused = quota_gb * GB, False
+    while True:
+        with open(join(work_dir, '.quota.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                running, reserved = _reservations(leases_dir)
+                used = disk_usage(work_dir)
+                if used + reserved + reserve > quota:
+                    used -= drop_unused_designs(cache_dir)
+                if used + reserved + reserve <= quota or not running:
+                    with open(lease, 'w') as lease_file:
+                        lease_file.write(str(reserve))
+                    break
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        if not paused:
+            logging.getLogger('nipype.workflow').info(
+                f"Work dir quota: {used / GB:.2f} GB used and {reserved / GB:.2f} GB reserved of "
+                f"{quota_gb:.2f} GB, job waits for running jobs to evict intermediates")
+            paused = True
+        time.sleep(poll)
+    try:
+        yield
+    finally:
+        os.remove(lease)
@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from nilearn import signal
+from nilearn.image import new_img_like, smooth_img
+
+from RestingfMRI_Denoise.utils.thread_budget import thread_limit, blas_threads
+from RestingfMRI_Denoise.utils.temporal_filter import prepare_confounds, clean_signals
+
+# Chunk sizes are fixed (independent of number of threads), so results do
+# not depend on number of threads
+VOXELS_CHUNK = 16384
+VOLUMES_CHUNK = 16
+
+
+def _chunks(n_items, chunk_size):
+    return [slice(start, min(start + chunk_size, n_items)) for start in range(0, n_items, chunk_size)]
+
+
+def _map(function, items, n_threads):
+    if n_threads > 1:
+        # BLAS threads of process are shared by all threads of pool
+        with thread_limit(max(1, (blas_threads() or n_threads) // n_threads)), \
+                ThreadPoolExecutor(max_workers=n_threads) as pool:
+            return list(pool.map(function, items))
+    return list(map(function, items))
+
+
+def smooth_img_chunked(img, fwhm, n_threads=1):
+    """nilearn.image.smooth_img of 4D image applied to chunks of volumes in
+    thread pool (volumes are smoothed independently, result is the same as
+    smoothing whole image).
+    Args:
+        img (nb.Nifti1Image): 4D image.
+        fwhm (float): Smoothing kernel in mm.
+        n_threads (int): Number of threads.
+    Returns:
+        nb.Nifti1Image: Smoothed image.
+    """
+    data = np.asanyarray(img.dataobj)
+    chunks = _chunks(data.shape[3], VOLUMES_CHUNK)
+    smoothed = _map(lambda chunk: np.asanyarray(smooth_img(new_img_like(img, data[..., chunk]), fwhm).dataobj),
+                    chunks, n_threads)
+    return new_img_like(img, np.concatenate(smoothed, axis=3), copy_header=True)
+
+
+def clean_img_chunked(img, confounds=None, n_threads=1, mask=None, temporal_filter='butterworth', **kwargs):
+    """nilearn.image.clean_img (without mask) with voxels split into chunks
+    of VOXELS_CHUNK cleaned in thread pool; heavy kernels (BLAS, filtering)
+    release GIL. Signals are cleaned in float64 (nilearn keeps float32 data
+    in float32, where results depend on chunking), and each voxel is cleaned
+    independently of others, so chunks give the same signals as cleaning
+    all voxels at once in float64.
+    With mask only in-mask voxels are extracted (as 2D array) and cleaned,
+    voxels outside of mask are zeros in returned image. Returned image is
+    float32 with and without mask.
+    With temporal_filter 'fft' signals are filtered with precomputed
+    frequency response (utils.temporal_filter.clean_signals) and confounds
+    are filtered and orthonormalized once for all chunks.
+    Args:
+        img (nb.Nifti1Image): 4D image.
+        confounds (np.array): Confounds passed to nilearn.signal.clean.
+        n_threads (int): Number of threads.
+        mask (np.array): Boolean array of shape img.shape[:3] or None.
+        temporal_filter (str): 'butterworth' (nilearn.signal.clean) or
+            'fft'.
+        **kwargs: Other parameters of nilearn.signal.clean (detrend,
+            standardize, high_pass, low_pass, t_r).
+    Returns:
+        nb.Nifti1Image: Cleaned image.
+    """
+    kwargs.setdefault('detrend', True)
+    kwargs.setdefault('standardize', True)
+    data = np.asanyarray(img.dataobj)
+    signals = (data[mask] if mask is not None else data.reshape(-1, img.shape[3])).T
+    cleaned = np.empty(signals.shape)
+    if temporal_filter == 'fft':
+        band = kwargs['t_r'], kwargs.get('high_pass'), kwargs.get('low_pass')
+        basis = prepare_confounds(confounds, *band) if confounds is not None else None
+        def clean_chunk(chunk):
+            cleaned[:, chunk] = clean_signals(signals[:, chunk], basis, *band)
+    else:
+        def clean_chunk(chunk):
+            cleaned[:, chunk] = signal.clean(signals[:, chunk].astype(np.float64), confounds=confounds, **kwargs)
+    _map(clean_chunk, _chunks(signals.shape[1], VOXELS_CHUNK), n_threads)
+    if mask is None:
+        return new_img_like(img, cleaned.T.reshape(img.shape).astype(np.float32), copy_header=True)
+    return new_img_like(img, unmask(cleaned, mask), copy_header=True)
+
+
+def unmask(signals, mask) -> np.array:
+    """Reconstructs 4D volume (float32) from signals of in-mask voxels.
+    Args:
+        signals (np.array): Shape (n_timepoints, n_voxels_in_mask).
+        mask (np.array): Boolean array of 3D shape.
+    Returns:
+        np.array: Shape mask.shape + (n_timepoints,), zeros outside of mask.
+    """
+    volume = np.zeros(mask.shape + (signals.shape[0],), dtype=np.float32)
+    volume[mask] = signals.T
+    return volume
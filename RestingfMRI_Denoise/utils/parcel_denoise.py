@@ -0,0 +1,108 @@
+import numpy as np
+from nilearn.signal import butterworth
+
+from RestingfMRI_Denoise.utils.connectivity_metrics import ledoit_wolf, cov_to_corr
+from RestingfMRI_Denoise.utils.temporal_filter import fft_filter
+
+BATCH_MB = 512
+
+
+def batched_detrend(signals):
+    """Removes mean and linear trend of each column.
+    Args:
+        signals (np.array): Shape (n_batch, n_timepoints, n_columns).
+    Returns:
+        np.array: Detrended signals.
+    """
+    n_timepoints = signals.shape[1]
+    signals = signals - signals.mean(axis=1, keepdims=True)
+    trend = np.arange(n_timepoints, dtype=np.float64)
+    trend = (trend - trend.mean()) / np.linalg.norm(trend - trend.mean())
+    return signals - trend[:, np.newaxis] * np.einsum('t,btn->bn', trend, signals)[:, np.newaxis, :]
+
+
+def batched_zscore(signals):
+    signals = signals - signals.mean(axis=1, keepdims=True)
+    std = signals.std(axis=1, keepdims=True)
+    std[std < np.finfo(np.float64).eps] = 1.
+    return signals / std
+
+
+def batched_butterworth(signals, t_r, high_pass=None, low_pass=None, temporal_filter='butterworth'):
+    """nilearn.signal.butterworth (or utils.temporal_filter.fft_filter with
+    temporal_filter 'fft') applied along time axis of all columns of all
+    batch items at once."""
+    if high_pass is None and low_pass is None:
+        return signals
+    n_batch, n_timepoints, n_columns = signals.shape
+    flat = signals.transpose(1, 0, 2).reshape(n_timepoints, -1)
+    if temporal_filter == 'fft':
+        flat = fft_filter(flat, t_r, high_pass, low_pass)
+    else:
+        flat = butterworth(flat, sampling_rate=1. / t_r, high_pass=high_pass, low_pass=low_pass, copy=True)
+    return flat.reshape(n_timepoints, n_batch, n_columns).transpose(1, 0, 2)
+
+
+def batched_clean(signals, confounds, t_r, high_pass=None, low_pass=None, temporal_filter='butterworth'):
+    """Denoising of many (run, pipeline) pairs at once with the steps of
+    nilearn.signal.clean (detrend=True, standardize='zscore',
+    butterworth filter): signals and confounds are detrended and filtered,
+    confounds are standardized and projected out, result is z-scored.
+    Projection uses batched SVD of confound designs instead of pivoted QR,
+    singular vectors of (near) zero singular values are discarded, so
+    designs can be padded with zero columns to common width.
+    Args:
+        signals (np.array): Shape (n_batch, n_timepoints, n_parcels).
+        confounds (np.array): Shape (n_batch, n_timepoints, n_confounds),
+            n_confounds may be 0.
+        t_r (float): Repetition time shared by all batch items.
+        high_pass (float): High pass cutoff in Hz or None.
+        low_pass (float): Low pass cutoff in Hz or None.
+        temporal_filter (str): 'butterworth' or 'fft' (see
+            batched_butterworth).
+    Returns:
+        np.array: Cleaned signals, shape (n_batch, n_timepoints, n_parcels).
+    """
+    signals = batched_butterworth(batched_detrend(signals), t_r, high_pass, low_pass, temporal_filter)
+    if confounds.shape[2]:
+        confounds = batched_butterworth(batched_detrend(confounds), t_r, high_pass, low_pass, temporal_filter)
+        confounds = batched_zscore(confounds)
+        u, s, _ = np.linalg.svd(confounds, full_matrices=False)
+        tol = s.max(axis=1, keepdims=True) * max(confounds.shape[1:]) * np.finfo(np.float64).eps
+        u = u * (s > tol)[:, np.newaxis, :]
+        signals = signals - np.matmul(u, np.matmul(u.transpose(0, 2, 1), signals))
+    return batched_zscore(signals)
+
+
+def batched_correlation(time_series):
+    """Correlation matrices as nilearn ConnectivityMeasure(kind='correlation')
+    (Ledoit-Wolf covariance of standardized time series).
+    Args:
+        time_series (np.array): Shape (n_batch, n_timepoints, n_parcels).
+    Returns:
+        np.array: Shape (n_batch, n_parcels, n_parcels).
+    """
+    return cov_to_corr(ledoit_wolf(batched_zscore(time_series)))
+
+
+def pad_confounds(confounds, n_timepoints) -> np.array:
+    """Stacks confound designs of different width, missing columns are zeros.
+    Args:
+        confounds (list): np.array of shape (n_timepoints, n_confounds_i)
+            or None (no confounds) for each batch item.
+    Returns:
+        np.array: Shape (n_batch, n_timepoints, max(n_confounds_i)).
+    """
+    widths = [0 if conf is None else conf.shape[1] for conf in confounds]
+    padded = np.zeros((len(confounds), n_timepoints, max(widths, default=0)))
+    for i, (conf, width) in enumerate(zip(confounds, widths)):
+        if width:
+            padded[i, :, :width] = conf
+    return padded
+
+
+def batches(n_items, n_timepoints, n_columns, batch_mb=BATCH_MB):
+    """Splits range(n_items) into slices of at most batch_mb of float64
+    tensor (n_batch, n_timepoints, n_columns)."""
+    size = max(1, int(batch_mb * 2 ** 20 // (n_timepoints * max(n_columns, 1) * 8)))
+    return [slice(start, min(start + size, n_items)) for start in range(0, n_items, size)]
@@ -0,0 +1,251 @@
+import copy
+import json
+import itertools
+from os.path import join, exists
+from RestingfMRI_Denoise.pipelines import get_pipeline_path, get_pipelines_names, load_pipeline_from_json
+from RestingfMRI_Denoise.utils.utils import swap_booleans, is_booleanlike, cast_bool
+from RestingfMRI_Denoise.utils.json_validator import is_valid
+
+# Pipeline extended by grid parameters if grid specification has no base
+DEFAULT_BASE = {'confounds': {'wm': False, 'csf': False, 'gs': False, 'motion': False, 'acompcor': False},
+                'aroma': False,
+                'spikes': False}
+# Key order checked by json_validator
+CONFOUND_KEYS = ('temp_deriv', 'quad_terms')
+SPIKE_KEYS = ('fd_th', 'dvars_th')
+# Stages of (run, pipeline) pair in order of execution, see stage_keys
+STAGES = ('confounds', 'spikes', 'design')
+# Short labels of parameters in generated names
+NAME_LABELS = {'fd_th': 'FD', 'dvars_th': 'DVARS', 'temp_deriv': 'td', 'quad_terms': 'quad'}
+
+
+def format_value(value) -> str:
+    """Label of parameter value used in pipeline names (thresholds follow
+    names of package pipelines, e.g. 0.5 -> '5', 2.5 -> '2p5')."""
+    if value is False:
+        return 'off'
+    if value is True:
+        return 'on'
+    if isinstance(value, dict) and set(value) == set(CONFOUND_KEYS):
+        return '-'.join([NAME_LABELS[key] for key in CONFOUND_KEYS if value[key]] or ['base'])
+    if isinstance(value, dict) and set(value) == set(SPIKE_KEYS):
+        return '-'.join(f"{NAME_LABELS[key]}{format_value(value[key])}" for key in SPIKE_KEYS)
+    if isinstance(value, (int, float)):
+        return f'{value:g}'.replace('0.', '', 1).replace('.', 'p') if 0 < value < 1 \
+            else f'{value:g}'.replace('.', 'p')
+    return str(value)
+
+
+def _name_part(key: str, label: str) -> str:
+    """Part of generated name of grid parameter missing in name template
+    (e.g. 'FD5' for spikes.fd_th or 'gs-td-on' for confounds.gs.temp_deriv)."""
+    section, *parts = key.split('.')
+    if section == 'spikes' and parts:
+        return f"{NAME_LABELS.get(parts[-1], parts[-1])}{label}"
+    parts = [NAME_LABELS.get(part, part) for part in parts] if section == 'confounds' and parts else [section]
+    return '-'.join(parts + [label])
+
+
+def _swap(value):
+    """Booleanlike values of grid parameter (also inside lists) to bool."""
+    if isinstance(value, list):
+        return [_swap(item) for item in value]
+    if isinstance(value, dict):
+        return swap_booleans(value, inplace=True)
+    return cast_bool(value) if is_booleanlike(value) else value
+
+
+def _ordered(value):
+    """Confound and spike settings with key order checked by
+    json_validator."""
+    if isinstance(value, dict):
+        value = {key: _ordered(item) for key, item in value.items()}
+        for keys in (CONFOUND_KEYS, SPIKE_KEYS):
+            if set(value) == set(keys):
+                return {key: value[key] for key in keys}
+    return value
+
+
+def _set(pipeline: dict, key: str, value) -> None:
+    """Sets dotted key (e.g. 'confounds.gs' or 'spikes.fd_th') of pipeline."""
+    *parents, leaf = key.split('.')
+    node = pipeline
+    for parent in parents:
+        if node.get(parent) is False:
+            # Threshold set on pipeline without spike regressors (other threshold disabled) or
+            # derivatives of confound not included in base
+            node[parent] = dict.fromkeys(SPIKE_KEYS, 0) if parent == 'spikes' \
+                else dict.fromkeys(CONFOUND_KEYS, False)
+        if not isinstance(node.get(parent), dict):
+            raise ValueError(f"Grid parameter '{key}' does not address pipeline setting")
+        node = node[parent]
+    node[leaf] = copy.deepcopy(value)
+
+
+def load_base(base) -> dict:
+    """Base pipeline of grid: package pipeline name, path to pipeline json
+    file or (partial) pipeline dictionary completed with DEFAULT_BASE."""
+    if base is None:
+        return copy.deepcopy(DEFAULT_BASE)
+    if isinstance(base, str):
+        path = get_pipeline_path(base) if base in get_pipelines_names() else base
+        if not exists(path):
+            raise ValueError(f"Base pipeline '{base}' is neither package pipeline nor existing file")
+        return load_pipeline_from_json(path)
+    pipeline = copy.deepcopy(DEFAULT_BASE)
+    for key, value in swap_booleans(base, inplace=False).items():
+        if key == 'confounds':
+            pipeline['confounds'].update(copy.deepcopy(value))
+        else:
+            pipeline[key] = copy.deepcopy(value)
+    return pipeline
+
+
+def expand_grid(spec: dict) -> list:
+    """Generates pipelines from grid specification: cartesian product of
+    values of every grid parameter applied to base pipeline.
+    Specification example (thresholds of spike regressors explored on top
+    of package pipeline)::
+
+        {"name": "24HMP_8Phys_spikes-FD{spikes.fd_th}_DVARS{spikes.dvars_th}",
+         "description": "24HMP+8Phys+SpikeReg",
+         "base": "pipeline-24HMP_8Phys",
+         "grid": {"spikes.fd_th": [0.1, 0.2, 0.3, 0.4, 0.5],
+                  "spikes.dvars_th": [0, 1.5, 3]}}
+
+    Grid parameters are dotted pipeline keys ('aroma', 'spikes',
+    'confounds.gs', 'spikes.fd_th', ...) with list of values. Name is
+    template filled with labels of values (see format_value), labels of
+    parameters missing in template are appended to it.
+    Args:
+        spec (dict): Grid specification with name, grid and optional
+            description and base keys (see load_base).
+    Returns:
+        list: Pipeline dictionaries validated by json_validator.is_valid in
+            grid order.
+    Raises:
+        ValueError: If specification is incomplete, generated pipeline is
+            not valid or generated names collide.
+    """
+    if 'name' not in spec or not isinstance(spec.get('grid'), dict):
+        raise ValueError("Pipeline grid specification requires name and grid keys")
+    keys = list(spec['grid'])
+    values = [_swap(value if isinstance(value, list) else [value]) for value in spec['grid'].values()]
+    if any(not value for value in values):
+        raise ValueError("Every grid parameter requires at least one value")
+    base = load_base(spec.get('base'))
+    pipelines, names = [], set()
+    for combination in itertools.product(*values):
+        pipeline = copy.deepcopy(base)
+        labels = {}
+        for key, value in zip(keys, combination):
+            _set(pipeline, key, value)
+            labels[key] = format_value(value)
+        name = spec['name']
+        for key, label in labels.items():
+            placeholder = '{' + key + '}'
+            if placeholder in name:
+                name = name.replace(placeholder, label)
+            elif len(values[keys.index(key)]) > 1:
+                name += f"_{_name_part(key, label)}"
+        if name in names:
+            raise ValueError(f"Pipeline grid generates name '{name}' more than once, "
+                             f"add parameters to name template")
+        names.add(name)
+        pipeline['name'] = name
+        pipeline['description'] = spec.get('description', base.get('description', spec['name']))
+        pipeline = {key: _ordered(pipeline[key]) for key in ('name', 'description', 'confounds', 'aroma', 'spikes')
+                    if key in pipeline}
+        if not is_valid(pipeline):
+            raise ValueError(f"Pipeline grid generates invalid pipeline {name}: {json.dumps(pipeline)}")
+        pipelines.append(pipeline)
+    return pipelines
+
+
+def normalize(pipeline: dict) -> dict:
+    """Canonical settings of pipeline: settings without effect on confounds
+    are dropped (quadratic terms without temporal derivatives, spike
+    regressors with both thresholds disabled), so pipelines which differ
+    only in spelling of the same design compare equal."""
+    confounds = {}
+    for key, value in pipeline['confounds'].items():
+        if isinstance(value, dict):
+            value = {'temp_deriv': bool(value['temp_deriv']),
+                     'quad_terms': bool(value['temp_deriv'] and value['quad_terms'])}
+        confounds[key] = value
+    spikes = pipeline['spikes']
+    if spikes:
+        spikes = {key: float(spikes[key] or 0) for key in SPIKE_KEYS}
+        if not any(spikes.values()):
+            spikes = False
+    return {'confounds': confounds, 'aroma': bool(pipeline['aroma']), 'spikes': spikes}
+
+
+def stage_keys(pipeline: dict) -> dict:
+    """Keys of stages of pipeline, pipelines with equal key compute the
+    same stage output for every run:
+    confounds - nuisance regressors (with derivatives and quadratic terms),
+    spikes - outlier volumes (spike regressors),
+    design - final design matrix and filter and smoothing settings of
+    Denoise (see design_dedup.effective_settings), i.e. denoised image.
+    """
+    settings = normalize(pipeline)
+    confounds = json.dumps({'confounds': settings['confounds'], 'aroma': settings['aroma']}, sort_keys=True)
+    spikes = json.dumps(settings['spikes'], sort_keys=True)
+    return {'confounds': confounds, 'spikes': spikes, 'design': f'{confounds}|{spikes}'}
+
+
+def shared_stages(pipelines: list) -> dict:
+    """Map of stages shared between pipelines used by planner of in-process
+    engines: only pipelines representing distinct designs prepare confounds
+    and are fingerprinted, other pipelines reuse outputs of their
+    representative.
+    Args:
+        pipelines (list): Pipeline dictionaries.
+    Returns:
+        dict: Pipeline name to dictionary with name of representative (first
+            pipeline with equal stage key, see stage_keys) of every stage in
+            STAGES.
+    """
+    first = {stage: {} for stage in STAGES}
+    shared = {}
+    for pipeline in pipelines:
+        keys = stage_keys(pipeline)
+        shared[pipeline['name']] = {stage: first[stage].setdefault(keys[stage], pipeline['name'])
+                                    for stage in STAGES}
+    return shared
+
+
+def summarize_shared(shared: dict) -> dict:
+    """Number of distinct computations of every stage in shared stages
+    map."""
+    return {stage: len({stages[stage] for stages in shared.values()}) for stage in STAGES}
+
+
+def write_grid(pipelines: list, output_dir: str) -> list:
+    """Writes generated pipelines as pipeline json files (accepted by
+    --pipelines) and shared stages map (pipeline_grid_plan.json).
+    Returns:
+        list: Paths to pipeline json files.
+    """
+    names = [pipeline['name'] for pipeline in pipelines]
+    if len(set(names)) < len(names):
+        raise ValueError(f"Pipeline grids generate the same names: "
+                         f"{', '.join(sorted({name for name in names if names.count(name) > 1}))}")
+    paths = []
+    for pipeline in pipelines:
+        path = join(output_dir, f"pipeline-{pipeline['name']}.json")
+        with open(path, 'w') as json_file:
+            json.dump(pipeline, json_file, indent=2)
+        paths.append(path)
+    shared = shared_stages(pipelines)
+    with open(join(output_dir, 'pipeline_grid_plan.json'), 'w') as json_file:
+        json.dump({'distinct': summarize_shared(shared), 'shared': shared}, json_file, indent=2)
+    return paths
+
+
+def load_grid(path: str) -> list:
+    """Loads grid specification json file and expands it (see
+    expand_grid)."""
+    with open(path, 'r') as json_file:
+        return expand_grid(json.load(json_file))
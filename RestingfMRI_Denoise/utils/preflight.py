@@ -0,0 +1,249 @@
+import json
+import logging
+import itertools
+from os.path import exists, basename
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import nibabel as nb
+from nibabel.affines import apply_affine
+from RestingfMRI_Denoise.utils.confound_prep import get_a_comp_cor, get_aroma_files
+from RestingfMRI_Denoise.utils.cost_estimate import run_label
+from RestingfMRI_Denoise.utils.compcor import find_segmentation
+
+MOTION_COLUMNS = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+TISSUE_COLUMNS = {'wm': 'white_matter', 'csf': 'csf', 'gs': 'global_signal'}
+# Allowed difference (seconds) between TR of sidecar or NIfTI header and TR used for filtering
+TR_TOLERANCE = 1e-3
+# Number of runs checked concurrently (checks read headers only, so they are I/O bound)
+PREFLIGHT_THREADS = 16
+
+
+class PreflightError(ValueError):
+    """Raised with consolidated report of all runs failing preflight."""
+
+    def __init__(self, message: str, report: pd.DataFrame = None):
+        super().__init__(message)
+        self.report = report
+
+
+def required_columns(pipeline: dict) -> list:
+    """Columns of fMRIPrep confounds table read by pipeline.
+    Args:
+        pipeline (dict): Denoising pipeline specification.
+    Returns:
+        list: Column names (aCompCor components are listed in confounds json).
+    """
+    columns = ['framewise_displacement']  # mean FD of ConfInvariants and QC measures
+    confounds = pipeline['confounds']
+    if confounds['motion']:
+        columns += MOTION_COLUMNS
+    # Tissue signals of AROMA pipelines are extracted from ICA-AROMA denoised data
+    if not pipeline['aroma']:
+        columns += [column for key, column in TISSUE_COLUMNS.items() if confounds[key]]
+    if pipeline['spikes'] and pipeline['spikes']['dvars_th']:
+        columns.append('std_dvars')
+    return columns
+
+
+def atlas_extent(parcellation_path: str) -> tuple:
+    """World coordinates (mm) of bounding box of labelled voxels of atlas.
+    Returns:
+        tuple: Minimal and maximal corner.
+    """
+    img = nb.load(parcellation_path)
+    ijk = np.argwhere(np.asanyarray(img.dataobj) > 0)
+    corners = np.array(list(itertools.product(*zip(ijk.min(axis=0), ijk.max(axis=0)))))
+    xyz = apply_affine(img.affine, corners)
+    return xyz.min(axis=0), xyz.max(axis=0)
+
+
+def grid_extent(header) -> tuple:
+    """World coordinates (mm) of field of view of image grid (voxel edges
+    included)."""
+    shape = np.array(header.get_data_shape()[:3])
+    corners = np.array(list(itertools.product(*zip([-.5] * 3, shape - .5))))
+    xyz = apply_affine(header.get_best_affine(), corners)
+    return xyz.min(axis=0), xyz.max(axis=0)
+
+
+def header_tr(header):
+    """TR stored in NIfTI header in seconds, None if not set."""
+    zooms = header.get_zooms()
+    if len(zooms) < 4 or not zooms[3]:
+        return None
+    units = header.get_xyzt_units()[1]
+    return float(zooms[3]) / (1000 if units == 'msec' else 1)
+
+
+def check_run(run: dict, pipelines: list, atlases: dict, compcor: str = 'fmriprep') -> list:
+    """Checks one run using only image headers, sidecar metadata and
+    confounds table header and row count.
+    Args:
+        run (dict): Run grabbed from BIDS dataset (see executor.grab_runs).
+        pipelines (list): Selected denoising pipelines.
+        atlases (dict): Atlas file name to bounding box of labelled voxels (see
+            atlas_extent).
+        compcor (str): Source of aCompCor components, tissue segmentation is
+            required instead of fMRIPrep columns if they are computed from
+            BOLD (see utils.compcor).
+    Returns:
+        list: Problems found as dictionaries with run, severity ('error' or
+            'warning'), check and message keys.
+    """
+    problems = []
+
+    def problem(check, message, severity='error'):
+        problems.append({'run': run_label(run['entities']), 'severity': severity,
+                         'check': check, 'message': message})
+
+    try:
+        bold = nb.load(run['fmri_prep']).header
+    except Exception as err:
+        problem('image', f"Cannot read {run['fmri_prep']}: {err}")
+        return problems
+    shape = bold.get_data_shape()
+    n_volumes = shape[3] if len(shape) > 3 else None
+    if n_volumes is None:
+        problem('image', f"{run['fmri_prep']} is not 4D (shape {shape})")
+    fov = grid_extent(bold)
+    tolerance = max(bold.get_zooms()[:3])
+    for name, (low, high) in atlases.items():
+        if np.any(low < fov[0] - tolerance) or np.any(high > fov[1] + tolerance):
+            problem('grid', f"Field of view of {run['fmri_prep']} does not cover atlas {name} "
+                            f"(is image in MNI space?)")
+    if run.get('brain_mask'):
+        try:
+            mask = nb.load(run['brain_mask']).header
+        except Exception as err:
+            problem('image', f"Cannot read {run['brain_mask']}: {err}")
+        else:
+            if mask.get_data_shape()[:3] != shape[:3] or not np.allclose(mask.get_best_affine(),
+                                                                         bold.get_best_affine()):
+                problem('grid', f"Grid of {run['brain_mask']} differs from functional image, "
+                                f"mask will be resampled", severity='warning')
+
+    # Repetition time
+    task = run['entities'].get('task')
+    tr = run['tr_dict'].get(task)
+    if not isinstance(tr, (int, float)) or isinstance(tr, bool) or tr <= 0:
+        problem('tr', f"RepetitionTime of task {task} not found in sidecar metadata")
+        tr = None
+    sidecar = run['fmri_prep'].split('.nii')[0] + '.json'
+    if tr is not None and exists(sidecar):
+        try:
+            with open(sidecar, 'r') as json_file:
+                sidecar_tr = json.load(json_file).get('RepetitionTime')
+        except ValueError as err:
+            problem('tr', f"Cannot read {sidecar}: {err}")
+        else:
+            if sidecar_tr is None:
+                problem('tr', f"RepetitionTime missing in {sidecar}")
+            elif abs(sidecar_tr - tr) > TR_TOLERANCE:
+                problem('tr', f"RepetitionTime {sidecar_tr} of {sidecar} differs from {tr} used for task {task} "
+                              f"(runs of one task must share TR)")
+    if tr is not None and header_tr(bold) is not None and abs(header_tr(bold) - tr) > TR_TOLERANCE:
+        problem('tr', f"TR {header_tr(bold)} in header of {run['fmri_prep']} differs from "
+                      f"RepetitionTime {tr}", severity='warning')
+
+    # Confounds table (header and number of rows)
+    try:
+        with open(run['conf_raw'], 'r') as conf_file:
+            columns = set(conf_file.readline().rstrip('\n').split('\t'))
+            n_rows = sum(1 for line in conf_file if line.strip())
+    except OSError as err:
+        problem('confounds', f"Cannot read {run['conf_raw']}: {err}")
+        return problems
+    if n_volumes is not None and n_rows != n_volumes:
+        problem('timepoints', f"{run['conf_raw']} has {n_rows} rows, functional image has {n_volumes} volumes")
+    missing = {}
+    for pipeline in pipelines:
+        for column in required_columns(pipeline):
+            if column not in columns:
+                missing.setdefault(column, []).append(pipeline['name'])
+    if any(pipeline['confounds']['acompcor'] for pipeline in pipelines) and compcor != 'fmriprep':
+        try:
+            find_segmentation(run['fmri_prep'])
+        except FileNotFoundError as err:
+            problem('confounds', f"{err} (needed to compute CompCor components)")
+    elif any(pipeline['confounds']['acompcor'] for pipeline in pipelines):
+        try:
+            a_comp_cor = get_a_comp_cor(run['conf_json'])
+        except (OSError, ValueError, KeyError) as err:
+            problem('confounds', f"Cannot read aCompCor components from {run['conf_json']}: {err!r}")
+            a_comp_cor = None
+        if a_comp_cor is not None:
+            acompcor_pipelines = [pipeline['name'] for pipeline in pipelines if pipeline['confounds']['acompcor']]
+            if not a_comp_cor:
+                problem('confounds', f"No retained aCompCor components in {run['conf_json']} "
+                                     f"(pipelines {', '.join(acompcor_pipelines)})")
+            for column in a_comp_cor:
+                if column not in columns:
+                    missing.setdefault(column, []).extend(acompcor_pipelines)
+    for column, names in missing.items():
+        problem('confounds', f"Column {column} missing in {run['conf_raw']} "
+                             f"(pipelines {', '.join(sorted(set(names)))})")
+
+    # ICA-AROMA inputs
+    if any(pipeline['aroma'] for pipeline in pipelines):
+        try:
+            get_aroma_files(run['conf_raw'], task)
+        except IndexError:
+            problem('aroma', f"Brain mask or MNI152NLin2009cAsym_res-2 segmentation used for AROMA "
+                             f"signals not found for {run['conf_raw']}")
+        try:
+            aroma = nb.load(run['fmri_prep_aroma']).header
+        except Exception as err:
+            problem('aroma', f"Cannot read {run['fmri_prep_aroma']}: {err}")
+        else:
+            aroma_shape = aroma.get_data_shape()
+            if len(aroma_shape) < 4 or aroma_shape[3] != n_rows:
+                problem('timepoints', f"{run['fmri_prep_aroma']} has "
+                                      f"{aroma_shape[3] if len(aroma_shape) > 3 else 1} volumes, "
+                                      f"{run['conf_raw']} has {n_rows} rows")
+    return problems
+
+
+def format_report(report: pd.DataFrame) -> str:
+    lines = []
+    for run, problems in report.groupby('run', sort=False):
+        lines.append(f"{run}:")
+        lines += [f"  [{problem.severity}] {problem.message}" for problem in problems.itertuples()]
+    return "\n".join(lines)
+
+
+def preflight(runs: list, pipelines: list, parcellation_paths: list, n_threads: int = PREFLIGHT_THREADS,
+              compcor: str = 'fmriprep') -> pd.DataFrame:
+    """Validates all runs before any job is scheduled. Runs are checked
+    concurrently and problems of all runs are collected, so one failing
+    preflight lists everything to fix.
+    Args:
+        runs (list): Runs grabbed from BIDS dataset (see executor.grab_runs).
+        pipelines (list): Selected denoising pipelines.
+        parcellation_paths (list): Paths to parcellations.
+        n_threads (int): Number of runs checked concurrently.
+        compcor (str): Source of aCompCor components (see check_run).
+    Returns:
+        pd.DataFrame: Warnings, one row per problem.
+    Raises:
+        PreflightError: If any run has error, message lists problems of all
+            runs and report attribute holds them.
+    """
+    report = pd.DataFrame(columns=['run', 'severity', 'check', 'message'])
+    if not runs:
+        return report
+    if isinstance(parcellation_paths, str):
+        parcellation_paths = [parcellation_paths]
+    atlases = {basename(path): atlas_extent(path) for path in parcellation_paths}
+    with ThreadPoolExecutor(max_workers=min(n_threads, len(runs))) as executor:
+        problems = list(itertools.chain.from_iterable(
+            executor.map(lambda run: check_run(run, pipelines, atlases, compcor), runs)))
+    if problems:
+        report = pd.DataFrame(problems, columns=report.columns)
+    errors = report[report.severity == 'error']
+    if len(errors):
+        raise PreflightError(f"Preflight failed for {errors.run.nunique()} of {len(runs)} runs:\n"
+                             + format_report(report), report)
+    if len(report):
+        logging.getLogger('nipype.workflow').warning("Preflight warnings:\n" + format_report(report))
+    return report
@@ -0,0 +1,269 @@
+import argparse
+import json
+from os.path import join, dirname, exists, abspath
+import numpy as np
+import pandas as pd
+import jinja2
+from RestingfMRI_Denoise.utils.instrumentation import stage_log_path
+
+
+def read_json_lines(path: str) -> pd.DataFrame:
+    """Reads file with one json dictionary per line, skipping lines that are
+    not valid json (e.g. messages logged by nipype to the same file).
+    Args:
+        path: path to log file.
+    Returns:
+        pd.DataFrame: one row per record.
+    """
+    records = []
+    with open(path, 'r') as log_file:
+        for line in log_file:
+            line = line.strip()
+            if not line.startswith('{'):
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return pd.DataFrame(records)
+
+
+def read_callback_log(path: str) -> pd.DataFrame:
+    """Reads nipype callback log written with profiler_callback.
+    Args:
+        path: path to profiler log (--profiler option).
+    Returns:
+        pd.DataFrame: finished nodes with start/finish as datetimes, duration
+            in seconds, memory in GB and number of used cores.
+    """
+    nodes = read_json_lines(path)
+    if nodes.empty:
+        return nodes
+    if 'error' in nodes:
+        nodes = nodes[nodes['error'] != True]
+    nodes = nodes.copy()
+    nodes['start'] = pd.to_datetime(nodes['start'])
+    nodes['finish'] = pd.to_datetime(nodes['finish'])
+    nodes['duration'] = (nodes['finish'] - nodes['start']).dt.total_seconds()
+    if 'node_type' not in nodes:  # logs written with nipype log_nodes_cb
+        nodes['node_type'] = nodes['name'].str.replace(r'^_|\d+$', '', regex=True)
+    if 'pipeline' not in nodes:
+        nodes['pipeline'] = ""
+    nodes['pipeline'] = nodes['pipeline'].fillna("")
+    if 'blas_threads' not in nodes:  # logs written before thread governance
+        nodes['blas_threads'] = np.nan
+    for column in ('runtime_threads', 'runtime_memory_gb', 'estimated_memory_gb', 'num_threads', 'blas_threads'):
+        nodes[column] = pd.to_numeric(nodes[column], errors='coerce')
+    # cpu_percent reported by nipype is percent of single core
+    nodes['cores_used'] = nodes['runtime_threads'] / 100
+    nodes['cpu_utilisation'] = nodes['cores_used'] / nodes['num_threads'].fillna(1).clip(lower=1)
+    return nodes.reset_index(drop=True)
+
+
+def _p95(values):
+    return np.percentile(values, 95) if len(values) else np.nan
+
+
+def aggregate_nodes(nodes: pd.DataFrame, by: str) -> pd.DataFrame:
+    """Aggregates node records.
+    Args:
+        nodes: output of read_callback_log.
+        by: column used for grouping ('node_type' or 'pipeline').
+    Returns:
+        pd.DataFrame: count, total/mean/p95 runtime, peak memory, mean
+            cpu utilisation and maximal BLAS threads for each group.
+    """
+    summary = nodes.groupby(by).agg(
+        n_nodes=('duration', 'size'),
+        total_runtime_s=('duration', 'sum'),
+        mean_runtime_s=('duration', 'mean'),
+        p95_runtime_s=('duration', _p95),
+        peak_memory_gb=('runtime_memory_gb', 'max'),
+        estimated_memory_gb=('estimated_memory_gb', 'max'),
+        mean_cores_used=('cores_used', 'mean'),
+        mean_cpu_utilisation=('cpu_utilisation', 'mean'),
+        max_blas_threads=('blas_threads', 'max'))
+    return summary.sort_values('total_runtime_s', ascending=False).reset_index()
+
+
+def aggregate_stages(stages: pd.DataFrame, by: list) -> pd.DataFrame:
+    """Aggregates stage-level records written by StageRecorder.
+    Args:
+        stages: records read with read_json_lines.
+        by: columns used for grouping (e.g. ['interface', 'stage']).
+    Returns:
+        pd.DataFrame: count, total/mean/p95 wall time, cpu time and peak
+            resident memory for each group.
+    """
+    stages = stages.copy()
+    for column in by:
+        if column not in stages:
+            stages[column] = ""
+        stages[column] = stages[column].fillna("")
+    summary = stages.groupby(by).agg(
+        n_records=('duration', 'size'),
+        total_runtime_s=('duration', 'sum'),
+        mean_runtime_s=('duration', 'mean'),
+        p95_runtime_s=('duration', _p95),
+        total_cpu_time_s=('cpu_time', 'sum'),
+        peak_rss_mb=('peak_rss_mb', 'max'))
+    return summary.sort_values('total_runtime_s', ascending=False).reset_index()
+
+
+def parallelism_timeline(nodes: pd.DataFrame) -> pd.DataFrame:
+    """Computes number of running nodes and busy cores over time.
+    Args:
+        nodes: output of read_callback_log.
+    Returns:
+        pd.DataFrame: one row per change point with time (seconds from start
+            of the first node), number of running nodes, reserved threads
+            and cores actually used.
+    """
+    origin = nodes['start'].min()
+    start = (nodes['start'] - origin).dt.total_seconds().values
+    finish = (nodes['finish'] - origin).dt.total_seconds().values
+    threads = nodes['num_threads'].fillna(1).values
+    cores = nodes['cores_used'].fillna(0).values
+    events = pd.DataFrame({
+        'time': np.concatenate([start, finish]),
+        'running_nodes': np.concatenate([np.ones(len(start)), -np.ones(len(finish))]),
+        'reserved_threads': np.concatenate([threads, -threads]),
+        'cores_used': np.concatenate([cores, -cores])})
+    timeline = events.groupby('time').sum().sort_index().cumsum().reset_index()
+    return timeline
+
+
+def critical_path(nodes: pd.DataFrame, tolerance: float = 1.0) -> pd.DataFrame:
+    """Reconstructs chain of nodes that determined total execution time.
+    Starting from the node that finished last, the blocking predecessor is
+    the node that finished latest before (within tolerance) the current
+    node started.
+    Args:
+        nodes: output of read_callback_log.
+        tolerance: allowed scheduling delay in seconds.
+    Returns:
+        pd.DataFrame: nodes on the critical path in execution order with
+            waiting time before each node.
+    """
+    if nodes.empty:
+        return nodes
+    tolerance = pd.Timedelta(seconds=tolerance)
+    current = nodes['finish'].idxmax()
+    path = [current]
+    while True:
+        start = nodes.at[current, 'start']
+        candidates = nodes[(nodes['finish'] <= start + tolerance) & (nodes.index != current)
+                           & (nodes['start'] < start)]
+        if candidates.empty:
+            break
+        current = candidates['finish'].idxmax()
+        path.append(current)
+    path = nodes.loc[path[::-1], ['name', 'node_type', 'pipeline', 'start', 'finish', 'duration']].copy()
+    path['wait_s'] = (path['start'] - path['finish'].shift()).dt.total_seconds().clip(lower=0).fillna(0)
+    return path.reset_index(drop=True)
+
+
+def memory_overruns(nodes: pd.DataFrame) -> pd.DataFrame:
+    """Returns nodes whose measured peak memory exceeded declared mem_gb."""
+    exceeded = nodes['runtime_memory_gb'] > nodes['estimated_memory_gb']
+    overruns = nodes.loc[exceeded, ['name', 'node_type', 'pipeline', 'runtime_memory_gb',
+                                    'estimated_memory_gb', 'duration']].copy()
+    overruns['ratio'] = overruns['runtime_memory_gb'] / overruns['estimated_memory_gb']
+    return overruns.sort_values('ratio', ascending=False).reset_index(drop=True)
+
+
+def plot_timeline(timeline: pd.DataFrame, out_fname: str) -> None:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(1, 1, figsize=(12, 4))
+    ax.step(timeline['time'], timeline['reserved_threads'], where='post', label='Reserved threads')
+    ax.step(timeline['time'], timeline['cores_used'], where='post', label='Cores used')
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Cores')
+    ax.set_title('Achieved parallelism')
+    ax.legend()
+    fig.savefig(out_fname, bbox_inches='tight')
+    plt.close(fig)
+
+
+def create_profile_summary(callback_log: str, output_dir: str, stage_log: str = None) -> str:
+    """Creates TSV tables and html summary from profiler logs.
+    Args:
+        callback_log: path to log written by --profiler option.
+        output_dir: directory where summary is saved (usually directory with
+            report.html).
+        stage_log: path to stage-level records, by default looked up next to
+            callback_log.
+    Returns:
+        str: path to html summary.
+    """
+    if stage_log is None:
+        stage_log = stage_log_path(callback_log)
+    nodes = read_callback_log(callback_log)
+    if nodes.empty:
+        raise ValueError(f"No finished nodes found in {callback_log}")
+    tables = {
+        'node_types': aggregate_nodes(nodes, 'node_type'),
+        'pipelines': aggregate_nodes(nodes[nodes['pipeline'] != ""], 'pipeline'),
+        'critical_path': critical_path(nodes),
+        'memory_overruns': memory_overruns(nodes)}
+    if exists(stage_log):
+        stages = read_json_lines(stage_log)
+        if not stages.empty:
+            tables['stages'] = aggregate_stages(stages, ['interface', 'stage'])
+            tables['stages_pipelines'] = aggregate_stages(stages, ['pipeline', 'interface'])
+    timeline = parallelism_timeline(nodes)
+    for name, table in tables.items():
+        table.to_csv(join(output_dir, f"profile_{name}.tsv"), sep='\t', index=False)
+    timeline.to_csv(join(output_dir, "profile_parallelism.tsv"), sep='\t', index=False)
+    plot_timeline(timeline, join(output_dir, "profile_parallelism.svg"))
+    makespan = (nodes['finish'].max() - nodes['start'].min()).total_seconds()
+    overview = {'Finished nodes': len(nodes),
+                'Wall time (s)': round(makespan, 1),
+                'Total node time (s)': round(nodes['duration'].sum(), 1),
+                'Mean parallelism': round(nodes['duration'].sum() / makespan, 2) if makespan > 0 else np.nan,
+                'Critical path time (s)': round(tables['critical_path']['duration'].sum(), 1),
+                'Nodes exceeding mem_gb': len(tables['memory_overruns'])}
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(
+            searchpath=join(dirname(__file__), 'report_templates')))
+    tpl = env.get_template('profile_template.html')
+    html = tpl.render(overview=overview,
+                      tables={name: table.to_html(index=False, float_format='%.3f', na_rep='')
+                              for name, table in tables.items()},
+                      css=env.get_template('report.css').render(),
+                      parallelism_plot='profile_parallelism.svg')
+    html_fname = join(output_dir, 'profile_summary.html')
+    with open(html_fname, 'w') as html_file:
+        html_file.write(html)
+    return html_fname
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """
+    Creates parser for profile summary script.
+    :return: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description="Summarise RestingfMRI_Denoise profiler logs.")
+    parser.add_argument("profiler_log",
+                        help="Path to log file created with --profiler option.")
+    parser.add_argument("--stage-log",
+                        type=str,
+                        help="Path to stage-level records, default PROFILER_stages.jsonl next to profiler_log.")
+    parser.add_argument("-o", "--output_dir",
+                        type=str,
+                        help="Directory where summary is saved, e.g. <bids_dir>/derivatives/denoise. \
+                        Default is directory of profiler_log.")
+    return parser
+
+
+def main() -> None:
+    args = get_parser().parse_args()
+    profiler_log = abspath(args.profiler_log)
+    output_dir = args.output_dir if args.output_dir is not None else dirname(profiler_log)
+    print(create_profile_summary(profiler_log, output_dir, args.stage_log))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 import jinja2
 from os.path import join, dirname, exists, basename
 import glob
+from RestingfMRI_Denoise.parcellation import atlas_suffix
+from RestingfMRI_Denoise.utils.screening import QC_LOSSES
+from RestingfMRI_Denoise.utils.tables import read_table
 
 YES = '\u2713'
 NO = '\u2717'
@@ -65,20 +68,49 @@ def get_pipeline_summary(pipeline):
     return(pipeline_list)
 
 
-def create_pipelines_data_dict(data_path: str, pipelines_list: list) -> dict:
+def get_screening_summary(screening_trace: str) -> dict:
+    """Generates rows of pilot screening table (QC losses with confidence
+    intervals and decision) from pipelines_screening.npz.
+
+    Args:
+        screening_trace: Path to decision trace of screen_pipelines.
+
+    Returns:
+        screening: dictionary with number of pilot runs and list of rows.
+    """
+    trace = read_table(screening_trace)
+    rows = []
+    for _, row in trace.iterrows():
+        rows.append({'pipeline': row['pipeline'],
+                     'atlas': row['atlas'],
+                     'losses': [f"{row[loss]:.3f} [{row[f'{loss}_ci_low']:.3f}, {row[f'{loss}_ci_high']:.3f}]"
+                                for loss in QC_LOSSES],
+                     'decision': row['decision'],
+                     'dominated_by': row['dominated_by']})
+    return {'n_pilot': int(trace['n_pilot'].iloc[0]) if len(trace) else 0,
+            'losses': list(QC_LOSSES),
+            'rows': rows}
+
+
+def create_pipelines_data_dict(data_path: str, pipelines_list: list, atlas_names: list = ("",)) -> dict:
     output = {}
     output['pipelines'] = []
     for pipeline in pipelines_list:
-        no_high_motion = "FC_FD_corr_mat_" + pipeline['name'] + '_no_high_motion.png'
-        all = "FC_FD_corr_mat_" + pipeline['name'] + '_all.png'
-        if not exists(join(data_path, no_high_motion)) \
-            and not exists(join(data_path, all)):
-            raise FileNotFoundError(f"Corelation matrix for {pipeline} is missing!")
-        
+        matrices = []
+        for atlas_name in atlas_names:
+            suffix = atlas_suffix(atlas_name)
+            no_high_motion = "FC_FD_corr_mat_" + pipeline['name'] + suffix + '_no_high_motion.png'
+            all = "FC_FD_corr_mat_" + pipeline['name'] + suffix + '_all.png'
+            if not exists(join(data_path, no_high_motion)) \
+                and not exists(join(data_path, all)):
+                raise FileNotFoundError(f"Corelation matrix for {pipeline} is missing!")
+            matrices.append({'atlas': atlas_name,
+                             'corelation_matrix_all': all,
+                             'corelation_matrix_no_high_motion': no_high_motion})
+
         pipeline_dict = {'name': pipeline['name'],
                          'description': pipeline['description'],
-                         'corelation_matrix_all': all,
-                         'corelation_matrix_no_high_motion': no_high_motion,
+                         'matrices': matrices,
                          'summary': get_pipeline_summary(pipeline)}
         output['pipelines'].append(pipeline_dict)
     return output
@@ -86,7 +118,10 @@ def create_pipelines_data_dict(data_path: str, pipelines_list: list) -> dict:
 
 def create_report(data_path: str, 
                   pipelines_list: list,
-                  excluded_subjects: list = ()) -> None:
+                  excluded_subjects: list = (),
+                  motion_gated_runs: list = (),
+                  atlas_names: list = ("",),
+                  screening_trace: str = None) -> None:
     #import os
     #dirname = os.path.dirname(__file__)
     #path = os.path.join(dirname, 'templates')
@@ -99,15 +134,23 @@ def create_report(data_path: str,
     script_template = env.get_template('script.js')
     script = script_template.render()
     tpl = env.get_template('report_template.html')
-    data_dict = create_pipelines_data_dict(data_path, pipelines_list)
+    data_dict = create_pipelines_data_dict(data_path, pipelines_list, atlas_names)
     data_dict['group'] = {}
-    data_dict['group']['img'] = {'Edges_Density': 'pipelines_edges_density.svg',
-                                 'Edges_Density_No_High_Motion': 'pipelines_edges_density_no_high_motion.svg',
-                                 'Pipelines_Distance_Dependency': 'pipelines_distance_dependence.svg',
-                                 'Pipelines_FC_FC_Pearson': 'pipelines_fc_fd_pearson.svg',
-                                 'Motion_Out': basename(glob.glob(join(data_path, 'motion_criterion*'))[0]),
-                                 'Tdof_Loss': 'pipelines_tdof_loss.svg'}
+    data_dict['group']['img'] = {'Motion_Out': basename(glob.glob(join(data_path, 'motion_criterion*'))[0])}
+    data_dict['group']['atlases'] = []
+    for atlas_name in atlas_names:
+        suffix = atlas_suffix(atlas_name)
+        data_dict['group']['atlases'].append({
+            'name': atlas_name,
+            'img': {'Edges_Density': f'pipelines_edges_density{suffix}.svg',
+                    'Edges_Density_No_High_Motion': f'pipelines_edges_density_no_high_motion{suffix}.svg',
+                    'Pipelines_Distance_Dependency': f'pipelines_distance_dependence{suffix}.svg',
+                    'Pipelines_FC_FC_Pearson': f'pipelines_fc_fd_pearson{suffix}.svg',
+                    'Tdof_Loss': f'pipelines_tdof_loss{suffix}.svg'}})
+    if screening_trace is not None:
+        data_dict['group']['screening'] = get_screening_summary(screening_trace)
     html = tpl.render(data_dict,                                            excluded_subjects=excluded_subjects,
+                      motion_gated_runs=motion_gated_runs,
                       css=css, 
                       script=script)
     with open(join(data_path, 'report.html'), 'w') as report_file:
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import t as t_dist
+
+N_BOOTSTRAP = 1000
+CI_LEVEL = 0.95
+# QC measures of QualityMeasures, all expressed as losses (lower is better)
+QC_LOSSES = ('perc_fc_fd_uncorr', 'pearson_fc_fd', 'distance_dependence', 'tdof_loss')
+
+
+def pilot_sample(mean_fd, size, strategy='stratified', seed=0) -> list:
+    """Selects pilot runs for pipeline screening.
+    Args:
+        mean_fd (list): Mean framewise displacement of every run.
+        size (int): Number of pilot runs.
+        strategy (str): 'random' (uniform sample) or 'stratified' (runs
+            sorted by mean FD are split into size strata of equal count,
+            one run is drawn from each, so pilot covers whole motion range).
+        seed (int): Seed of random generator.
+    Returns:
+        list: Sorted indices of pilot runs.
+    """
+    rng = np.random.default_rng(seed)
+    n_runs = len(mean_fd)
+    if size >= n_runs:
+        return list(range(n_runs))
+    if strategy == 'random':
+        return sorted(rng.choice(n_runs, size, replace=False).tolist())
+    if strategy == 'stratified':
+        strata = np.array_split(np.argsort(mean_fd, kind='stable'), size)
+        return sorted(int(rng.choice(stratum)) for stratum in strata)
+    raise ValueError(f"Unknown pilot strategy '{strategy}', use 'random' or 'stratified'")
+
+
+def _qc_losses(corr_vec, mean_fd, n_conf, distance_vector) -> np.array:
+    """QC measures of QualityMeasures for (resampled) runs as losses:
+    % of edges correlated with FD, |median QC-FC|, |distance dependence|
+    and mean number of confounds."""
+    n_runs = len(mean_fd)
+    fd = mean_fd - mean_fd.mean()
+    fd_norm = np.linalg.norm(fd)
+    if n_runs < 3 or fd_norm == 0:
+        # QC-FC is undefined for resample with constant FD
+        return np.full(len(QC_LOSSES), np.nan)
+    fc = corr_vec - corr_vec.mean(axis=0)
+    fc_norm = np.linalg.norm(fc, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fc_fd_corr = np.nan_to_num(fd @ fc / (fd_norm * fc_norm))
+        t = fc_fd_corr * np.sqrt((n_runs - 2) / (1 - np.minimum(fc_fd_corr ** 2, 1 - 1e-12)))
+    fc_fd_pval = 2 * t_dist.sf(np.abs(t), n_runs - 2)
+    distance_dependence = np.nan_to_num(np.corrcoef(fc_fd_corr, distance_vector)[0, 1])
+    return np.array([np.sum(fc_fd_pval < 0.05) / len(fc_fd_pval) * 100,
+                     abs(np.median(fc_fd_corr)),
+                     abs(distance_dependence),
+                     n_conf.mean()])
+
+
+def bootstrap_qc(corr_vec, mean_fd, n_conf, distance_vector, n_bootstrap=N_BOOTSTRAP, seed=0) -> dict:
+    """Point estimates and percentile bootstrap confidence intervals of QC
+    losses (see QC_LOSSES) of one pipeline on pilot runs. Runs are
+    resampled with the same seed for every pipeline, so resamples are
+    paired across pipelines; resamples with constant FD are ignored.
+    Args:
+        corr_vec (np.array): Vectorized connectivity matrices of pilot runs,
+            shape (n_runs, n_edges).
+        mean_fd (np.array): Mean FD of pilot runs.
+        n_conf (np.array): Number of confounds of pilot runs.
+        distance_vector (np.array): Vectorized distance matrix.
+        n_bootstrap (int): Number of bootstrap resamples.
+        seed (int): Seed of random generator.
+    Returns:
+        dict: Loss name to tuple (estimate, ci_low, ci_high).
+    """
+    mean_fd, n_conf = np.asarray(mean_fd, dtype=np.float64), np.asarray(n_conf, dtype=np.float64)
+    estimate = _qc_losses(corr_vec, mean_fd, n_conf, distance_vector)
+    rng = np.random.default_rng(seed)
+    n_runs = len(mean_fd)
+    resampled = np.empty((n_bootstrap, len(QC_LOSSES)))
+    for b in range(n_bootstrap):
+        idx = rng.integers(n_runs, size=n_runs)
+        resampled[b] = _qc_losses(corr_vec[idx], mean_fd[idx], n_conf[idx], distance_vector)
+    alpha = (1 - CI_LEVEL) / 2
+    low, high = np.nanquantile(resampled, [alpha, 1 - alpha], axis=0)
+    return {loss: (estimate[i], low[i], high[i]) for i, loss in enumerate(QC_LOSSES)}
+
+
+def prune_dominated(qc: dict) -> dict:
+    """Finds pipelines clearly dominated by other pipeline: the other
+    pipeline is not worse in any QC loss (point estimates, all
+    parcellations) and better with non-overlapping confidence intervals in
+    at least one. Domination is a strict partial order, so at least one
+    pipeline is always kept.
+    Args:
+        qc (dict): Pipeline name to list of bootstrap_qc outputs (one per
+            parcellation).
+    Returns:
+        dict: Name of every pruned pipeline to name of pipeline dominating it.
+    """
+    def flat(name):
+        return np.array([value for atlas_qc in qc[name] for value in atlas_qc.values()])
+    pruned = {}
+    for name in qc:
+        for other in qc:
+            if other == name:
+                continue
+            mine, theirs = flat(name), flat(other)
+            if np.all(theirs[:, 0] <= mine[:, 0]) and np.any(theirs[:, 2] < mine[:, 1]):
+                pruned[name] = other
+                break
+    return pruned
+
+
+def screening_trace(qc: dict, pruned: dict, atlas_names: list, n_pilot: int) -> pd.DataFrame:
+    """Decision trace of screening, one row per pipeline and parcellation."""
+    rows = []
+    for name, atlases_qc in qc.items():
+        for atlas_name, atlas_qc in zip(atlas_names, atlases_qc):
+            row = {'pipeline': name, 'atlas': atlas_name, 'n_pilot': n_pilot}
+            for loss, (estimate, low, high) in atlas_qc.items():
+                row[loss] = estimate
+                row[f'{loss}_ci_low'] = low
+                row[f'{loss}_ci_high'] = high
+            row['decision'] = 'pruned' if name in pruned else 'kept'
+            row['dominated_by'] = pruned.get(name, '')
+            rows.append(row)
+    return pd.DataFrame(rows)
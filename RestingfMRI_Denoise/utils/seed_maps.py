@@ -0,0 +1,141 @@
+import os
+import re
+import gzip
+import shutil
+import tempfile
+from os.path import isfile
+from contextlib import contextmanager
+import numpy as np
+import nibabel as nb
+from nipype.utils.filemanip import split_filename
+from nilearn.image import resample_to_img
+
+SEED_RADIUS = 6.
+CHUNK_MB = 256
+# Buffer of decompression of gzipped image
+COPY_BUFFER = 16 * 2 ** 20
+
+
+def parse_seed(seed: str) -> tuple:
+    """Parses seed definition.
+    Args:
+        seed (str): Path to seed mask image (non-zero voxels belong to seed)
+            or MNI coordinates in mm as 'NAME:x,y,z'.
+    Returns:
+        tuple: Seed name and path to mask or tuple of coordinates.
+    """
+    if isfile(seed):
+        _, base, _ = split_filename(seed)
+        return re.sub('[^a-zA-Z0-9]', '', base), seed
+    match = re.fullmatch(r'([a-zA-Z0-9]+):(-?[\d.]+),(-?[\d.]+),(-?[\d.]+)', seed)
+    if match is None:
+        raise ValueError(f"Seed '{seed}' is neither existing mask file nor coordinates NAME:x,y,z")
+    return match.group(1), tuple(float(coordinate) for coordinate in match.group(2, 3, 4))
+
+
+def get_seed_masks(seeds, img, radius=SEED_RADIUS) -> dict:
+    """Boolean masks of seeds on voxel grid of img.
+    Masks are resampled with nearest neighbour interpolation, coordinates
+    are replaced by spheres of given radius (in mm).
+    Args:
+        seeds (list): Seed definitions (see parse_seed).
+        img (nb.Nifti1Image): Image defining voxel grid.
+        radius (float): Radius of spherical seeds in mm.
+    Returns:
+        dict: Seed name to boolean array of shape img.shape[:3].
+    """
+    shape = img.shape[:3]
+    target = nb.Nifti1Image(np.zeros(shape, dtype=np.int8), img.affine)
+    masks = {}
+    for seed in seeds:
+        name, definition = parse_seed(seed)
+        if type(definition) is str:
+            mask = np.asarray(resample_to_img(definition, target, interpolation='nearest').dataobj) != 0
+        else:
+            voxels = np.indices(shape).reshape(3, -1)
+            world = img.affine[:3, :3] @ voxels + img.affine[:3, 3:]
+            distance = np.linalg.norm(world - np.array(definition)[:, np.newaxis], axis=0)
+            mask = (distance <= radius).reshape(shape)
+        if not mask.any():
+            raise ValueError(f"Seed '{name}' does not contain any voxel of image")
+        masks[name] = mask
+    return masks
+
+
+@contextmanager
+def uncompressed(fmri, tmp_dir=None):
+    """Path of uncompressed image which can be memory-mapped: gzipped image
+    is decompressed once to temporary .nii file in tmp_dir (removed on
+    exit), uncompressed image is used directly. Slabs of gzipped image
+    would otherwise be decompressed from the start of file for every slab.
+    """
+    if not fmri.endswith('.gz'):
+        yield fmri
+        return
+    fd, path = tempfile.mkstemp(suffix='.nii', dir=tmp_dir)
+    try:
+        with gzip.open(fmri, 'rb') as source, os.fdopen(fd, 'wb') as target:
+            shutil.copyfileobj(source, target, COPY_BUFFER)
+        yield path
+    finally:
+        os.remove(path)
+
+
+def _slabs(img, chunk_mb):
+    """Yields z-slabs of 4D image as 2D arrays (n_voxels, n_timepoints),
+    number of slices per slab is chosen to fit chunk_mb of float64 data."""
+    nx, ny, nz, nt = img.shape
+    slices = max(1, int(chunk_mb * 2 ** 20 // (nx * ny * nt * 8)))
+    for z in range(0, nz, slices):
+        slab = np.asarray(img.dataobj[:, :, z:z + slices, :], dtype=np.float64)
+        yield slice(z, z + slab.shape[2]), slab.reshape(-1, nt)
+
+
+def _standardize(data):
+    data = data - data.mean(axis=-1, keepdims=True)
+    std = data.std(axis=-1, keepdims=True)
+    return np.divide(data, std, out=np.zeros_like(data), where=std > 0)
+
+
+def seed_to_voxel_correlation(fmri, seeds, radius=SEED_RADIUS, chunk_mb=CHUNK_MB, tmp_dir=None) -> dict:
+    """Pearson correlation of mean seed signals with every voxel.
+    Gzipped image is decompressed once to uncompressed copy (see
+    uncompressed), which is memory-mapped and read in z-slabs twice: first
+    pass accumulates seed signals, second computes correlations of all
+    seeds with voxels of slab in single matrix product. At most one slab
+    of chunk_mb is held in memory.
+    Args:
+        fmri (str): Path to 4D fMRI image.
+        seeds (list): Seed definitions (see parse_seed).
+        radius (float): Radius of spherical seeds in mm.
+        chunk_mb (int): Size of slab in MB.
+        tmp_dir (str): Directory of uncompressed copy of gzipped image,
+            system temporary directory if None.
+    Returns:
+        dict: Seed name to float32 correlation map of shape img.shape[:3].
+    """
+    with uncompressed(fmri, tmp_dir) as path:
+        img = nb.load(path, mmap=True)
+        masks = get_seed_masks(seeds, img, radius)
+        names = list(masks)
+        nt = img.shape[3]
+        seed_sums = np.zeros((len(names), nt))
+        for z, slab in _slabs(img, chunk_mb):
+            for i, name in enumerate(names):
+                seed_sums[i] += slab[masks[name][:, :, z].ravel()].sum(axis=0)
+        counts = np.array([masks[name].sum() for name in names])
+        seed_signals = _standardize(seed_sums / counts[:, np.newaxis])
+        maps = np.zeros(img.shape[:3] + (len(names),), dtype=np.float32)
+        for z, slab in _slabs(img, chunk_mb):
+            corr = _standardize(slab) @ seed_signals.T / nt
+            maps[:, :, z] = corr.reshape(maps[:, :, z].shape)
+    return {name: maps[..., i] for i, name in enumerate(names)}
+
+
+def save_seed_map(seed_map, reference, fname) -> str:
+    """Saves correlation map as float32 NIfTI on grid of reference image."""
+    img = nb.load(reference, mmap=True)
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    nb.Nifti1Image(seed_map, img.affine, header).to_filename(fname)
+    return fname
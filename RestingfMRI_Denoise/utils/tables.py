@@ -0,0 +1,39 @@
+from os.path import splitext
+import numpy as np
+import pandas as pd
+
+TABLE_EXTENSION = '.npz'
+
+
+def save_table(table: pd.DataFrame, fname: str, tsv: bool = False) -> str:
+    """Saves group-level table as binary columns (one array per column in
+    .npz file), so large tables (e.g. edge weights of fine parcellations)
+    are written and read without text formatting and parsing.
+    Args:
+        table (pd.DataFrame): Table to save (index is not stored).
+        fname (str): Output path without extension.
+        tsv (bool): Also export table as tab separated text next to .npz
+            file.
+    Returns:
+        str: Path to .npz file.
+    """
+    columns = {}
+    for i, column in enumerate(table.columns):
+        values = table[column].to_numpy()
+        # Mixed columns (e.g. session labels of runs and 0 of runs without session) are stored as text
+        columns[f'column_{i}'] = values.astype(str) if values.dtype == object else values
+    path = fname + TABLE_EXTENSION
+    np.savez(path, columns=np.array([str(column) for column in table.columns]), **columns)
+    if tsv:
+        table.to_csv(fname + '.tsv', sep='\t', index=False)
+    return path
+
+
+def read_table(path: str) -> pd.DataFrame:
+    """Reads group-level table saved by save_table or TSV file of earlier
+    versions."""
+    if splitext(path)[1] == '.tsv':
+        return pd.read_csv(path, sep='\t')
+    with np.load(path, allow_pickle=False) as data:
+        return pd.DataFrame({column: data[f'column_{i}'] for i, column in enumerate(data['columns'])},
+                            columns=list(data['columns']))
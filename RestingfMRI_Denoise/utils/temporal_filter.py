@@ -0,0 +1,176 @@
+from functools import lru_cache
+import numpy as np
+from scipy import fft
+from scipy import signal as sp_signal
+from scipy import linalg
+from nilearn.signal import butterworth
+
+TEMPORAL_FILTERS = ('butterworth', 'fft')
+# Order of nilearn.signal.butterworth
+BUTTERWORTH_ORDER = 5
+# Fraction of energy of zero phase impulse response covered by padding of signals
+KERNEL_ENERGY = 1 - 1e-6
+# Singular values of difference of FFT and nilearn filters (unit gain) neglected by edge correction
+EDGE_TOLERANCE = 1e-6
+# Columns filtered at once (complex spectra of chunk are kept in memory)
+COLUMNS_CHUNK = 4096
+
+
+def _critical_frequencies(t_r: float, high_pass: float = None, low_pass: float = None) -> tuple:
+    """Critical frequencies and type of butterworth filter, cutoffs are
+    clipped to (0, Nyquist) as by nilearn.signal.butterworth."""
+    if high_pass is not None and low_pass is not None and high_pass >= low_pass:
+        raise ValueError(f"High pass cutoff frequency ({high_pass}) is greater than or equal to "
+                         f"low pass cutoff frequency ({low_pass})")
+    nyq = .5 / t_r
+    critical = [min(max(freq, nyq * np.finfo(1.).eps), nyq * (1 - 10 * np.finfo(1.).eps))
+                for freq in (high_pass, low_pass) if freq is not None]
+    btype = 'band' if len(critical) == 2 else 'high' if high_pass is not None else 'low'
+    return (critical if len(critical) == 2 else critical[0]), btype
+
+
+@lru_cache(maxsize=64)
+def frequency_response(n_timepoints: int, t_r: float, high_pass: float = None, low_pass: float = None) -> tuple:
+    """Zero phase response of butterworth filter of nilearn.signal.butterworth
+    (applied forward and backward) on real FFT frequencies of padded run.
+    Cached per (number of timepoints, TR, band), so filter is designed once
+    for all voxels, confounds and pipelines of runs with the same shape.
+    Args:
+        n_timepoints (int): Number of volumes of run.
+        t_r (float): Repetition time.
+        high_pass (float): High pass cutoff in Hz or None.
+        low_pass (float): Low pass cutoff in Hz or None.
+    Returns:
+        tuple: Padding (samples added to each end of run), FFT length and
+            gain of rfft frequencies (np.array of n_fft // 2 + 1 values).
+    """
+    critical, btype = _critical_frequencies(t_r, high_pass, low_pass)
+    # Second order sections, transfer function coefficients are inaccurate at low cutoffs
+    sos = sp_signal.butter(BUTTERWORTH_ORDER, critical, btype=btype, output='sos', fs=1. / t_r)
+    # Signals are padded by the length of impulse response, so circular convolution does not wrap run edges
+    impulse = np.zeros(4 * n_timepoints)
+    impulse[0] = 1.
+    energy = np.cumsum(sp_signal.sosfilt(sos, impulse) ** 2)
+    padding = min(n_timepoints - 1, int(np.searchsorted(energy, KERNEL_ENERGY * energy[-1])) + 1)
+    n_fft = fft.next_fast_len(n_timepoints + 2 * padding, real=True)
+    _, response = sp_signal.sosfreqz(sos, worN=np.fft.rfftfreq(n_fft, d=t_r), fs=1. / t_r)
+    return padding, n_fft, np.abs(response) ** 2
+
+
+def _pad(rows: np.array, padding: int) -> np.array:
+    """Odd extension of rows (time along last axis) as by
+    scipy.signal.filtfilt."""
+    return np.concatenate([2 * rows[:, :1] - rows[:, padding:0:-1],
+                           rows,
+                           2 * rows[:, -1:] - rows[:, -2:-padding - 2:-1]], axis=1)
+
+
+def _filter_rows(rows: np.array, t_r: float, high_pass: float, low_pass: float) -> np.array:
+    """Product of real FFT of padded rows with frequency response."""
+    n_timepoints = rows.shape[1]
+    padding, n_fft, response = frequency_response(n_timepoints, t_r, high_pass, low_pass)
+    spectrum = fft.rfft(_pad(rows, padding), n_fft, axis=1)
+    spectrum *= response
+    return fft.irfft(spectrum, n_fft, axis=1)[:, padding:padding + n_timepoints]
+
+
+@lru_cache(maxsize=64)
+def edge_correction(n_timepoints: int, t_r: float, high_pass: float = None, low_pass: float = None) -> tuple:
+    """Low rank correction of FFT filter (see _filter_rows) to filter of
+    nilearn.signal.butterworth. Both filters are linear operators on
+    signals of run which differ only by handling of run edges (filtfilt
+    pads 3 filter orders and starts from steady state initial conditions),
+    so their difference has low rank. It is computed once per (number of
+    timepoints, TR, band) from both filters applied to identity matrix and
+    truncated at singular values below EDGE_TOLERANCE (once per worker
+    process, about 1 s for 1200 and 9 s for 2400 volumes).
+    Returns:
+        tuple: Arrays of shape (n_timepoints, rank) and (rank, n_timepoints),
+            filtered rows are corrected by rows @ first @ second.
+    """
+    identity = np.eye(n_timepoints)
+    difference = butterworth(identity, sampling_rate=1. / t_r, high_pass=high_pass, low_pass=low_pass,
+                             copy=True) - _filter_rows(identity, t_r, high_pass, low_pass).T
+    u, s, vt = np.linalg.svd(difference)
+    rank = int((s > EDGE_TOLERANCE).sum())
+    return np.ascontiguousarray(vt[:rank].T), np.ascontiguousarray(u[:, :rank].T * s[:rank, np.newaxis])
+
+
+def fft_filter(signals: np.array, t_r: float, high_pass: float = None, low_pass: float = None) -> np.array:
+    """nilearn.signal.butterworth computed from precomputed operators of run
+    shape: product of real FFT of columns padded by odd extension with
+    frequency response (see frequency_response) and low rank correction of
+    run edges (see edge_correction), in chunks of COLUMNS_CHUNK.
+    Filtered signals differ from nilearn by about EDGE_TOLERANCE of signal
+    amplitude, except where transfer function coefficients used by nilearn
+    lose precision (band-pass of long runs with short TR, e.g. 4e-5 for 1200
+    volumes at TR 0.8 s, 3e-3 for 2400 volumes at TR 0.5 s).
+    Args:
+        signals (np.array): Shape (n_timepoints, n_columns).
+        t_r (float): Repetition time.
+        high_pass (float): High pass cutoff in Hz or None.
+        low_pass (float): Low pass cutoff in Hz or None.
+    Returns:
+        np.array: Filtered float64 signals of the same shape.
+    """
+    if high_pass is None and low_pass is None:
+        return signals
+    n_timepoints, t_r = signals.shape[0], float(t_r)
+    left, right = edge_correction(n_timepoints, t_r, high_pass, low_pass)
+    # Time axis is transposed to last axis, contiguous for FFT of voxels (signals of images are transposed views)
+    rows = np.asarray(signals, dtype=np.float64).T
+    filtered = np.empty(rows.shape)
+    for start in range(0, rows.shape[0], COLUMNS_CHUNK):
+        chunk = slice(start, start + COLUMNS_CHUNK)
+        filtered[chunk] = _filter_rows(rows[chunk], t_r, high_pass, low_pass) + (rows[chunk] @ left) @ right
+    return filtered.T
+
+
+def prepare_confounds(confounds: np.array, t_r: float, high_pass: float = None, low_pass: float = None) -> np.array:
+    """Orthonormal basis of detrended, filtered and standardized confounds
+    (pivoted QR as nilearn.signal.clean), computed once for all chunks of
+    voxels of run.
+    Args:
+        confounds (np.array): Shape (n_timepoints, n_confounds).
+        t_r (float): Repetition time.
+        high_pass (float): High pass cutoff in Hz or None.
+        low_pass (float): Low pass cutoff in Hz or None.
+    Returns:
+        np.array: Shape (n_timepoints, rank of confounds).
+    """
+    confounds = np.asarray(confounds, dtype=np.float64)
+    if confounds.ndim == 1:
+        confounds = confounds[:, np.newaxis]
+    confounds = zscore(fft_filter(sp_signal.detrend(confounds, axis=0), t_r, high_pass, low_pass))
+    q, r, _ = linalg.qr(confounds, mode='economic', pivoting=True)
+    return q[:, np.abs(np.diag(r)) > np.finfo(np.float64).eps * 100.]
+
+
+def clean_signals(signals: np.array, confounds_basis: np.array, t_r: float, high_pass: float = None,
+                  low_pass: float = None) -> np.array:
+    """nilearn.signal.clean (detrend=True, standardize='zscore',
+    standardize_confounds=True) with filtering by fft_filter (see its
+    accuracy).
+    Args:
+        signals (np.array): Shape (n_timepoints, n_signals).
+        confounds_basis (np.array): Output of prepare_confounds or None (no
+            confounds).
+        t_r (float): Repetition time.
+        high_pass (float): High pass cutoff in Hz or None.
+        low_pass (float): Low pass cutoff in Hz or None.
+    Returns:
+        np.array: Cleaned float64 signals.
+    """
+    signals = fft_filter(sp_signal.detrend(np.asarray(signals, dtype=np.float64), axis=0), t_r, high_pass, low_pass)
+    if confounds_basis is not None:
+        signals -= confounds_basis @ (confounds_basis.T @ signals)
+    return zscore(signals)
+
+
+def zscore(signals: np.array) -> np.array:
+    """Standardizes columns, constant columns are only centered (as
+    nilearn.signal.standardize_signal)."""
+    signals = signals - signals.mean(axis=0)
+    std = signals.std(axis=0)
+    std[std < np.finfo(np.float64).eps] = 1.
+    return signals / std
@@ -0,0 +1,113 @@
+import os
+from contextlib import contextmanager
+
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin, run_node
+
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                   "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+BLAS_THREADS_ENV = "RESTINGFMRI_DENOISE_BLAS_THREADS"
+
+
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def threads_per_worker(cpu_budget: int = None, n_workers: int = None) -> int:
+    """
+    Number of BLAS/OpenMP threads of each of n_workers parallel workers
+    sharing cpu_budget cores.
+    :param cpu_budget: number of cores available to the whole run, by default
+        all cpus available to the process
+    :param n_workers: number of parallel workers, by default 1
+    :return: number of threads (at least 1)
+    """
+    cpu_budget = cpu_budget or available_cpus()
+    return max(1, cpu_budget // (n_workers or 1))
+
+
+def blas_threads() -> int or None:
+    """
+    Effective number of threads of BLAS/OpenMP libraries loaded in current
+    process (maximum across libraries) or None if it cannot be determined.
+    """
+    try:
+        from threadpoolctl import threadpool_info
+    except ImportError:
+        threads = os.environ.get("OMP_NUM_THREADS")
+        return int(threads) if threads else None
+    threads = [pool['num_threads'] for pool in threadpool_info()]
+    return max(threads) if threads else None
+
+
+def set_thread_limit(n_threads: int) -> None:
+    """
+    Limits BLAS/OpenMP threads of current process and of processes started
+    afterwards (threadpoolctl for libraries already loaded, environment
+    variables for new processes). Effective limit is exposed in
+    RESTINGFMRI_DENOISE_BLAS_THREADS environment variable, so it is stored
+    in runtime of nipype interfaces.
+    :param n_threads: number of threads
+    """
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=n_threads)
+    except ImportError:
+        pass
+    os.environ[BLAS_THREADS_ENV] = str(blas_threads() or n_threads)
+
+
+@contextmanager
+def thread_limit(n_threads: int):
+    """
+    Temporarily limits BLAS/OpenMP threads of libraries loaded in current
+    process (no-op without threadpoolctl), e.g. in each of several Python
+    threads calling BLAS.
+    :param n_threads: number of threads
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        yield
+        return
+    with threadpool_limits(limits=n_threads):
+        yield
+
+
+def run_node_with_budget(node, updatehash, taskid, threads_per_proc):
+    """nipype run_node with BLAS/OpenMP threads of worker limited to
+    node.n_procs * threads_per_proc."""
+    set_thread_limit(max(1, node.n_procs) * threads_per_proc)
+    return run_node(node, updatehash, taskid)
+
+
+class ThreadBudgetMultiProcPlugin(MultiProcPlugin):
+    """
+    MultiProc plugin limiting BLAS/OpenMP threads of every node according to
+    its declared n_procs: each of n_procs slots gets cpu_budget // n_procs
+    threads, so concurrently running nodes never use more than cpu_budget
+    threads in total.
+    Additional plugin_args: cpu_budget (number of cores, by default all
+    available cpus).
+    """
+
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.threads_per_proc = threads_per_worker((plugin_args or {}).get('cpu_budget'), self.processors)
+        # Workers started by pool inherit limits of main process
+        set_thread_limit(self.threads_per_proc)
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        # Don't allow streaming outputs
+        if getattr(node.interface, "terminal_output", "") == "stream":
+            node.interface.terminal_output = "allatonce"
+        result_future = self.pool.submit(run_node_with_budget, node, updatehash, self._taskid,
+                                         self.threads_per_proc)
+        result_future.add_done_callback(self._async_callback)
+        self._task_obj[self._taskid] = result_future
+        return self._taskid
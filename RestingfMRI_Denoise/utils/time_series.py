@@ -0,0 +1,76 @@
+from functools import lru_cache
+import numpy as np
+import nibabel as nb
+from scipy import sparse
+from nilearn import signal
+from nilearn.image import resample_to_img
+
+
+@lru_cache(maxsize=8)
+def _labels_operator(parcellation_paths, shape, affine_bytes):
+    target = nb.Nifti1Image(np.zeros(shape, dtype=np.int8), np.frombuffer(affine_bytes).reshape(4, 4))
+    rows, cols, weights, slices = [], [], [], []
+    n_rows = 0
+    for path in parcellation_paths:
+        labels_img = resample_to_img(path, target, interpolation='nearest')
+        labels = np.asarray(labels_img.dataobj).astype(int).ravel()
+        voxels = np.flatnonzero(labels)
+        present, index, counts = np.unique(labels[voxels], return_inverse=True, return_counts=True)
+        rows.append(n_rows + index)
+        cols.append(voxels)
+        weights.append(1. / counts[index])
+        slices.append(slice(n_rows, n_rows + len(present)))
+        n_rows += len(present)
+    operator = sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                                 shape=(n_rows, int(np.prod(shape))))
+    return operator, tuple(slices)
+
+
+def get_labels_operator(parcellation_paths, target_img):
+    """Creates sparse operator averaging voxels within each parcel of all
+    parcellations at once (parcellations are stacked along rows).
+    Parcellations are resampled to the grid of target_img with nearest
+    neighbour interpolation, as done by NiftiLabelsMasker. Operators are
+    cached for repeated calls with the same grid.
+    Args:
+        parcellation_paths (list): Paths to parcellation images.
+        target_img (nb.Nifti1Image): 4D image defining voxel grid.
+    Returns:
+        tuple: sparse matrix of shape (n_parcels_total, n_voxels) and
+            slices selecting rows of each parcellation.
+    """
+    affine = np.ascontiguousarray(target_img.affine, dtype=np.float64)
+    return _labels_operator(tuple(parcellation_paths), tuple(target_img.shape[:3]), affine.tobytes())
+
+
+def extract_region_signals(fmri, parcellation_paths) -> tuple:
+    """Reads fMRI data once and averages voxels within parcels of every
+    parcellation, without any cleaning.
+    Args:
+        fmri (str): Path to 4D fMRI image.
+        parcellation_paths (list): Paths to parcellation images.
+    Returns:
+        tuple: np.array of shape (n_timepoints, n_parcels_total) and slices
+            selecting columns of each parcellation.
+    """
+    img = nb.load(fmri)
+    operator, slices = get_labels_operator(parcellation_paths, img)
+    data = np.asanyarray(img.dataobj).reshape(-1, img.shape[3])
+    return np.asarray(operator @ data).T, slices
+
+
+def extract_time_series(fmri, parcellation_paths, detrend=True, standardize=True):
+    """Reads fMRI data once and extracts mean time series of parcels of
+    every parcellation.
+    Args:
+        fmri (str): Path to 4D fMRI image.
+        parcellation_paths (list): Paths to parcellation images.
+        detrend (bool): Passed to nilearn.signal.clean.
+        standardize (bool): Passed to nilearn.signal.clean.
+    Returns:
+        list: np.array of shape (n_timepoints, n_parcels) for each
+            parcellation.
+    """
+    region_signals, slices = extract_region_signals(fmri, parcellation_paths)
+    return [signal.clean(region_signals[:, atlas], detrend=detrend, standardize=standardize)
+            for atlas in slices]
@@ -10,15 +10,19 @@ from nipype import config
 from nipype.pipeline import engine as pe
 from nilearn import datasets
 
-from RestingfMRI_Denoise.interfaces.prep_bids import BIDSGrab, BIDSDataSink
-from RestingfMRI_Denoise.interfaces.confounds import Confounds, GroupConfounds
+from RestingfMRI_Denoise.interfaces.prep_bids import BIDSGrab, BIDSDataSink, Preflight
+from RestingfMRI_Denoise.interfaces.confounds import (Confounds, ConfInvariants, CompCor, GroupConfounds, GroupMotion,
+                                                      MotionGate)
 from RestingfMRI_Denoise.interfaces.denoising import Denoise
-from RestingfMRI_Denoise.interfaces.connectivity import Connectivity, GroupConnectivity
+from RestingfMRI_Denoise.interfaces.connectivity import (Connectivity, GroupConnectivity, GroupConnectivityMetrics,
+                                                         DynamicConnectivity, SeedConnectivity)
 from RestingfMRI_Denoise.interfaces.pipeline_selector import PipelineSelector
 from RestingfMRI_Denoise.interfaces.quality_measures import QualityMeasures, PipelinesQualityMeasures, MergeGroupQualityMeasures
 from RestingfMRI_Denoise.interfaces.report_creator import ReportCreator
-from RestingfMRI_Denoise.parcellation import get_parcelation_file_path, get_distance_matrix_file_path
+from RestingfMRI_Denoise.interfaces.lifecycle import EvictIntermediate
+from RestingfMRI_Denoise.parcellation import get_parcelation_file_path, get_distance_matrix_file_path, get_atlas_names
 from RestingfMRI_Denoise.pipelines import get_pipelines_paths
+from RestingfMRI_Denoise.utils.utils import load_pipeline_from_json
 import RestingfMRI_Denoise.utils.temps as temps
 
 import logging
@@ -38,6 +42,19 @@ def init_denoise_wf(bids_dir,
                         ica_aroma=False,
                         high_pass=0.008,
                         low_pass=0.08,
+                        motion_gate=False,
+                        dfc_window=None,
+                        dfc_step=1,
+                        dfc_taper='rectangular',
+                        seeds=None,
+                        seed_radius=6.,
+                        denoise_threads=1,
+                        screening_trace=None,
+                        evict_intermediates=False,
+                        work_quota=None,
+                        tsv_tables=False,
+                        compcor='fmriprep',
+                        temporal_filter='butterworth',
                         # desc=None,
                         # ignore=None, force_index=None,
                         base_dir='/tmp/Restingfmri_Denoise/', 
@@ -45,6 +62,9 @@ def init_denoise_wf(bids_dir,
                         ):
     workflow = pe.Workflow(name=name, base_dir=base_dir)
     temps.base_dir = base_dir
+    if isinstance(parcellation_paths, str):
+        parcellation_paths = [parcellation_paths]
+    atlas_names = get_atlas_names(parcellation_paths)
 
     # 1) --- Selecting pipeline
     # Inputs: fulfilled
@@ -67,31 +87,105 @@ def init_denoise_wf(bids_dir,
                           name="BidsGrabber")
     # Outputs: fmri_prep, conf_raw, conf_json, entities, tr_dict
 
+    # 2a) --- Validating inputs of all runs before scheduling any job
+    # Inputs: fmri_prep, fmri_prep_aroma, brain_mask, conf_raw, conf_json, entities, tr_dict
+    preflight = pe.Node(
+                      Preflight(
+                          pipelines=[load_pipeline_from_json(path) for path in pipelines_paths],
+                          parcellation=parcellation_paths,
+                          compcor=compcor
+                          ),
+                      name="Preflight")
+    workflow.connect([
+        (grabbing_bids, preflight, [('fmri_prep', 'fmri_prep'),
+                                    ('fmri_prep_aroma', 'fmri_prep_aroma'),
+                                    ('brain_mask', 'brain_mask'),
+                                    ('conf_raw', 'conf_raw'),
+                                    ('conf_json', 'conf_json'),
+                                    ('entities', 'entities'),
+                                    ('tr_dict', 'tr_dict')])
+    ])
+    # Outputs: fmri_prep, fmri_prep_aroma, brain_mask, conf_raw, conf_json, entities, warnings
+
+    # 2b) --- Excluding high motion runs before denoising (optional)
+    # Inputs: fmri_prep, fmri_prep_aroma, brain_mask, conf_raw, conf_json, entities
+    if motion_gate:
+        run_source = pe.Node(MotionGate(), name="MotionGate")
+        workflow.connect([
+            (preflight, run_source, [('fmri_prep', 'fmri_prep'),
+                                     ('fmri_prep_aroma', 'fmri_prep_aroma'),
+                                     ('brain_mask', 'brain_mask'),
+                                     ('conf_raw', 'conf_raw'),
+                                     ('conf_json', 'conf_json'),
+                                     ('entities', 'entities')])
+        ])
+    else:
+        run_source = preflight
+    # Outputs: fmri_prep, fmri_prep_aroma, brain_mask, conf_raw, conf_json, entities, excluded_summary, excluded_runs
+
+    # 2c) --- Pipeline independent confounds measures (computed once per run)
+    # Inputs: pipelines, conf_raw, conf_json, fmri_prep_aroma, entities
+    compcor_from_bold = compcor != 'fmriprep' and any(load_pipeline_from_json(path)['confounds']['acompcor']
+                                                      for path in pipelines_paths)
+    conf_invariants = pe.MapNode(
+                          ConfInvariants(
+                              pipelines=[load_pipeline_from_json(path) for path in pipelines_paths]
+                              ),
+                          iterfield=['conf_raw', 'conf_json', 'fmri_prep_aroma', 'entities']
+                                    + (['compcor'] if compcor_from_bold else []),
+                          name="ConfInvariants")
+    # Outputs: conf_invariants
+
+    # 2d) --- CompCor components computed from BOLD (optional, once per run for all aCompCor pipelines)
+    # Inputs: fmri_prep, brain_mask, entities, tr_dict
+    if compcor_from_bold:
+        compcor_node = pe.MapNode(
+                              CompCor(
+                                  temporal=compcor == 'temporal',
+                                  output_dir=temps.mkdtemp(os.path.join(base_dir, 'compcor'))
+                                  ),
+                              iterfield=['fmri_prep', 'brain_mask', 'entities'],
+                              name="CompCor")
+        workflow.connect([
+            (grabbing_bids, compcor_node, [('tr_dict', 'tr_dict')]),
+            (run_source, compcor_node, [('fmri_prep', 'fmri_prep'),
+                                        ('brain_mask', 'brain_mask'),
+                                        ('entities', 'entities')]),
+            (compcor_node, conf_invariants, [('compcor', 'compcor')])
+        ])
+    # Outputs: compcor
+
     # 3) --- Confounds preprocessing
-    # Inputs: pipeline, conf_raw, conf_json
+    # Inputs: pipeline, conf_raw, conf_json, conf_invariants
     temppath = os.path.join(base_dir, 'prep_conf')
     prep_conf = pe.MapNode(
                           Confounds(
                               output_dir=temps.mkdtemp(temppath)
                               ),
-                          iterfield=['conf_raw', 'conf_json', 'entities', 'fmri_prep_aroma'],
+                          iterfield=['conf_raw', 'conf_json', 'entities', 'fmri_prep_aroma', 'conf_invariants'],
                           name="ConfPrep")
     # Outputs: conf_prep, low_pass, high_pass
 
     # 4) --- Denoising
-    # Inputs: fmri_prep, fmri_prep_aroma, conf_prep, pipeline, entity, tr_dict
-    iterate = ['fmri_prep', 'fmri_prep_aroma', 'conf_prep', 'entities']
+    # Inputs: fmri_prep, fmri_prep_aroma, brain_mask, conf_prep, pipeline, entity, tr_dict
+    iterate = ['fmri_prep', 'fmri_prep_aroma', 'brain_mask', 'conf_prep', 'entities']
     temppath = os.path.join(base_dir, 'denoise')
     denoise = pe.MapNode(
                         Denoise(
                             smoothing=smoothing,
                             high_pass=high_pass,
                             low_pass=low_pass,
+                            temporal_filter=temporal_filter,
                             ica_aroma=ica_aroma,
+                            n_threads=denoise_threads,
+                            design_cache_dir=temps.mkdtemp(os.path.join(base_dir, 'design_cache')),
+                            work_dir=base_dir,
                             output_dir=temps.mkdtemp(temppath)
                             ),
                         iterfield=iterate,
-                        name="Denoiser", mem_gb=6)
+                        name="Denoiser", mem_gb=6, n_procs=denoise_threads)
+    if work_quota is not None:
+        denoise.inputs.work_quota = work_quota
     # Outputs: fmri_denoised
     
     # 5) --- Connectivity estimation
@@ -100,12 +194,27 @@ def init_denoise_wf(bids_dir,
     connectivity = pe.MapNode(
                             Connectivity(
                                 output_dir=temps.mkdtemp(temppath),
-                                parcellation=parcellation_paths
+                                parcellation=parcellation_paths,
+                                store_dir=os.path.join(bids_dir, 'derivatives', 'denoise')
                                 ),
-                            iterfield=['fmri_denoised'],
+                            iterfield=['fmri_denoised', 'entities'],
                             name='ConnCalc')
     # Outputs: conn_mat, carpet_plot
 
+    # 5b) --- Seed-to-voxel connectivity maps (optional)
+    # Inputs: fmri_denoised
+    if seeds:
+        temppath = os.path.join(base_dir, 'seed_connectivity')
+        seed_connectivity = pe.MapNode(
+                                SeedConnectivity(
+                                    output_dir=temps.mkdtemp(temppath),
+                                    seeds=seeds,
+                                    seed_radius=seed_radius
+                                    ),
+                                iterfield=['fmri_denoised', 'entities'],
+                                name='SeedConn')
+    # Outputs: seed_maps
+
     # 6) --- Group confounds
     # Inputs: conf_summary, pipeline_name
     # FIXME BEGIN
@@ -116,28 +225,70 @@ def init_denoise_wf(bids_dir,
     group_conf_summary = pe.Node(
                                 GroupConfounds(
                                     output_dir=os.path.join(bids_dir, 'derivatives', 'denoise'),
+                                    tsv=tsv_tables,
                                     ),
                                 name="GroupConf")
     # Outputs: group_conf_summary
 
+    # 6b) --- Group motion (computed once for all pipelines)
+    # Inputs: conf_invariants, entities, excluded_summary
+    group_motion = pe.Node(
+                          GroupMotion(
+                              output_dir=os.path.join(bids_dir, 'derivatives', 'denoise'),
+                              tsv=tsv_tables,
+                              ),
+                          name="GroupMotion")
+    # Outputs: group_motion_summary, motion_plot, exclude_list
+
     # 7) --- Group connectivity
     # Inputs: corr_mat, pipeline_name
     group_connectivity = pe.Node(
                                 GroupConnectivity(
                                     output_dir=os.path.join(bids_dir, 'derivatives', 'denoise'),
+                                    atlas_names=atlas_names,
+                                    store_dir=os.path.join(bids_dir, 'derivatives', 'denoise')
                                     ),
                                 name="GroupConn")
     # Outputs: group_corr_mat
 
-    # 8) --- Quality measures
+    # 7b) --- Group connectivity metrics (correlation, covariance, partial correlation, tangent)
+    # Inputs: time_series, pipeline_name, entities
+    group_connectivity_metrics = pe.Node(
+                                GroupConnectivityMetrics(
+                                    output_dir=os.path.join(bids_dir, 'derivatives', 'denoise'),
+                                    atlas_names=atlas_names,
+                                    store_dir=os.path.join(bids_dir, 'derivatives', 'denoise')
+                                    ),
+                                name="GroupConnMetrics")
+    # Outputs: conn_metrics
+
+    # 7c) --- Sliding-window dynamic connectivity (optional)
+    # Inputs: time_series, pipeline_name, entities
+    if dfc_window:
+        dynamic_connectivity = pe.Node(
+                                DynamicConnectivity(
+                                    output_dir=os.path.join(bids_dir, 'derivatives', 'denoise'),
+                                    atlas_names=atlas_names,
+                                    store_dir=os.path.join(bids_dir, 'derivatives', 'denoise'),
+                                    window=dfc_window,
+                                    step=dfc_step,
+                                    taper=dfc_taper
+                                    ),
+                                name="DynamicConn")
+    # Outputs: dynamic_conn
+
+    # 8) --- Quality measures (one per parcellation)
     # Inputs: group_corr_mat, group_conf_summary, pipeline_name
     quality_measures = pe.MapNode(
                                   QualityMeasures(
                                       output_dir=os.path.join(bids_dir, 'derivatives', 'denoise'),
-                                      distance_matrix=get_distance_matrix_file_path()
                                       ),
-                                  iterfield=['group_corr_mat', 'group_conf_summary'],
+                                  iterfield=['group_corr_mat', 'distance_matrix', 'atlas_name'],
                                   name="QualityMeasures")
+    quality_measures.inputs.distance_matrix = [get_distance_matrix_file_path(
+                                                  path, os.path.join(bids_dir, 'derivatives', 'denoise'))
+                                              for path in parcellation_paths]
+    quality_measures.inputs.atlas_name = atlas_names
     # Outputs: fc_fd_summary, edges_weight, edges_weight_clean
 
     # 9) --- Merge quality measures into lists for further processing
@@ -152,6 +303,8 @@ def init_denoise_wf(bids_dir,
     pipelines_quality_measures = pe.Node(
                                         PipelinesQualityMeasures(
                                                               output_dir=os.path.join(bids_dir, 'derivatives', 'denoise'),
+                                                              atlas_names=atlas_names,
+                                                              tsv=tsv_tables
                                                               ),
                                         name="PipelinesQC")
 
@@ -160,11 +313,14 @@ def init_denoise_wf(bids_dir,
     # 11) --- Report from data
     report_creator = pe.JoinNode(
                             ReportCreator(
-                                group_data_dir=os.path.join(bids_dir, 'derivatives', 'denoise')
+                                group_data_dir=os.path.join(bids_dir, 'derivatives', 'denoise'),
+                                atlas_names=atlas_names
                                 ),
                             joinsource=pipelineselector,
                             joinfield=['pipelines', 'pipelines_names'],
                             name='ReportCreator')
+    if screening_trace:
+        report_creator.inputs.screening_trace = screening_trace
 
     # 12) --- Save derivatives
     # TODO: Fill missing in/out
@@ -192,24 +348,34 @@ def init_denoise_wf(bids_dir,
 # --- Connecting nodes
     workflow.connect([
         (grabbing_bids, denoise, [('tr_dict', 'tr_dict')]),
-        (grabbing_bids, denoise, [('fmri_prep', 'fmri_prep'),
-                                  ('fmri_prep_aroma', 'fmri_prep_aroma')]),
-        (grabbing_bids, denoise, [('entities', 'entities')]),
-        (grabbing_bids, prep_conf, [('conf_raw', 'conf_raw'),
-                                    ('conf_json', 'conf_json'),
-                                    ('entities', 'entities'),
-                                   ('fmri_prep_aroma', 'fmri_prep_aroma')]),
-        (grabbing_bids, ds_confounds, [('entities', 'entities')]),
-        (grabbing_bids, ds_denoise, [('entities', 'entities')]),
-        (grabbing_bids, ds_connectivity, [('entities', 'entities')]),
-        (grabbing_bids, ds_carpet_plot, [('entities', 'entities')]),
-        (grabbing_bids, ds_matrix_plot, [('entities', 'entities')]),
+        (run_source, denoise, [('fmri_prep', 'fmri_prep'),
+                               ('fmri_prep_aroma', 'fmri_prep_aroma'),
+                               ('brain_mask', 'brain_mask')]),
+        (run_source, denoise, [('entities', 'entities')]),
+        (run_source, prep_conf, [('conf_raw', 'conf_raw'),
+                                 ('conf_json', 'conf_json'),
+                                 ('entities', 'entities'),
+                                 ('fmri_prep_aroma', 'fmri_prep_aroma')]),
+        (run_source, conf_invariants, [('conf_raw', 'conf_raw'),
+                                       ('conf_json', 'conf_json'),
+                                       ('entities', 'entities'),
+                                       ('fmri_prep_aroma', 'fmri_prep_aroma')]),
+        (run_source, group_motion, [('entities', 'entities')]),
+        (conf_invariants, prep_conf, [('conf_invariants', 'conf_invariants')]),
+        (conf_invariants, group_motion, [('conf_invariants', 'conf_invariants')]),
+        (run_source, connectivity, [('entities', 'entities')]),
+        (run_source, ds_confounds, [('entities', 'entities')]),
+        (run_source, ds_denoise, [('entities', 'entities')]),
+        (run_source, ds_connectivity, [('entities', 'entities')]),
+        (run_source, ds_carpet_plot, [('entities', 'entities')]),
+        (run_source, ds_matrix_plot, [('entities', 'entities')]),
 
         (pipelineselector, prep_conf, [('pipeline', 'pipeline')]),
         (pipelineselector, denoise, [('pipeline', 'pipeline')]),
         (prep_conf, group_conf_summary, [('conf_summary', 'conf_summary'),
                                         ('pipeline_name', 'pipeline_name')]),
 
+        (pipelineselector, connectivity, [('pipeline_name', 'pipeline_name')]),
         (pipelineselector, ds_denoise, [('pipeline_name', 'pipeline_name')]),
         (pipelineselector, ds_connectivity, [('pipeline_name', 'pipeline_name')]),
         (pipelineselector, ds_confounds, [('pipeline_name', 'pipeline_name')]),
@@ -221,6 +387,10 @@ def init_denoise_wf(bids_dir,
 
         (prep_conf, group_connectivity, [('pipeline_name', 'pipeline_name')]),
         (connectivity, group_connectivity, [('corr_mat', 'corr_mat')]),
+        (run_source, group_connectivity, [('entities', 'entities')]),
+        (prep_conf, group_connectivity_metrics, [('pipeline_name', 'pipeline_name')]),
+        (connectivity, group_connectivity_metrics, [('time_series', 'time_series')]),
+        (run_source, group_connectivity_metrics, [('entities', 'entities')]),
 
         (prep_conf, ds_confounds, [('conf_prep', 'in_file')]),
         (denoise, ds_denoise, [('fmri_denoised', 'in_file')]),
@@ -233,13 +403,12 @@ def init_denoise_wf(bids_dir,
         (group_conf_summary, quality_measures, [('group_conf_summary', 'group_conf_summary')]),
         (quality_measures, merge_quality_measures, [('fc_fd_summary', 'fc_fd_summary'),
                                                     ('edges_weight', 'edges_weight'),
-                                                    ('edges_weight_clean', 'edges_weight_clean'),
-                                                    ('exclude_list', 'exclude_list')]),
+                                                    ('edges_weight_clean', 'edges_weight_clean')]),
         (merge_quality_measures, pipelines_quality_measures,
             [('fc_fd_summary', 'fc_fd_summary'),
              ('edges_weight', 'edges_weight'),
              ('edges_weight_clean', 'edges_weight_clean')]),
-        (merge_quality_measures, report_creator,
+        (group_motion, report_creator,
             [('exclude_list', 'excluded_subjects')]),
         (pipelines_quality_measures, report_creator,
             [('plot_pipeline_edges_density', 'plot_pipeline_edges_density'),
@@ -251,6 +420,49 @@ def init_denoise_wf(bids_dir,
             [('pipeline', 'pipelines'),
              ('pipeline_name', 'pipelines_names')])
     ])
+    if seeds:
+        ds_seed_maps = pe.MapNode(BIDSDataSink(base_directory=bids_dir),
+                                  iterfield=['in_file', 'entities'],
+                                  name="ds_seed_maps")
+        workflow.connect([
+            (denoise, seed_connectivity, [('fmri_denoised', 'fmri_denoised')]),
+            (run_source, seed_connectivity, [('entities', 'entities')]),
+            (pipelineselector, seed_connectivity, [('pipeline_name', 'pipeline_name')]),
+            (seed_connectivity, ds_seed_maps, [('seed_maps', 'in_file')]),
+            (run_source, ds_seed_maps, [('entities', 'entities')]),
+            (pipelineselector, ds_seed_maps, [('pipeline_name', 'pipeline_name')])
+        ])
+
+    # 13) --- Eviction of denoised images after connectivity, seed maps and sink (optional)
+    if evict_intermediates:
+        evict_consumers = ['in_file', 'connectivity', 'sink'] + (['seed_maps'] if seeds else [])
+        evict_denoised = pe.MapNode(EvictIntermediate(),
+                                    iterfield=evict_consumers,
+                                    name="EvictDenoised")
+        # Evicted images are regenerated if workflow is rerun in the same work dir, so rerun recomputes
+        # Denoiser and its downstream nodes (nipype cache is kept only without eviction)
+        denoise.overwrite = True
+        workflow.connect([
+            (denoise, evict_denoised, [('fmri_denoised', 'in_file')]),
+            (connectivity, evict_denoised, [('corr_mat', 'connectivity')]),
+            (ds_denoise, evict_denoised, [('out_file', 'sink')])
+        ])
+        if seeds:
+            workflow.connect(seed_connectivity, 'seed_maps', evict_denoised, 'seed_maps')
+
+    if dfc_window:
+        workflow.connect([
+            (prep_conf, dynamic_connectivity, [('pipeline_name', 'pipeline_name')]),
+            (connectivity, dynamic_connectivity, [('time_series', 'time_series')]),
+            (run_source, dynamic_connectivity, [('entities', 'entities')])
+        ])
+
+    if motion_gate:
+        workflow.connect([
+            (run_source, group_conf_summary, [('excluded_summary', 'excluded_summary')]),
+            (run_source, group_motion, [('excluded_summary', 'excluded_summary')]),
+            (run_source, report_creator, [('excluded_runs', 'motion_gated_runs')])
+        ])
 
     return workflow
 
@@ -0,0 +1,124 @@
+#Daemon mode
+#Keeps imported modules, process pool of in-process engines (workers keep
+#cached atlas operators), validated pipelines and BIDS index warm between
+#denoise jobs submitted over local UNIX socket (utils.daemon_client).
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import traceback
+import socketserver
+from contextlib import ExitStack
+from concurrent.futures.process import BrokenProcessPool
+
+from RestingfMRI_Denoise.__main__ import main
+from RestingfMRI_Denoise.interfaces.prep_bids import enable_layout_cache
+from RestingfMRI_Denoise.workflows.executor import worker_pool
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            response = self.server.run_request(json.loads(line))
+        except ValueError as err:
+            response = {'status': 'error', 'error': f"Invalid request: {err}"}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class DenoiseDaemon(socketserver.UnixStreamServer):
+    """
+    Serves requests one at a time, so submitted jobs are queued on socket
+    and executed in order. Each denoise job runs main() in daemon process
+    with the warm process pool; working directory and environment are
+    restored after every job.
+    """
+
+    def __init__(self, socket_path: str, n_procs: int = None, cpu_budget: int = None):
+        if os.path.exists(socket_path):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(socket_path)
+            except OSError:
+                os.remove(socket_path)  # stale socket of stopped daemon
+            else:
+                raise RuntimeError(f"Daemon is already running at {socket_path}")
+        super().__init__(socket_path, JobHandler)
+        os.chmod(socket_path, 0o600)
+        self.n_procs, self.cpu_budget = n_procs, cpu_budget
+        self.pools = ExitStack()
+        self.pool = self.pools.enter_context(worker_pool(n_procs, cpu_budget))
+        self.started, self.jobs, self.stopped = time.time(), 0, False
+        enable_layout_cache()
+
+    def run_request(self, request: dict) -> dict:
+        command = request.get('command', 'denoise')
+        if command == 'ping':
+            return {'status': 'ok', 'jobs': self.jobs, 'uptime': time.time() - self.started}
+        if command == 'shutdown':
+            self.stopped = True
+            return {'status': 'ok'}
+        if command != 'denoise':
+            return {'status': 'error', 'error': f"Unknown command '{command}'"}
+        cwd, environ = os.getcwd(), dict(os.environ)
+        start = time.time()
+        try:
+            os.chdir(request.get('cwd', cwd))
+            main(request['argv'], pool=self.pool)
+            response = {'status': 'ok'}
+        except SystemExit as err:  # invalid arguments
+            response = {'status': 'error', 'error': f"Invalid arguments (exit code {err.code})"}
+        except BrokenProcessPool:
+            self.pool = self.pools.enter_context(worker_pool(self.n_procs, self.cpu_budget))
+            response = {'status': 'error', 'error': traceback.format_exc()}
+        except Exception:
+            response = {'status': 'error', 'error': traceback.format_exc()}
+        finally:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+        self.jobs += 1
+        response['seconds'] = time.time() - start
+        # Request without argv fails inside try, it is still logged
+        print(f"Job {self.jobs} ({' '.join(map(str, request.get('argv', [])))}): {response['status']} "
+              f"in {response['seconds']:.1f} s", flush=True)
+        return response
+
+    def serve(self) -> None:
+        try:
+            while not self.stopped:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.remove(self.server_address)
+            self.pools.close()
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Runs RestingfMRI_Denoise daemon accepting jobs over UNIX socket "
+                    "(submit with RestingfMRI_Denoise_submit).")
+    parser.add_argument("socket",
+                        help="Path to UNIX socket.")
+    parser.add_argument("--n-procs",
+                        type=int,
+                        default=None,
+                        help="Number of worker processes kept warm, by default number of cpus.")
+    parser.add_argument("--cpu-budget",
+                        type=int,
+                        default=None,
+                        help="Number of cores available to daemon, BLAS/OpenMP threads of each worker are limited \
+                        to CPU_BUDGET // N_PROCS, by default all available cpus.")
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    daemon = DenoiseDaemon(args.socket, args.n_procs, args.cpu_budget)
+    print(f"Listening on {args.socket}", flush=True)
+    daemon.serve()
+    sys.exit(0)
@@ -0,0 +1,1133 @@
+#In-process execution engine
+#Runs the same interfaces as init_denoise_wf as plain python calls over
+#a process pool, without nipype graph bookkeeping (input hashing, result
+#pickles and node directories in the work dir).
+#watch_denoise runs the same stages on runs completed by fMRIPrep while
+#preprocessing of the cohort is still running.
+import os
+import copy
+import json
+import logging
+import datetime
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from os.path import join, exists
+from nipype.utils.filemanip import ensure_list, split_filename
+from nipype.interfaces.base import Undefined, isdefined
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from nilearn.connectome import sym_matrix_to_vec
+
+from RestingfMRI_Denoise.interfaces.prep_bids import BIDSGrab, BIDSDataSink
+from RestingfMRI_Denoise.interfaces.confounds import (Confounds, ConfInvariants, CompCor, GroupConfounds, GroupMotion,
+                                                      MotionGate)
+from RestingfMRI_Denoise.interfaces.denoising import Denoise
+from RestingfMRI_Denoise.interfaces.connectivity import (Connectivity, GroupConnectivity, GroupConnectivityMetrics,
+                                                         DynamicConnectivity, SeedConnectivity)
+from RestingfMRI_Denoise.interfaces.quality_measures import QualityMeasures, PipelinesQualityMeasures, MergeGroupQualityMeasures
+from RestingfMRI_Denoise.interfaces.report_creator import ReportCreator
+from RestingfMRI_Denoise.parcellation import (get_parcelation_file_path, get_distance_matrix_file_path,
+                                              get_atlas_names, atlas_suffix)
+from RestingfMRI_Denoise.pipelines import get_pipelines_paths
+from RestingfMRI_Denoise.utils.utils import load_pipeline_from_json
+from RestingfMRI_Denoise.utils.json_validator import is_valid
+from RestingfMRI_Denoise.utils.time_series import extract_region_signals
+from RestingfMRI_Denoise.utils.parcel_denoise import (batched_clean, batched_correlation, batched_detrend,
+                                                      batched_zscore, batches, pad_confounds)
+from RestingfMRI_Denoise.utils.screening import (N_BOOTSTRAP, pilot_sample, bootstrap_qc, prune_dominated,
+                                                  screening_trace)
+from RestingfMRI_Denoise.utils.design_dedup import effective_settings, denoise_fingerprint, representatives, link_or_copy
+from RestingfMRI_Denoise.utils.lifecycle import evict, drop_unused_designs
+from RestingfMRI_Denoise.utils.preflight import preflight, PreflightError
+from RestingfMRI_Denoise.utils.cost_estimate import run_label
+from RestingfMRI_Denoise.utils.pipeline_grid import shared_stages, summarize_shared
+from RestingfMRI_Denoise.utils.connectivity_store import store_path, append_runs
+from RestingfMRI_Denoise.utils.tables import save_table
+from RestingfMRI_Denoise.utils.thread_budget import available_cpus, blas_threads, set_thread_limit, threads_per_worker
+import RestingfMRI_Denoise.utils.temps as temps
+
+
+# Validated pipelines by (path, modification time), kept warm by daemon
+_pipelines_cache = {}
+
+
+def load_pipelines(pipelines_paths) -> list:
+    """
+    Loads and validates pipelines (same checks as PipelineSelector).
+    Validated pipelines are cached until their json file changes.
+    :param pipelines_paths: iterable with paths to pipeline json files
+    :return: list of pipeline dictionaries sorted by name
+    """
+    pipelines = []
+    for path in pipelines_paths:
+        key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+        if key not in _pipelines_cache:
+            js = load_pipeline_from_json(path)
+            if not is_valid(js):
+                raise ValueError("""
+                Json file {} is not a valid pipeline,
+                check schema at Restingfmri_Denoise.utils.json_validator.py
+                """.format(os.path.basename(path)))
+            _pipelines_cache[key] = js
+        pipelines.append(copy.deepcopy(_pipelines_cache[key]))
+    return sorted(pipelines, key=lambda pipeline: pipeline['name'])
+
+
+def grab_runs(bids_dir, derivatives, task, session, subject, ica_aroma, skip_incomplete=False) -> list:
+    """
+    Runs BIDSGrab and splits its outputs into list of per-run dictionaries.
+    :param skip_incomplete: skip runs with missing files instead of raising
+    :return: list of dictionaries with fmri_prep, fmri_prep_aroma, brain_mask,
+        conf_raw, conf_json, entities and tr_dict keys
+    """
+    grabber = BIDSGrab(bids_dir=bids_dir,
+                       derivatives=derivatives,
+                       task=task,
+                       session=session,
+                       subject=subject,
+                       ica_aroma=ica_aroma,
+                       skip_incomplete=skip_incomplete)
+    outputs = grabber.run().outputs
+    if not isdefined(outputs.fmri_prep):
+        return []
+    # Single run outputs are collapsed from lists by OutputMultiPath
+    keys = ('fmri_prep', 'fmri_prep_aroma', 'brain_mask', 'conf_raw', 'conf_json', 'entities')
+    # brain_mask is a plain list (None for runs without mask)
+    values = [ensure_list(getattr(outputs, key)) for key in keys]
+    return [{**dict(zip(keys, run_values)), 'tr_dict': outputs.tr_dict} for run_values in zip(*values)]
+
+
+def gate_runs(runs: list) -> tuple:
+    """
+    Excludes runs failing pipeline independent motion criteria (MotionGate).
+    :param runs: output of grab_runs
+    :return: tuple with list of passed runs, list of summaries and names of
+        excluded runs
+    """
+    gate = MotionGate(**{key: [run[key] for run in runs]
+                         for key in ('fmri_prep', 'fmri_prep_aroma', 'brain_mask', 'conf_raw', 'conf_json',
+                                     'entities')})
+    outputs = gate.run().outputs
+    passed_keys = {run_key(entities) for entities in outputs.entities}
+    passed = [run for run in runs if run_key(run['entities']) in passed_keys]
+    return passed, outputs.excluded_summary, outputs.excluded_runs
+
+
+def run_key(entities: dict) -> str:
+    return "_".join(f"{key}-{entities[key]}" for key in ('subject', 'session', 'task') if key in entities)
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _timed(node_type: str, interface, records: list):
+    start = _now()
+    result = interface.run()
+    records.append({'node_type': node_type, 'start': start, 'finish': _now(), 'blas_threads': blas_threads()})
+    return result.outputs
+
+
+def conf_invariants(job: dict) -> dict:
+    """
+    Pipeline independent confounds measures of one run, shared by all
+    (run, pipeline) jobs, preceded by CompCor components computed from BOLD
+    if aCompCor pipelines use them.
+    :param job: dictionary with run, pipelines and options keys
+    :return: dictionary with conf_invariants and records keys
+    """
+    run, options, records = job['run'], job['options'], []
+    compcor = Undefined
+    if options['compcor'] != 'fmriprep' and any(pipeline['confounds']['acompcor'] for pipeline in job['pipelines']):
+        compcor = _timed('CompCor', CompCor(fmri_prep=run['fmri_prep'],
+                                            brain_mask=run['brain_mask'] or Undefined,
+                                            entities=run['entities'],
+                                            tr_dict=run['tr_dict'],
+                                            temporal=options['compcor'] == 'temporal',
+                                            output_dir=options['compcor_dir']), records).compcor
+    outputs = _timed('ConfInvariants', ConfInvariants(pipelines=job['pipelines'],
+                                                      conf_raw=run['conf_raw'],
+                                                      conf_json=run['conf_json'],
+                                                      fmri_prep_aroma=run['fmri_prep_aroma'],
+                                                      entities=run['entities'],
+                                                      compcor=compcor), records)
+    return {'conf_invariants': outputs.conf_invariants, 'records': records}
+
+
+CHECKPOINT_KEYS = ('conf_summary', 'corr_mat', 'time_series', 'files')
+
+# Watch mode
+POLL_INTERVAL = 60
+STABLE_SECONDS = 120
+GROUP_INTERVAL = 3600
+# QC-FC correlations need at least 3 runs (of all runs and of runs included by every pipeline)
+MIN_GROUP_RUNS = 3
+RUN_FILES = ('fmri_prep', 'fmri_prep_aroma', 'brain_mask', 'conf_raw', 'conf_json')
+
+
+def process_run(job: dict) -> dict:
+    """
+    Confounds preprocessing, denoising, connectivity estimation and sinking
+    of derivatives for one (run, pipeline) pair.
+    Results are stored in checkpoint file, if checkpoint with existing
+    outputs is found processing is skipped.
+    :param job: dictionary with run, pipeline and options keys
+    :return: dictionary with outputs of run
+    """
+    run, pipeline, options = job['run'], job['pipeline'], job['options']
+    checkpoint = join(options['checkpoint_dir'], f"{run_key(run['entities'])}_pipeline-{pipeline['name']}.json")
+    if exists(checkpoint):
+        with open(checkpoint, 'r') as checkpoint_file:
+            outputs = json.load(checkpoint_file)
+        if set(CHECKPOINT_KEYS) <= set(outputs) \
+                and all(exists(path) for path in outputs['files'] + ensure_list(outputs['time_series'])
+                        if path not in outputs.get('evicted', [])):
+            outputs['records'] = []
+            if options['sink']:
+                # Store may have been removed with derivatives after checkpoint was written
+                _store_connectivity([run], pipeline, [outputs], options)
+            return outputs
+    if 'confounds' in job:
+        # Confounds already prepared by design planning (plan_designs)
+        confounds = job['confounds']
+        conf_prep, conf_summary, records = confounds['conf_prep'], confounds['conf_summary'], []
+    else:
+        confounds = prepare_confounds(job)
+        conf_prep, conf_summary, records = confounds['conf_prep'], confounds['conf_summary'], confounds['records']
+    denoise = _timed('Denoiser', Denoise(fmri_prep=run['fmri_prep'],
+                                         fmri_prep_aroma=run['fmri_prep_aroma'],
+                                         brain_mask=run['brain_mask'],
+                                         conf_prep=conf_prep,
+                                         pipeline=pipeline,
+                                         entities=run['entities'],
+                                         tr_dict=run['tr_dict'],
+                                         smoothing=options['smoothing'],
+                                         high_pass=options['high_pass'],
+                                         low_pass=options['low_pass'],
+                                         temporal_filter=options['temporal_filter'],
+                                         ica_aroma=options['ica_aroma'],
+                                         n_threads=options['denoise_threads'],
+                                         design_cache_dir=job.get('design_cache_dir', options['design_cache_dir']),
+                                         work_dir=options['work_dir'],
+                                         work_quota=options['work_quota'] or Undefined,
+                                         output_dir=options['denoise_dir']), records)
+    connectivity = _timed('ConnCalc', Connectivity(fmri_denoised=denoise.fmri_denoised,
+                                                   parcellation=options['parcellation'],
+                                                   entities=run['entities'],
+                                                   pipeline_name=pipeline['name'],
+                                                   store_dir=options['group_dir'] if options['sink'] else Undefined,
+                                                   output_dir=options['connectivity_dir']), records)
+    files = [conf_prep, denoise.fmri_denoised, *ensure_list(connectivity.corr_mat),
+             *ensure_list(connectivity.carpet_plot), *ensure_list(connectivity.matrix_plot)]
+    if options['seeds']:
+        seed_connectivity = _timed('SeedConn', SeedConnectivity(fmri_denoised=denoise.fmri_denoised,
+                                                                seeds=options['seeds'],
+                                                                seed_radius=options['seed_radius'],
+                                                                entities=run['entities'],
+                                                                pipeline_name=pipeline['name'],
+                                                                output_dir=options['seed_connectivity_dir']), records)
+        files += ensure_list(seed_connectivity.seed_maps)
+    if options['sink']:
+        _timed('ds_derivatives', BIDSDataSink(base_directory=options['bids_dir'],
+                                              in_file=files,
+                                              pipeline_name=pipeline['name'],
+                                              entities=[run['entities']] * len(files)), records)
+    evicted = []
+    if not options['keep_intermediates']:
+        # All consumers of denoised image (connectivity, seed maps, sink) have finished
+        evicted = [denoise.fmri_denoised]
+        evict(evicted)
+    outputs = {'conf_summary': conf_summary,
+               'corr_mat': connectivity.corr_mat,
+               'time_series': connectivity.time_series,
+               'files': files,
+               'evicted': evicted}
+    with open(checkpoint, 'w') as checkpoint_file:
+        json.dump(outputs, checkpoint_file, default=lambda value: value.item())  # numpy scalars
+    outputs['records'] = records
+    return outputs
+
+
+def _store_connectivity(runs: list, pipeline: dict, run_outputs: list, options: dict) -> None:
+    """Appends connectivity and time series files of runs to connectivity
+    stores of pipeline (one per parcellation)."""
+    for a, atlas_name in enumerate(options['atlas_names']):
+        append_runs(store_path(options['group_dir'], pipeline['name'], atlas_name),
+                    [run['entities'] for run in runs],
+                    [np.load(ensure_list(outputs['corr_mat'])[a]) for outputs in run_outputs],
+                    [np.load(ensure_list(outputs['time_series'])[a]) for outputs in run_outputs])
+
+
+def prepare_confounds(job: dict) -> dict:
+    """
+    Confounds preprocessing of one (run, pipeline) pair.
+    :param job: dictionary with run, pipeline and options keys
+    :return: dictionary with conf_prep, conf_summary and records keys
+    """
+    run, pipeline, options = job['run'], job['pipeline'], job['options']
+    records = []
+    confounds = _timed('ConfPrep', Confounds(pipeline=pipeline,
+                                             conf_raw=run['conf_raw'],
+                                             conf_json=run['conf_json'],
+                                             entities=run['entities'],
+                                             fmri_prep_aroma=run['fmri_prep_aroma'],
+                                             conf_invariants=run['conf_invariants'],
+                                             output_dir=options['prep_conf_dir']), records)
+    return {'conf_prep': confounds.conf_prep, 'conf_summary': confounds.conf_summary, 'records': records}
+
+
+def region_signals(job: dict) -> dict:
+    """
+    Mean signals of parcels of all parcellations of one preprocessed run
+    (parcel-space engine), cached in work dir.
+    :param job: dictionary with run and options keys
+    :return: dictionary with region_signals (path), slices and records keys
+    """
+    run, options = job['run'], job['options']
+    records = []
+    signals_file = join(options['region_signals_dir'], f"{run_key(run['entities'])}_region_signals.npz")
+    if not exists(signals_file):
+        start = _now()
+        signals, slices = extract_region_signals(run['fmri_prep'], options['parcellation'])
+        np.savez(signals_file, signals=signals, slices=[(atlas.start, atlas.stop) for atlas in slices])
+        records.append({'node_type': 'RegionSignals', 'start': start, 'finish': _now(),
+                        'blas_threads': blas_threads()})
+    with np.load(signals_file) as cached:
+        slices, n_timepoints = cached['slices'].tolist(), len(cached['signals'])
+    return {'region_signals': signals_file,
+            'slices': slices,
+            'n_timepoints': n_timepoints,
+            'records': records}
+
+
+def _read_conf_prep(conf_prep: str):
+    try:
+        return pd.read_csv(conf_prep, delimiter='\t').values
+    except pd.errors.EmptyDataError:
+        return None
+
+
+def design_sources(jobs: list, shared: dict) -> list:
+    """
+    Job of the same run and representative pipeline of design of every job
+    (see utils.pipeline_grid.shared_stages). Jobs are pipeline-major and
+    representative is the first pipeline with the design, so source of job
+    is never after the job.
+    :param jobs: (run, pipeline) jobs
+    :param shared: shared stages map of pipelines of jobs
+    :return: index of source job for each job
+    """
+    index = {(run_key(job['run']['entities']), job['pipeline']['name']): k for k, job in enumerate(jobs)}
+    return [index[(run_key(job['run']['entities']), shared[job['pipeline']['name']]['design'])] for job in jobs]
+
+
+def share_confounds(jobs: list, shared: dict, pool) -> list:
+    """
+    Confounds preprocessing of (run, pipeline) jobs planned with map of
+    stages shared between pipelines: confounds are prepared only for
+    pipelines representing distinct designs, other pipelines get link to
+    confounds of their representative (named after pipeline).
+    :param jobs: (run, pipeline) jobs
+    :param shared: shared stages map of pipelines of jobs
+    :param pool: process pool
+    :return: outputs of prepare_confounds for jobs
+    """
+    sources = design_sources(jobs, shared)
+    unique = [k for k, source in enumerate(sources) if source == k]
+    confounds = dict(zip(unique, pool.map(prepare_confounds, [jobs[k] for k in unique])))
+    for k, source in enumerate(sources):
+        if source != k:
+            src = confounds[source]['conf_prep']
+            suffix = f"_prep_pipeline-{jobs[source]['pipeline']['name']}.tsv"
+            conf_prep = src[:-len(suffix)] + f"_prep_pipeline-{jobs[k]['pipeline']['name']}.tsv"
+            link_or_copy(src, conf_prep)
+            confounds[k] = {'conf_prep': conf_prep,
+                            'conf_summary': {key: list(value) for key, value in confounds[source]['conf_summary'].items()},
+                            'records': []}
+    if len(unique) < len(jobs):
+        distinct = summarize_shared(shared)
+        logging.getLogger('nipype.workflow').info(
+            f"Shared stages: {len(shared)} pipelines with {distinct['confounds']} distinct confound sets, "
+            f"{distinct['spikes']} distinct spike settings and {distinct['design']} distinct designs, "
+            f"confounds prepared for {len(unique)} of {len(jobs)} (run, pipeline) pairs")
+    return [confounds[k] for k in range(len(jobs))]
+
+
+def plan_designs(jobs: list, confounds: list, options: dict, shared: dict = None) -> list:
+    """
+    Finds (run, pipeline) pairs solving identical denoising problem: the same
+    run, final design matrix and effective filter and smoothing settings
+    (see utils.design_dedup). Such pairs are denoised once and results are
+    fanned out to all equivalent pipelines.
+    :param jobs: (run, pipeline) jobs
+    :param confounds: outputs of prepare_confounds for jobs
+    :param shared: shared stages map of pipelines (see share_confounds),
+        pairs of pipelines with statically identical design are assigned to
+        their representative without reading confounds
+    :return: index of representative job for each job
+    """
+    sources = design_sources(jobs, shared) if shared is not None else range(len(jobs))
+    fingerprints = []
+    for k, (job, conf) in enumerate(zip(jobs, confounds)):
+        if sources[k] != k:
+            fingerprints.append(fingerprints[sources[k]])
+            continue
+        run = job['run']
+        settings = effective_settings(job['pipeline'], options['smoothing'], options['high_pass'],
+                                      options['low_pass'], options['temporal_filter'])
+        fingerprints.append(denoise_fingerprint(run['fmri_prep'], run['brain_mask'],
+                                                _read_conf_prep(conf['conf_prep']),
+                                                run['tr_dict'][run['entities']['task']], settings))
+    plan = representatives(fingerprints)
+    n_unique = len(set(plan))
+    if n_unique < len(jobs):
+        logging.getLogger('nipype.workflow').info(
+            f"Design planning: {len(jobs) - n_unique} of {len(jobs)} (run, pipeline) pairs "
+            f"share denoising problem with other pipeline, {n_unique} pairs are denoised")
+    return plan
+
+
+def cohort_denoise(runs: list, pipelines: list, options: dict, pool) -> list:
+    """
+    Parcel-space engine: instead of denoising every (run, pipeline) pair
+    voxelwise, confounds of all pipelines are regressed from parcel signals
+    of all runs at once. Pairs sharing number of timepoints, TR and filter
+    are stacked into (pairs x timepoints x parcels) tensor and cleaned with
+    batched linear algebra (utils.parcel_denoise.batched_clean), followed by
+    batched correlation of every parcellation. Pairs with identical design
+    (see plan_designs) are cleaned once.
+    Voxelwise smoothing is skipped and parcels are averaged before (not
+    after) standardization, so results approximate the voxelwise engines.
+    :param runs: runs with conf_invariants
+    :param pipelines: pipeline dictionaries
+    :param pool: process pool used for confounds and signal extraction
+    :return: list of outputs of (run, pipeline) pairs ordered as jobs of
+        process_run (pipeline-major)
+    """
+    jobs = [{'run': run, 'pipeline': pipeline, 'options': options}
+            for pipeline in pipelines for run in runs]
+    shared = shared_stages(pipelines)
+    confounds = share_confounds(jobs, shared, pool)
+    plan = plan_designs(jobs, confounds, options, shared)
+    signals = list(pool.map(region_signals, [{'run': run, 'options': options} for run in runs]))
+    slices = [slice(*atlas) for atlas in signals[0]['slices']]
+    suffixes = [atlas_suffix(name) for name in options['atlas_names']]
+    run_outputs = []
+    for job, conf in zip(jobs, confounds):
+        _, base, _ = split_filename(job['run']['fmri_prep'])
+        base = join(options['connectivity_dir'], f"{base}_denoised_pipeline-{job['pipeline']['name']}")
+        run_outputs.append({'conf_summary': conf['conf_summary'],
+                            'corr_mat': [f'{base}{suffix}_conn_mat.npy' for suffix in suffixes],
+                            'time_series': [f'{base}{suffix}_time_series.npy' for suffix in suffixes],
+                            'records': conf['records']})
+    # Pairs are grouped by shape and filter, run-major order keeps runs of batch together
+    groups = {}
+    for i, run in enumerate(runs):
+        n_timepoints = signals[i]['n_timepoints']
+        t_r = run['tr_dict'][run['entities']['task']]
+        for j, pipeline in enumerate(pipelines):
+            k = j * len(runs) + i
+            if plan[k] != k:
+                continue
+            low_pass = None if pipeline['confounds']['acompcor'] else options['low_pass']
+            groups.setdefault((n_timepoints, t_r, low_pass), []).append((i, k))
+    records = []
+    for (n_timepoints, t_r, low_pass), pairs in groups.items():
+        start = _now()
+        for batch in batches(len(pairs), n_timepoints, slices[-1].stop):
+            batch_pairs = pairs[batch]
+            run_signals = {}
+            for i in {i for i, _ in batch_pairs}:
+                with np.load(signals[i]['region_signals']) as cached:
+                    run_signals[i] = cached['signals']
+            cleaned = batched_clean(np.stack([run_signals[i] for i, _ in batch_pairs]),
+                                    pad_confounds([_read_conf_prep(confounds[k]['conf_prep'])
+                                                   for _, k in batch_pairs], n_timepoints),
+                                    t_r, options['high_pass'], low_pass, options['temporal_filter'])
+            for a, atlas in enumerate(slices):
+                # Same cleaning as Connectivity applies to extracted time series
+                time_series = batched_zscore(batched_detrend(cleaned[:, :, atlas]))
+                corr_mats = batched_correlation(time_series)
+                for (_, k), ts, corr_mat in zip(batch_pairs, time_series, corr_mats):
+                    np.save(run_outputs[k]['time_series'][a], ts)
+                    np.save(run_outputs[k]['corr_mat'][a], corr_mat)
+        records.append({'node_type': 'CohortDenoise', 'start': start, 'finish': _now(),
+                        'blas_threads': blas_threads()})
+    _log_records(records)
+    for k, representative in enumerate(plan):
+        if representative != k:
+            for key in ('time_series', 'corr_mat'):
+                for src, dst in zip(run_outputs[representative][key], run_outputs[k][key]):
+                    link_or_copy(src, dst)
+    if options['sink']:
+        for j, pipeline in enumerate(pipelines):
+            _store_connectivity(runs, pipeline, run_outputs[j * len(runs):(j + 1) * len(runs)], options)
+    for job, conf, outputs in zip(jobs, confounds, run_outputs):
+        if not options['sink']:
+            break
+        files = [conf['conf_prep'], *outputs['corr_mat']]
+        _timed('ds_derivatives', BIDSDataSink(base_directory=options['bids_dir'],
+                                              in_file=files,
+                                              pipeline_name=job['pipeline']['name'],
+                                              entities=[job['run']['entities']] * len(files)), outputs['records'])
+    for signal in signals:
+        _log_records(signal['records'])
+    return run_outputs
+
+
+def quality_measures(job: dict) -> dict:
+    """
+    Group confounds, group connectivity and quality measures of single
+    pipeline.
+    :param job: dictionary with pipeline, conf_summary, corr_mat,
+        time_series, entities and options keys
+    :return: outputs of QualityMeasures interface
+    """
+    pipeline_name, options = job['pipeline']['name'], job['options']
+    records = []
+    names = [pipeline_name] * len(job['conf_summary'])
+    group_conf = _timed('GroupConf', GroupConfounds(conf_summary=job['conf_summary'],
+                                                    pipeline_name=names,
+                                                    excluded_summary=options['excluded_summary'],
+                                                    tsv=options['tsv_tables'],
+                                                    output_dir=options['group_dir']), records)
+    group_conn = _timed('GroupConn', GroupConnectivity(corr_mat=job['corr_mat'],
+                                                       pipeline_name=names,
+                                                       atlas_names=options['atlas_names'],
+                                                       entities=job['entities'],
+                                                       store_dir=options['group_dir'],
+                                                       output_dir=options['group_dir']), records)
+    _timed('GroupConnMetrics', GroupConnectivityMetrics(time_series=job['time_series'],
+                                                        pipeline_name=names,
+                                                        atlas_names=options['atlas_names'],
+                                                        entities=job['entities'],
+                                                        store_dir=options['group_dir'],
+                                                        output_dir=options['group_dir']), records)
+    if options['dfc_window']:
+        _timed('DynamicConn', DynamicConnectivity(time_series=job['time_series'],
+                                                  pipeline_name=names,
+                                                  atlas_names=options['atlas_names'],
+                                                  entities=job['entities'],
+                                                  window=options['dfc_window'],
+                                                  step=options['dfc_step'],
+                                                  taper=options['dfc_taper'],
+                                                  store_dir=options['group_dir'],
+                                                  output_dir=options['group_dir']), records)
+    outputs = {'fc_fd_summary': [], 'edges_weight': [], 'edges_weight_clean': []}
+    # One QualityMeasures per parcellation, nested the same way as outputs of QualityMeasures MapNode
+    for group_corr_mat, distance_matrix, atlas_name in zip(ensure_list(group_conn.group_corr_mat),
+                                                           options['distance_matrix'],
+                                                           options['atlas_names']):
+        qc = _timed('QualityMeasures', QualityMeasures(group_corr_mat=group_corr_mat,
+                                                       group_conf_summary=group_conf.group_conf_summary,
+                                                       distance_matrix=distance_matrix,
+                                                       atlas_name=atlas_name,
+                                                       pipeline_name=pipeline_name,
+                                                       output_dir=options['group_dir']), records)
+        for key in outputs:
+            outputs[key].append(getattr(qc, key))
+    return {'pipeline': pipeline_name,
+            **outputs,
+            'records': records}
+
+
+def _log_records(records: list, pipeline_name: str = "") -> None:
+    """Writes records in the format of profiler_callback for profile summary."""
+    logger = logging.getLogger('callback')
+    if not logger.handlers:
+        return
+    for record in records:
+        start = datetime.datetime.fromisoformat(record['start'])
+        finish = datetime.datetime.fromisoformat(record['finish'])
+        logger.debug(json.dumps({'name': record['node_type'],
+                                 'id': record['node_type'],
+                                 'node_type': record['node_type'],
+                                 'pipeline': pipeline_name,
+                                 'start': record['start'],
+                                 'finish': record['finish'],
+                                 'duration': (finish - start).total_seconds(),
+                                 'runtime_threads': 'N/A',
+                                 'runtime_memory_gb': 'N/A',
+                                 'estimated_memory_gb': 'N/A',
+                                 'num_threads': 1,
+                                 'blas_threads': record.get('blas_threads') or 'N/A'}))
+
+
+@contextmanager
+def worker_pool(n_procs=None, cpu_budget=None, pool=None):
+    """
+    Process pool of per-run stages. BLAS/OpenMP threads of each of n_procs
+    workers are limited to cpu_budget // n_procs; batched stages in main
+    process use whole budget while workers are idle.
+    :param pool: existing pool (e.g. kept warm by daemon), returned as is
+    """
+    set_thread_limit(threads_per_worker(cpu_budget))
+    if pool is not None:
+        yield pool
+        return
+    n_workers = n_procs or available_cpus()
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             initializer=set_thread_limit,
+                             initargs=(threads_per_worker(cpu_budget, n_workers),)) as pool:
+        yield pool
+
+
+def _make_options(bids_dir, parcellation_paths, base_dir, **settings) -> dict:
+    """Options shared by per-run and group stages, creates output and work
+    directories."""
+    temps.base_dir = base_dir
+    group_dir = join(bids_dir, 'derivatives', 'denoise')
+    os.makedirs(group_dir, exist_ok=True)
+    if isinstance(parcellation_paths, str):
+        parcellation_paths = [parcellation_paths]
+    return {'bids_dir': bids_dir,
+            'group_dir': group_dir,
+            'parcellation': parcellation_paths,
+            'atlas_names': get_atlas_names(parcellation_paths),
+            'distance_matrix': [get_distance_matrix_file_path(path, group_dir) for path in parcellation_paths],
+            **settings,
+            'sink': True,
+            'work_dir': base_dir,
+            'retain_designs': False,
+            'prep_conf_dir': temps.mkdtemp(join(base_dir, 'prep_conf')),
+            'denoise_dir': temps.mkdtemp(join(base_dir, 'denoise')),
+            'design_cache_dir': temps.mkdtemp(join(base_dir, 'design_cache')),
+            'connectivity_dir': temps.mkdtemp(join(base_dir, 'connectivity')),
+            'seed_connectivity_dir': temps.mkdtemp(join(base_dir, 'seed_connectivity')),
+            'region_signals_dir': temps.mkdtemp(join(base_dir, 'region_signals')),
+            'compcor_dir': temps.mkdtemp(join(base_dir, 'compcor')),
+            'checkpoint_dir': temps.mkdtemp(join(base_dir, 'checkpoints'))}
+
+
+def _denoise_runs(runs: list, pipelines: list, options: dict, pool, parcel_space: bool) -> list:
+    """
+    Per-run stages of all (run, pipeline) pairs: pipeline independent
+    confounds measures, then confounds preprocessing, denoising and
+    connectivity (voxelwise or in parcel space).
+    :return: outputs of pairs in pipeline-major order
+    """
+    # Pipeline independent work is done once per run before fan-out over pipelines
+    pending = [run for run in runs if 'conf_invariants' not in run]
+    for run, outputs in zip(pending, pool.map(conf_invariants, [{'run': run, 'pipelines': pipelines,
+                                                                  'options': options} for run in pending])):
+        run['conf_invariants'] = outputs['conf_invariants']
+        _log_records(outputs['records'])
+    if parcel_space:
+        return cohort_denoise(runs, pipelines, options, pool)
+    jobs = [{'run': run, 'pipeline': pipeline, 'options': options}
+            for pipeline in pipelines for run in runs]
+    shared = shared_stages(pipelines)
+    for job, confounds in zip(jobs, share_confounds(jobs, shared, pool)):
+        job['confounds'] = confounds
+        _log_records(confounds['records'], job['pipeline']['name'])
+    plan = plan_designs(jobs, [job['confounds'] for job in jobs], options, shared)
+    evict_designs = not options['keep_intermediates'] and not options['retain_designs']
+    if evict_designs:
+        # Only designs shared by equivalent pairs are cached
+        group_size = Counter(plan)
+        for k, representative in enumerate(plan):
+            if group_size[representative] == 1:
+                jobs[k]['design_cache_dir'] = Undefined
+    # Representatives are denoised first, equivalent pairs then reuse cached denoised image
+    unique = [k for k, representative in enumerate(plan) if representative == k]
+    duplicates = [k for k, representative in enumerate(plan) if representative != k]
+    run_outputs = dict(zip(unique, pool.map(process_run, [jobs[k] for k in unique])))
+    run_outputs.update(zip(duplicates, pool.map(process_run, [jobs[k] for k in duplicates])))
+    if evict_designs:
+        # All equivalent pairs have linked their cached image
+        drop_unused_designs(options['design_cache_dir'])
+    return [run_outputs[k] for k in range(len(jobs))]
+
+
+def group_stages(runs: list, pipelines: list, run_outputs: list, options: dict, pool,
+                 excluded_runs: list = (), screening_trace: str = None) -> dict:
+    """
+    Group confounds, group connectivity, quality measures of every pipeline
+    (in process pool), group motion, merged QC and report.
+    :param runs: processed runs with conf_invariants
+    :param run_outputs: outputs of (run, pipeline) pairs in pipeline-major
+        order
+    :param excluded_runs: names of runs excluded by motion gate
+    :param screening_trace: decision trace of pilot screening included in
+        the report
+    :return: dictionary with group outputs (pipelines_fc_fd_summary etc.)
+    """
+    group_dir = options['group_dir']
+    qc_jobs = []
+    for i, pipeline in enumerate(pipelines):
+        pipeline_outputs = run_outputs[i * len(runs):(i + 1) * len(runs)]
+        qc_jobs.append({'pipeline': pipeline,
+                        'conf_summary': [outputs['conf_summary'] for outputs in pipeline_outputs],
+                        'corr_mat': [outputs['corr_mat'] for outputs in pipeline_outputs],
+                        'time_series': [outputs['time_series'] for outputs in pipeline_outputs],
+                        'entities': [run['entities'] for run in runs],
+                        'options': options})
+    qc_outputs = list(pool.map(quality_measures, qc_jobs))
+    for outputs in qc_outputs:
+        _log_records(outputs['records'], outputs['pipeline'])
+    records = []
+    group_motion = _timed('GroupMotion', GroupMotion(conf_invariants=[run['conf_invariants'] for run in runs],
+                                                     entities=[run['entities'] for run in runs],
+                                                     excluded_summary=options['excluded_summary'],
+                                                     tsv=options['tsv_tables'],
+                                                     output_dir=group_dir), records)
+    _log_records(records)
+    # Outputs are nested the same way as outputs of QualityMeasures MapNode
+    merge = MergeGroupQualityMeasures(fc_fd_summary=[qc['fc_fd_summary'] for qc in qc_outputs],
+                                      edges_weight=[qc['edges_weight'] for qc in qc_outputs],
+                                      edges_weight_clean=[qc['edges_weight_clean'] for qc in qc_outputs]).run().outputs
+    pipelines_qc = PipelinesQualityMeasures(fc_fd_summary=merge.fc_fd_summary,
+                                            edges_weight=merge.edges_weight,
+                                            edges_weight_clean=merge.edges_weight_clean,
+                                            atlas_names=options['atlas_names'],
+                                            tsv=options['tsv_tables'],
+                                            output_dir=group_dir).run().outputs
+    ReportCreator(pipelines=pipelines,
+                  pipelines_names=[pipeline['name'] for pipeline in pipelines],
+                  group_data_dir=group_dir,
+                  excluded_subjects=group_motion.exclude_list,
+                  motion_gated_runs=list(excluded_runs),
+                  atlas_names=options['atlas_names'],
+                  screening_trace=screening_trace or Undefined).run()
+    return {'pipelines_fc_fd_summary': pipelines_qc.pipelines_fc_fd_summary,
+            'pipelines_edges_weight': pipelines_qc.pipelines_edges_weight,
+            'pipelines_edges_weight_clean': pipelines_qc.pipelines_edges_weight_clean,
+            'report': join(group_dir, 'report.html')}
+
+
+def run_denoise(bids_dir,
+                derivatives='fmriprep',
+                parcellation_paths=get_parcelation_file_path('Schaefer2018_200Parcels_7Networks_order_FSLMNI152_1mm'),
+                task=[],
+                session=[],
+                subject=[],
+                pipelines_paths=get_pipelines_paths(),
+                smoothing=True,
+                ica_aroma=False,
+                high_pass=0.008,
+                low_pass=0.08,
+                base_dir='/tmp/Restingfmri_Denoise/',
+                n_procs=None,
+                motion_gate=False,
+                dfc_window=None,
+                dfc_step=1,
+                dfc_taper='rectangular',
+                seeds=None,
+                seed_radius=6.,
+                denoise_threads=1,
+                parcel_space=False,
+                cpu_budget=None,
+                screening_trace=None,
+                keep_intermediates=False,
+                work_quota=None,
+                tsv_tables=False,
+                compcor='fmriprep',
+                temporal_filter='butterworth',
+                pool=None
+                ) -> dict:
+    """
+    Runs denoising with the same stages and outputs as init_denoise_wf:
+    BIDSGrab -> preflight -> confounds -> denoise -> connectivity -> group QC
+    -> report, where per-run stages are executed concurrently in process pool.
+    :param n_procs: number of worker processes, by default number of cpus
+    :param motion_gate: exclude runs with high motion before denoising
+    :param dfc_window: window length (volumes) of sliding-window connectivity,
+        sliding-window connectivity is skipped if None
+    :param seeds: seed masks or coordinates ('NAME:x,y,z') of seed-to-voxel
+        correlation maps, maps are skipped if None
+    :param seed_radius: radius (mm) of seeds defined by coordinates
+    :param denoise_threads: number of threads of each Denoise job
+    :param parcel_space: denoise parcel signals of all runs and pipelines at
+        once with batched regression (see cohort_denoise) instead of
+        denoising every (run, pipeline) pair voxelwise
+    :param cpu_budget: number of cores shared by all workers, BLAS/OpenMP
+        threads of each worker are limited to cpu_budget // n_procs, by
+        default all available cpus
+    :param screening_trace: decision trace of pilot screening
+        (screen_pipelines) included in the report
+    :param keep_intermediates: keep denoised images and design cache in
+        work dir, by default images are evicted once connectivity, seed maps
+        and sink are done
+    :param work_quota: quota of work dir in GB, denoising jobs wait while
+        running jobs would exceed it (see utils.lifecycle)
+    :param tsv_tables: also export group-level tables as TSV (they are saved
+        as binary .npz columns, see utils.tables)
+    :param compcor: source of aCompCor components: 'fmriprep' columns or
+        components computed from BOLD, 'anatomical' (WM and CSF) or
+        'temporal' (also tCompCor), see utils.compcor
+    :param temporal_filter: temporal filter engine, 'butterworth' (nilearn)
+        or 'fft' (precomputed frequency response applied with real FFTs to
+        signals and confounds, see utils.temporal_filter)
+    :param pool: process pool kept by caller (e.g. daemon), by default pool
+        of n_procs workers is created for the run
+    :return: dictionary with group outputs (pipelines_fc_fd_summary etc.)
+    """
+    if parcel_space and seeds:
+        raise ValueError("Seed-to-voxel maps require voxelwise denoising, they are not available in parcel space")
+    options = _make_options(bids_dir, parcellation_paths, base_dir,
+                            dfc_window=dfc_window,
+                            dfc_step=dfc_step,
+                            dfc_taper=dfc_taper,
+                            seeds=seeds,
+                            seed_radius=seed_radius,
+                            denoise_threads=denoise_threads,
+                            smoothing=smoothing,
+                            ica_aroma=ica_aroma,
+                            high_pass=high_pass,
+                            low_pass=low_pass,
+                            keep_intermediates=keep_intermediates,
+                            work_quota=work_quota,
+                            tsv_tables=tsv_tables,
+                            compcor=compcor,
+                            temporal_filter=temporal_filter)
+    pipelines = load_pipelines(pipelines_paths)
+    runs = grab_runs(bids_dir, derivatives, task, session, subject, ica_aroma)
+    preflight(runs, pipelines, options['parcellation'], compcor=options['compcor'])
+    options['excluded_summary'], excluded_runs = [], []
+    if motion_gate:
+        runs, options['excluded_summary'], excluded_runs = gate_runs(runs)
+    with worker_pool(n_procs, cpu_budget, pool) as pool:
+        run_outputs = _denoise_runs(runs, pipelines, options, pool, parcel_space)
+        for i, pipeline in enumerate(pipelines):
+            for outputs in run_outputs[i * len(runs):(i + 1) * len(runs)]:
+                _log_records(outputs['records'], pipeline['name'])
+        return group_stages(runs, pipelines, run_outputs, options, pool, excluded_runs, screening_trace)
+
+
+def screen_pipelines(bids_dir,
+                     derivatives='fmriprep',
+                     parcellation_paths=get_parcelation_file_path('Schaefer2018_200Parcels_7Networks_order_FSLMNI152_1mm'),
+                     task=[],
+                     session=[],
+                     subject=[],
+                     pipelines_paths=get_pipelines_paths(),
+                     smoothing=True,
+                     ica_aroma=False,
+                     high_pass=0.008,
+                     low_pass=0.08,
+                     base_dir='/tmp/Restingfmri_Denoise/',
+                     n_procs=None,
+                     motion_gate=False,
+                     denoise_threads=1,
+                     parcel_space=False,
+                     cpu_budget=None,
+                     pilot_size=20,
+                     pilot_strategy='stratified',
+                     n_bootstrap=N_BOOTSTRAP,
+                     seed=0,
+                     keep_intermediates=False,
+                     work_quota=None,
+                     tsv_tables=False,
+                     compcor='fmriprep',
+                     temporal_filter='butterworth',
+                     pool=None) -> tuple:
+    """
+    Pilot screening of pipelines: all pipelines are run on pilot sample of
+    runs, bootstrap confidence intervals of QC measures are estimated and
+    pipelines clearly dominated by other pipeline are pruned (see
+    utils.screening). Pilot outputs are not sunk to derivatives; denoised
+    images of pilot runs are retained in design cache and reused by the full
+    run (unused entries are dropped by the full run or under work quota).
+    :param pilot_size: number of pilot runs
+    :param pilot_strategy: 'stratified' (by mean FD) or 'random'
+    :param n_bootstrap: number of bootstrap resamples
+    :param seed: seed of pilot sampling and bootstrap
+    :param pool: process pool kept by caller, see run_denoise
+    :return: tuple with list of paths of kept pipelines and path to decision
+        trace (pipelines_screening.npz in group directory)
+    """
+    options = _make_options(bids_dir, parcellation_paths, base_dir,
+                            dfc_window=None,
+                            seeds=None,
+                            denoise_threads=denoise_threads,
+                            smoothing=smoothing,
+                            ica_aroma=ica_aroma,
+                            high_pass=high_pass,
+                            low_pass=low_pass,
+                            keep_intermediates=keep_intermediates,
+                            work_quota=work_quota,
+                            tsv_tables=tsv_tables,
+                            compcor=compcor,
+                            temporal_filter=temporal_filter)
+    options['sink'] = False
+    options['retain_designs'] = True
+    options['checkpoint_dir'] = temps.mkdtemp(join(base_dir, 'screening'))
+    paths = {}
+    for path in pipelines_paths:
+        paths[load_pipeline_from_json(path)['name']] = path
+    pipelines = load_pipelines(pipelines_paths)
+    runs = grab_runs(bids_dir, derivatives, task, session, subject, ica_aroma)
+    preflight(runs, pipelines, options['parcellation'], compcor=options['compcor'])
+    if motion_gate:
+        runs, _, _ = gate_runs(runs)
+    with worker_pool(n_procs, cpu_budget, pool) as pool:
+        for run, outputs in zip(runs, pool.map(conf_invariants, [{'run': run, 'pipelines': pipelines,
+                                                                   'options': options} for run in runs])):
+            run['conf_invariants'] = outputs['conf_invariants']
+            _log_records(outputs['records'])
+        pilot = [runs[i] for i in pilot_sample([run['conf_invariants']['mean_fd'] for run in runs],
+                                               pilot_size, pilot_strategy, seed)]
+        logging.getLogger('nipype.workflow').info(
+            f"Pipeline screening: {len(pipelines)} pipelines on {len(pilot)} of {len(runs)} runs")
+        run_outputs = _denoise_runs(pilot, pipelines, options, pool, parcel_space)
+    mean_fd = [run['conf_invariants']['mean_fd'] for run in pilot]
+    distance_vectors = [sym_matrix_to_vec(np.load(path)) for path in options['distance_matrix']]
+    qc = {}
+    for i, pipeline in enumerate(pipelines):
+        pipeline_outputs = run_outputs[i * len(pilot):(i + 1) * len(pilot)]
+        n_conf = [outputs['conf_summary']['n_conf'][0] for outputs in pipeline_outputs]
+        qc[pipeline['name']] = [
+            bootstrap_qc(np.stack([sym_matrix_to_vec(np.load(ensure_list(outputs['corr_mat'])[a]))
+                                   for outputs in pipeline_outputs]),
+                         mean_fd, n_conf, distance_vector, n_bootstrap, seed)
+            for a, distance_vector in enumerate(distance_vectors)]
+    pruned = prune_dominated(qc)
+    trace = save_table(screening_trace(qc, pruned, options['atlas_names'], len(pilot)),
+                       join(options['group_dir'], 'pipelines_screening'), options['tsv_tables'])
+    logging.getLogger('nipype.workflow').info(
+        f"Pipeline screening: {len(pruned)} of {len(pipelines)} pipelines pruned")
+    return [paths[pipeline['name']] for pipeline in pipelines if pipeline['name'] not in pruned], trace
+
+
+def file_signature(run: dict) -> tuple:
+    """Size and modification time of every file of run (brain mask is
+    optional).
+    :raises OSError: if file is removed or renamed
+    """
+    return tuple((os.path.getsize(run[name]), os.path.getmtime(run[name])) for name in RUN_FILES if run[name])
+
+
+def stable_runs(runs: list, signatures: dict, stable_seconds: float, now: float) -> list:
+    """
+    Selects runs whose files are completely written: size and modification
+    time of every file are the same as in previous poll and the newest file
+    is at least stable_seconds old.
+    :param runs: output of grab_runs
+    :param signatures: run key to file signatures of previous poll, updated
+        in place
+    :param now: time of current poll (time.time())
+    :return: list of completed runs
+    """
+    completed = []
+    for run in runs:
+        key = run_key(run['entities'])
+        try:
+            signature = file_signature(run)
+        except OSError:  # file removed or renamed while being written
+            signatures.pop(key, None)
+            continue
+        if signatures.get(key) == signature and now - max(mtime for _, mtime in signature) >= stable_seconds:
+            completed.append(run)
+        signatures[key] = signature
+    return completed
+
+
+def changed_runs(runs: list, failed: dict) -> list:
+    """
+    Runs which failed in watch mode and whose files have changed since
+    (e.g. fMRIPrep was rerun), removed from failed to be retried.
+    :param runs: output of grab_runs
+    :param failed: run key to file signature at failure, updated in place
+    :return: keys of runs to retry
+    """
+    retry = []
+    for run in runs:
+        key = run_key(run['entities'])
+        if key not in failed:
+            continue
+        try:
+            signature = file_signature(run)
+        except OSError:
+            continue
+        if signature != failed[key]:
+            del failed[key]
+            retry.append(key)
+    return retry
+
+
+def _mark_failed(runs: list, failed: dict, reason: str) -> None:
+    for run in runs:
+        try:
+            failed[run_key(run['entities'])] = file_signature(run)
+        except OSError:  # retried as soon as files are complete again
+            failed[run_key(run['entities'])] = None
+        logging.getLogger('nipype.workflow').error(
+            f"Watch: run {run_key(run['entities'])} skipped, it is retried when its files change: {reason}")
+
+
+def _preflight_watched(runs: list, pipelines: list, options: dict, failed: dict) -> list:
+    """Preflight of runs found by watch, runs with errors are reported and
+    marked as failed instead of stopping the watcher.
+    :return: runs which passed preflight
+    """
+    try:
+        preflight(runs, pipelines, options['parcellation'], compcor=options['compcor'])
+        return runs
+    except PreflightError as err:
+        errors = err.report[err.report.severity == 'error'] if err.report is not None else None
+        failing = set(errors.run) if errors is not None else {run_label(run['entities']) for run in runs}
+        logging.getLogger('nipype.workflow').error(f"Watch: {err}")
+        _mark_failed([run for run in runs if run_label(run['entities']) in failing], failed, "preflight failed")
+        return [run for run in runs if run_label(run['entities']) not in failing]
+
+
+def _denoise_watched(runs: list, pipelines: list, options: dict, pool, parcel_space: bool, failed: dict) -> tuple:
+    """Per-run stages of runs found by watch. Failing batch is retried run
+    by run, so one run that cannot be processed does not stop the watcher;
+    runs failing alone are marked as failed.
+    :return: processed runs and their outputs in pipeline-major order
+    """
+    try:
+        return runs, _denoise_runs(runs, pipelines, options, pool, parcel_space)
+    except Exception as err:
+        if len(runs) == 1:
+            _mark_failed(runs, failed, repr(err))
+            return [], []
+    processed, run_outputs = [], []
+    for run in runs:
+        done, outputs = _denoise_watched([run], pipelines, options, pool, parcel_space, failed)
+        processed += done
+        if done:
+            run_outputs.append(outputs)
+    return processed, [outputs[i] for i in range(len(pipelines)) for outputs in run_outputs]
+
+
+def included_runs(runs: list, pipelines: list, pair_outputs: dict) -> int:
+    """Smallest number of runs included (not excluded for high motion) by
+    any pipeline, i.e. size of the smallest 'No_high_motion' sample of
+    QualityMeasures."""
+    return min(sum(int(pair_outputs[run_key(run['entities']), pipeline['name']]['conf_summary']['include'][0])
+                   for run in runs)
+               for pipeline in pipelines)
+
+
+def _group_watched(runs: list, pipelines: list, pair_outputs: dict, options: dict, pool,
+                   excluded_runs: list) -> bool:
+    """Group stages of runs processed by watch, errors are reported instead
+    of stopping the watcher.
+    :return: True if group QC and report were refreshed
+    """
+    try:
+        group_stages(runs, pipelines,
+                     [pair_outputs[run_key(run['entities']), pipeline['name']]
+                      for pipeline in pipelines for run in runs],
+                     options, pool, excluded_runs)
+    except Exception:
+        logging.getLogger('nipype.workflow').error(
+            f"Watch: group QC of {len(runs)} runs failed, retried after next group interval\n"
+            f"{traceback.format_exc()}")
+        return False
+    logging.getLogger('nipype.workflow').info(f"Watch: group QC refreshed with {len(runs)} runs")
+    return True
+
+
+def watch_denoise(bids_dir,
+                  derivatives='fmriprep',
+                  parcellation_paths=get_parcelation_file_path('Schaefer2018_200Parcels_7Networks_order_FSLMNI152_1mm'),
+                  task=[],
+                  session=[],
+                  subject=[],
+                  pipelines_paths=get_pipelines_paths(),
+                  smoothing=True,
+                  ica_aroma=False,
+                  high_pass=0.008,
+                  low_pass=0.08,
+                  base_dir='/tmp/Restingfmri_Denoise/',
+                  n_procs=None,
+                  motion_gate=False,
+                  dfc_window=None,
+                  dfc_step=1,
+                  dfc_taper='rectangular',
+                  seeds=None,
+                  seed_radius=6.,
+                  denoise_threads=1,
+                  parcel_space=False,
+                  cpu_budget=None,
+                  poll_interval=POLL_INTERVAL,
+                  stable_seconds=STABLE_SECONDS,
+                  group_interval=GROUP_INTERVAL,
+                  exit_idle=None,
+                  keep_intermediates=False,
+                  work_quota=None,
+                  tsv_tables=False,
+                  compcor='fmriprep',
+                  temporal_filter='butterworth',
+                  pool=None) -> dict:
+    """
+    Long-running variant of run_denoise. Derivatives are polled every
+    poll_interval seconds; runs with all files present (BIDSGrab with
+    skip_incomplete) and stable (see stable_runs) are queued through the
+    per-run stages, group QC and report are refreshed at most every
+    group_interval seconds when new runs were processed. Per-run results are
+    checkpointed, so restarted watch skips runs processed before.
+    :param poll_interval: seconds between polls of derivatives
+    :param stable_seconds: minimal age (seconds) of files of completed run
+    :param group_interval: minimal number of seconds between group refreshes
+    :param exit_idle: stop after no new run was found for exit_idle seconds
+        (group QC is refreshed before exit), by default watch runs until
+        interrupted
+    Other parameters are the same as in run_denoise.
+    :return: dictionary with number of processed runs and path to report
+    """
+    if parcel_space and seeds:
+        raise ValueError("Seed-to-voxel maps require voxelwise denoising, they are not available in parcel space")
+    options = _make_options(bids_dir, parcellation_paths, base_dir,
+                            dfc_window=dfc_window,
+                            dfc_step=dfc_step,
+                            dfc_taper=dfc_taper,
+                            seeds=seeds,
+                            seed_radius=seed_radius,
+                            denoise_threads=denoise_threads,
+                            smoothing=smoothing,
+                            ica_aroma=ica_aroma,
+                            high_pass=high_pass,
+                            low_pass=low_pass,
+                            keep_intermediates=keep_intermediates,
+                            work_quota=work_quota,
+                            tsv_tables=tsv_tables,
+                            compcor=compcor,
+                            temporal_filter=temporal_filter)
+    options['excluded_summary'], excluded_runs = [], []
+    pipelines = load_pipelines(pipelines_paths)
+    runs, pair_outputs, signatures, seen, failed = [], {}, {}, set(), {}
+    last_group, pending_group, last_new = None, False, time.time()
+    with worker_pool(n_procs, cpu_budget, pool) as pool:
+        while True:
+            now = time.time()
+            grabbed = grab_runs(bids_dir, derivatives, task, session, subject, ica_aroma, skip_incomplete=True)
+            seen.difference_update(changed_runs(grabbed, failed))
+            found = [run for run in grabbed if run_key(run['entities']) not in seen]
+            new = stable_runs(found, signatures, stable_seconds, now)
+            if new:
+                seen.update(run_key(run['entities']) for run in new)
+                last_new = now
+                new = _preflight_watched(new, pipelines, options, failed)
+                if motion_gate:
+                    new, excluded_summary, excluded = gate_runs(new)
+                    options['excluded_summary'] += excluded_summary
+                    excluded_runs += excluded
+                new, run_outputs = _denoise_watched(new, pipelines, options, pool, parcel_space, failed) \
+                    if new else ([], [])
+                for i, pipeline in enumerate(pipelines):
+                    for run, outputs in zip(new, run_outputs[i * len(new):(i + 1) * len(new)]):
+                        pair_outputs[run_key(run['entities']), pipeline['name']] = outputs
+                        _log_records(outputs['records'], pipeline['name'])
+                runs += new
+                pending_group = True
+                logging.getLogger('nipype.workflow').info(
+                    f"Watch: {len(new)} new runs processed, {len(runs)} runs in total")
+            idle = exit_idle is not None and now - last_new >= exit_idle
+            if pending_group and len(runs) >= MIN_GROUP_RUNS \
+                    and included_runs(runs, pipelines, pair_outputs) >= MIN_GROUP_RUNS \
+                    and (idle or last_group is None or now - last_group >= group_interval):
+                # Failed refresh stays pending and is retried after group_interval
+                pending_group = not _group_watched(runs, pipelines, pair_outputs, options, pool, excluded_runs)
+                last_group = now
+            if idle:
+                break
+            time.sleep(poll_interval)
+    return {'runs': len(runs),
+            'report': join(options['group_dir'], 'report.html')}
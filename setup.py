@@ -29,5 +29,8 @@ if __name__ == '__main__':
                                                    '*build_tests*']),
         include_package_data=True,
         install_requires=requirements,
-        scripts=[join('RestingfMRI_Denoise', 'scripts', 'RestingfMRI_Denoise')]
+        scripts=[join('RestingfMRI_Denoise', 'scripts', 'RestingfMRI_Denoise'),
+                 join('RestingfMRI_Denoise', 'scripts', 'RestingfMRI_Denoise_profile'),
+                 join('RestingfMRI_Denoise', 'scripts', 'RestingfMRI_Denoise_daemon'),
+                 join('RestingfMRI_Denoise', 'scripts', 'RestingfMRI_Denoise_submit')]
     )
@@ -0,0 +1,18 @@
+import gzip
+import pytest
+
+
+@pytest.fixture
+def decompressed_bytes(monkeypatch):
+    """Counts bytes decompressed from all gzip files (also those skipped by
+    seek, which decompresses from the start of file when seeking back)."""
+    counter = {'bytes': 0}
+    read = gzip._GzipReader.read
+
+    def counting_read(self, *args, **kwargs):
+        chunk = read(self, *args, **kwargs)
+        counter['bytes'] += len(chunk)
+        return chunk
+
+    monkeypatch.setattr(gzip._GzipReader, 'read', counting_read)
+    return counter
@@ -0,0 +1,18 @@
+import numpy as np
+import nibabel as nb
+
+from RestingfMRI_Denoise.utils.compcor import masked_time_series
+
+
+def test_masked_time_series_reads_gzipped_image_once(tmp_path, decompressed_bytes):
+    rng = np.random.default_rng(8)
+    data = rng.standard_normal((10, 9, 8, 60)).astype(np.float32)
+    path = str(tmp_path / 'bold.nii.gz')
+    nb.Nifti1Image(data, np.eye(4)).to_filename(path)
+    masks = [rng.random(data.shape[:3]) < .3, rng.random(data.shape[:3]) < .1]
+    # Blocks of one volume, so image is read in many blocks
+    series = masked_time_series(nb.load(path, keep_file_open=True), masks, chunk_mb=0)
+    # Header is also read (in buffered blocks) when image is loaded, every further pass would add data.nbytes
+    assert decompressed_bytes['bytes'] < 1.5 * data.nbytes
+    for time_series, mask in zip(series, masks):
+        np.testing.assert_array_equal(time_series, data[mask].T)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from nilearn.connectome import ConnectivityMeasure
+
+from RestingfMRI_Denoise.utils.connectivity_metrics import (
+    METRICS, TRIU_OFFSET, connectivity_metrics, to_upper_triangle, from_upper_triangle)
+
+
+@pytest.fixture
+def time_series():
+    rng = np.random.default_rng(0)
+    mixing = rng.standard_normal((8, 8))
+    # Runs of different length, as runs with different number of volumes in one group
+    return [rng.standard_normal((n_timepoints, 8)) @ mixing for n_timepoints in (120, 150, 90, 200)]
+
+
+@pytest.mark.parametrize('metric', METRICS)
+def test_metrics_match_nilearn(time_series, metric):
+    expected = ConnectivityMeasure(kind=metric.replace('_', ' ')).fit_transform(time_series)
+    matrices = connectivity_metrics(time_series, [metric])
+    np.testing.assert_allclose(matrices[metric], expected, atol=1e-8)
+
+
+def test_tangent_mean_matches_nilearn(time_series):
+    measure = ConnectivityMeasure(kind='tangent')
+    measure.fit_transform(time_series)
+    np.testing.assert_allclose(connectivity_metrics(time_series, ['tangent'])['tangent_mean'],
+                               measure.mean_, atol=1e-8)
+
+
+def test_unknown_metric_raises(time_series):
+    with pytest.raises(ValueError):
+        connectivity_metrics(time_series, ['coherence'])
+
+
+@pytest.mark.parametrize('metric', METRICS)
+def test_upper_triangle_round_trip(time_series, metric):
+    matrices = connectivity_metrics(time_series, [metric])[metric]
+    vectors = to_upper_triangle(matrices, TRIU_OFFSET[metric])
+    restored = from_upper_triangle(vectors, matrices.shape[1], offset=TRIU_OFFSET[metric])
+    np.testing.assert_allclose(restored, matrices.astype(np.float32), atol=1e-6)
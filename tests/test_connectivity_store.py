@@ -0,0 +1,66 @@
+import numpy as np
+import h5py
+import pytest
+
+from RestingfMRI_Denoise.utils.connectivity_store import (
+    append_runs, read_connectivity, read_index, read_time_series, read_n_regions)
+
+ENTITIES = [{'subject': '01', 'session': '1', 'task': 'rest'},
+            {'subject': '02', 'task': 'rest'},
+            {'subject': '03', 'session': '1', 'task': 'rest'}]
+
+
+@pytest.fixture
+def runs():
+    rng = np.random.default_rng(6)
+    time_series = [rng.standard_normal((n_volumes, 5)) for n_volumes in (60, 45, 80)]
+    return time_series, [np.corrcoef(run_time_series.T) for run_time_series in time_series]
+
+
+def test_round_trip(tmp_path, runs):
+    time_series, corr_mats = runs
+    path = str(tmp_path / 'store.h5')
+    append_runs(path, ENTITIES[:2], corr_mats[:2], time_series[:2])
+    append_runs(path, ENTITIES[2:], corr_mats[2:], time_series[2:])
+    assert read_n_regions(path) == 5
+    assert read_index(path)['subject'].tolist() == ['01', '02', '03']
+    # Selected runs in requested order
+    selected = [ENTITIES[2], ENTITIES[0]]
+    np.testing.assert_allclose(read_connectivity(path, selected, matrices=True),
+                               [corr_mats[2], corr_mats[0]], atol=1e-6)
+    for stored, expected in zip(read_time_series(path, selected), [time_series[2], time_series[0]]):
+        np.testing.assert_allclose(stored, expected, atol=1e-6)
+
+
+def test_missing_run_raises(tmp_path, runs):
+    time_series, corr_mats = runs
+    path = str(tmp_path / 'store.h5')
+    append_runs(path, ENTITIES[:1], corr_mats[:1], time_series[:1])
+    with pytest.raises(KeyError):
+        read_connectivity(path, ENTITIES[1:2])
+
+
+def test_append_is_idempotent(tmp_path, runs):
+    time_series, corr_mats = runs
+    path = str(tmp_path / 'store.h5')
+    for _ in range(3):
+        append_runs(path, ENTITIES, corr_mats, time_series)
+    with h5py.File(path, 'r') as store:
+        assert store['conn'].shape[0] == len(ENTITIES)
+        assert store['time_series'].shape[0] == sum(len(run_time_series) for run_time_series in time_series)
+
+
+def test_rerun_replaces_run(tmp_path, runs):
+    time_series, corr_mats = runs
+    path = str(tmp_path / 'store.h5')
+    append_runs(path, ENTITIES, corr_mats, time_series)
+    # Shorter rerun reuses segment of the run
+    shorter = time_series[0][:30]
+    append_runs(path, ENTITIES[:1], [np.corrcoef(shorter.T)], [shorter])
+    stored = read_time_series(path)
+    np.testing.assert_allclose(stored[0], shorter, atol=1e-6)
+    for run_stored, run_time_series in zip(stored[1:], time_series[1:]):
+        np.testing.assert_allclose(run_stored, run_time_series, atol=1e-6)
+    with h5py.File(path, 'r') as store:
+        assert store['conn'].shape[0] == len(ENTITIES)
+        assert store['time_series'].shape[0] == sum(len(run_time_series) for run_time_series in time_series)
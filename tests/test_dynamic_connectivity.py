@@ -0,0 +1,66 @@
+import numpy as np
+import h5py
+import pytest
+
+from RestingfMRI_Denoise.utils.dynamic_connectivity import (
+    get_taper, sliding_window_correlation, save_dynamic_connectivity)
+
+
+def weighted_corrcoef(window_series, weights):
+    """Weighted Pearson correlation of columns computed directly."""
+    weights = weights / weights.sum()
+    centered = window_series - weights @ window_series
+    cov = (centered * weights[:, np.newaxis]).T @ centered
+    sd = np.sqrt(np.diag(cov))
+    return cov / np.outer(sd, sd)
+
+
+@pytest.fixture
+def time_series():
+    rng = np.random.default_rng(1)
+    return rng.standard_normal((100, 6)) @ rng.standard_normal((6, 6)) + 50.
+
+
+@pytest.mark.parametrize('window, step', [(20, 1), (30, 7), (100, 1)])
+def test_rectangular_windows_match_corrcoef(time_series, window, step):
+    dfc = sliding_window_correlation(time_series, window, step)
+    rows, cols = np.triu_indices(time_series.shape[1], k=1)
+    starts = range(0, len(time_series) - window + 1, step)
+    expected = np.array([np.corrcoef(time_series[start:start + window].T)[rows, cols] for start in starts])
+    assert dfc.shape == expected.shape
+    np.testing.assert_allclose(dfc, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('taper', ['hamming', 'hann'])
+def test_tapered_windows_match_weighted_correlation(time_series, taper):
+    window, step = 24, 5
+    weights = get_taper(window, taper)
+    dfc = sliding_window_correlation(time_series, window, step, taper)
+    rows, cols = np.triu_indices(time_series.shape[1], k=1)
+    starts = range(0, len(time_series) - window + 1, step)
+    expected = np.array([weighted_corrcoef(time_series[start:start + window], weights)[rows, cols]
+                         for start in starts])
+    np.testing.assert_allclose(dfc, expected, atol=1e-5)
+
+
+def test_window_longer_than_run_raises(time_series):
+    with pytest.raises(ValueError):
+        sliding_window_correlation(time_series, len(time_series) + 1)
+
+
+def test_runs_are_written_as_generated(tmp_path, time_series):
+    runs = ['sub-01_task-rest', 'sub-02_task-rest']
+    dfc_runs = [sliding_window_correlation(time_series[:n_timepoints], 20, 4) for n_timepoints in (100, 80)]
+    fname = save_dynamic_connectivity(str(tmp_path / 'dfc.h5'), runs, iter(dfc_runs), 20, 4, 'rectangular',
+                                      time_series.shape[1])
+    with h5py.File(fname, 'r') as store:
+        assert store.attrs['n_regions'] == time_series.shape[1]
+        for row, (run, dfc) in enumerate(zip(runs, dfc_runs)):
+            np.testing.assert_array_equal(store[f'runs/{run}/dfc'][:], dfc)
+            np.testing.assert_allclose(store['edge_mean'][row], dfc.mean(axis=0), atol=1e-6)
+
+
+def test_no_runs(tmp_path):
+    fname = save_dynamic_connectivity(str(tmp_path / 'dfc.h5'), [], iter([]), 20, 4, 'rectangular', 6)
+    with h5py.File(fname, 'r') as store:
+        assert store['edge_mean'].shape == (0, 15)
@@ -0,0 +1,25 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from RestingfMRI_Denoise.interfaces.confounds import GroupMotion
+from RestingfMRI_Denoise.utils import plotting
+
+
+def conf_invariants(mean_fd, max_fd, n_spikes):
+    return {'mean_fd': mean_fd, 'max_fd': max_fd, 'n_timepoints': 100, 'n_spikes': n_spikes}
+
+
+def test_exclude_list_holds_high_motion_runs(tmp_path, monkeypatch):
+    # Plot style of motion_plot is missing in recent matplotlib
+    monkeypatch.setattr(plotting, 'motion_plot', lambda summary: plt.figure())
+    group_motion = GroupMotion(
+        conf_invariants=[conf_invariants(0.05, 0.5, {'24HMP_8Phys': 0, '24HMP_8Phys_spikes': 5}),
+                         conf_invariants(0.6, 3.5, {'24HMP_8Phys': 0, '24HMP_8Phys_spikes': 30}),
+                         # Too many spikes for one pipeline only
+                         conf_invariants(0.1, 1., {'24HMP_8Phys': 0, '24HMP_8Phys_spikes': 45})],
+        entities=[{'subject': '01', 'task': 'rest'}, {'subject': '02', 'task': 'rest'},
+                  {'subject': '03', 'task': 'rest'}],
+        output_dir=str(tmp_path))
+    results = group_motion.run(cwd=str(tmp_path)).outputs
+    assert results.exclude_list == ['sub-02', 'sub-03']
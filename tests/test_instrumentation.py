@@ -0,0 +1,26 @@
+import json
+
+import numpy as np
+
+from RestingfMRI_Denoise.utils.instrumentation import StageRecorder, enable_stage_log, disable_stage_log
+
+
+def test_peak_is_measured_per_stage(tmp_path):
+    path = str(tmp_path / 'stages.jsonl')
+    recorder = StageRecorder('Denoise', {'subject': '01'}, pipeline='24HMP_8Phys')
+    enable_stage_log(path)
+    try:
+        with recorder.stage('large'):
+            data = np.ones(256 * 2 ** 20 // 8)
+        del data
+        with recorder.stage('small'):
+            np.ones(1000).sum()
+    finally:
+        disable_stage_log()
+    with open(path) as log:
+        large, small = [json.loads(line) for line in log]
+    assert large['peak_rss_mb'] - large['rss_start_mb'] > 200
+    # Same worker, but memory of the previous stage is not attributed to this one
+    assert small['peak_rss_mb'] < large['peak_rss_mb'] - 200
+    assert small['process_peak_rss_mb'] >= large['peak_rss_mb'] - 1
+    assert small['subject'] == '01' and small['pipeline'] == '24HMP_8Phys'
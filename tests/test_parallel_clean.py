@@ -0,0 +1,51 @@
+import numpy as np
+import nibabel as nb
+import pytest
+from nilearn import signal
+
+from RestingfMRI_Denoise.utils import parallel_clean
+from RestingfMRI_Denoise.utils.parallel_clean import clean_img_chunked
+
+CLEAN_KWARGS = {'t_r': 2., 'high_pass': 0.01, 'low_pass': 0.1}
+
+
+@pytest.fixture
+def img():
+    rng = np.random.default_rng(2)
+    data = (rng.standard_normal((6, 5, 4, 80)) + 100.).astype(np.float32)
+    return nb.Nifti1Image(data, np.diag([3., 3., 3., 1.]))
+
+
+@pytest.fixture
+def confounds():
+    return np.random.default_rng(3).standard_normal((80, 3))
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # Many chunks per image, so chunking and threads are exercised on small data
+    monkeypatch.setattr(parallel_clean, 'VOXELS_CHUNK', 7)
+
+
+@pytest.mark.parametrize('temporal_filter', ['butterworth', 'fft'])
+def test_threads_give_identical_images(img, confounds, temporal_filter):
+    single = clean_img_chunked(img, confounds, n_threads=1, temporal_filter=temporal_filter, **CLEAN_KWARGS)
+    threaded = clean_img_chunked(img, confounds, n_threads=4, temporal_filter=temporal_filter, **CLEAN_KWARGS)
+    np.testing.assert_array_equal(np.asanyarray(single.dataobj), np.asanyarray(threaded.dataobj))
+
+
+def test_chunks_match_cleaning_all_voxels(img, confounds):
+    cleaned = clean_img_chunked(img, confounds, n_threads=4, **CLEAN_KWARGS)
+    signals = np.asanyarray(img.dataobj).reshape(-1, img.shape[3]).T.astype(np.float64)
+    expected = signal.clean(signals, confounds=confounds, detrend=True, standardize=True, **CLEAN_KWARGS)
+    np.testing.assert_allclose(np.asanyarray(cleaned.dataobj).reshape(-1, img.shape[3]).T, expected, atol=1e-5)
+
+
+def test_mask_gives_unmasked_signals_in_mask(img, confounds):
+    mask = np.zeros(img.shape[:3], dtype=bool)
+    mask[1:5, 1:4, :3] = True
+    masked = np.asanyarray(clean_img_chunked(img, confounds, n_threads=4, mask=mask, **CLEAN_KWARGS).dataobj)
+    unmasked = np.asanyarray(clean_img_chunked(img, confounds, n_threads=4, **CLEAN_KWARGS).dataobj)
+    np.testing.assert_allclose(masked[mask], unmasked[mask], atol=1e-6)
+    assert not masked[~mask].any()
+    assert masked.dtype == unmasked.dtype == np.float32
@@ -0,0 +1,53 @@
+import pytest
+
+from RestingfMRI_Denoise.utils.json_validator import is_valid
+from RestingfMRI_Denoise.utils.pipeline_grid import expand_grid, shared_stages, summarize_shared
+
+SPIKES_GRID = {"name": "24HMP_8Phys_spikes-FD{spikes.fd_th}_DVARS{spikes.dvars_th}",
+               "base": "pipeline-24HMP_8Phys",
+               "grid": {"spikes.fd_th": [0.2, 0.5], "spikes.dvars_th": [0, 3]}}
+
+
+def test_expand_grid_is_cartesian_product():
+    pipelines = expand_grid(SPIKES_GRID)
+    assert [pipeline['name'] for pipeline in pipelines] == [
+        '24HMP_8Phys_spikes-FD2_DVARS0', '24HMP_8Phys_spikes-FD2_DVARS3',
+        '24HMP_8Phys_spikes-FD5_DVARS0', '24HMP_8Phys_spikes-FD5_DVARS3']
+    assert [pipeline['spikes'] for pipeline in pipelines] == [
+        {'fd_th': 0.2, 'dvars_th': 0}, {'fd_th': 0.2, 'dvars_th': 3},
+        {'fd_th': 0.5, 'dvars_th': 0}, {'fd_th': 0.5, 'dvars_th': 3}]
+    assert all(is_valid(pipeline) for pipeline in pipelines)
+
+
+def test_parameters_missing_in_name_are_appended():
+    pipelines = expand_grid({"name": "8Phys", "base": "pipeline-24HMP_8Phys",
+                             "grid": {"confounds.gs": [False, {"temp_deriv": True, "quad_terms": False}]}})
+    assert [pipeline['name'] for pipeline in pipelines] == ['8Phys_gs-off', '8Phys_gs-td']
+
+
+@pytest.mark.parametrize('spec', [{"name": "8Phys"},
+                                  {"name": "8Phys", "grid": {"confounds.gs": []}},
+                                  {"name": "8Phys", "grid": {"confounds.gs.fd_th": [1]}},
+                                  # Both thresholds are labelled FD5
+                                  {"name": "8Phys_spikes-FD{spikes.fd_th}", "base": "pipeline-24HMP_8Phys",
+                                   "grid": {"spikes.fd_th": [0.5, 0.50000001]}}])
+def test_invalid_specification_raises(spec):
+    with pytest.raises(ValueError):
+        expand_grid(spec)
+
+
+def test_spike_grid_shares_confounds():
+    shared = shared_stages(expand_grid(SPIKES_GRID))
+    assert {stages['confounds'] for stages in shared.values()} == {'24HMP_8Phys_spikes-FD2_DVARS0'}
+    assert summarize_shared(shared) == {'confounds': 1, 'spikes': 4, 'design': 4}
+
+
+def test_equivalent_designs_share_representative():
+    pipelines = expand_grid({"name": "8Phys", "base": "pipeline-24HMP_8Phys",
+                             "grid": {"confounds.gs": [{"temp_deriv": False, "quad_terms": False},
+                                                       {"temp_deriv": False, "quad_terms": True}],
+                                      "spikes": [False, {"fd_th": 0, "dvars_th": 0}]}})
+    # Quadratic terms without derivatives and spikes without thresholds have no effect
+    shared = shared_stages(pipelines)
+    assert len({stages['design'] for stages in shared.values()}) == 1
+    assert all(stages['design'] == pipelines[0]['name'] for stages in shared.values())
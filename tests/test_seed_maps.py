@@ -0,0 +1,38 @@
+import os
+import numpy as np
+import nibabel as nb
+import pytest
+
+from RestingfMRI_Denoise.utils.seed_maps import seed_to_voxel_correlation
+
+
+@pytest.fixture
+def denoised(tmp_path):
+    rng = np.random.default_rng(7)
+    data = rng.standard_normal((10, 9, 8, 60)).astype(np.float32)
+    # Shared signal in one corner, correlated with seed placed there
+    data[:4, :4, :4] += 2 * rng.standard_normal(60).astype(np.float32)
+    path = str(tmp_path / 'denoised.nii.gz')
+    nb.Nifti1Image(data, np.diag([2., 2., 2., 1.])).to_filename(path)
+    return path, data
+
+
+def test_gzipped_image_is_decompressed_once(tmp_path, denoised, decompressed_bytes):
+    path, data = denoised
+    # Slab of one slice, so image is read in many slabs in both passes
+    seed_to_voxel_correlation(path, ['PCC:2,2,2'], radius=2., chunk_mb=0, tmp_dir=str(tmp_path))
+    image_bytes = 352 + data.nbytes
+    assert decompressed_bytes['bytes'] <= image_bytes
+    # Temporary uncompressed copy is removed
+    assert sorted(os.listdir(tmp_path)) == ['denoised.nii.gz']
+
+
+def test_correlation_matches_direct_computation(tmp_path, denoised):
+    path, data = denoised
+    maps = seed_to_voxel_correlation(path, ['PCC:2,2,2'], radius=2., chunk_mb=0, tmp_dir=str(tmp_path))
+    world = np.indices(data.shape[:3]).reshape(3, -1) * 2.
+    seed = (np.linalg.norm(world - 2., axis=0) <= 2.).reshape(data.shape[:3])
+    seed_signal = data[seed].astype(np.float64).mean(axis=0)
+    voxels = data.reshape(-1, data.shape[3]).astype(np.float64)
+    expected = np.array([np.corrcoef(voxel, seed_signal)[0, 1] for voxel in voxels]).reshape(data.shape[:3])
+    np.testing.assert_allclose(maps['PCC'], expected, atol=1e-5)
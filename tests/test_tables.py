@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+
+from RestingfMRI_Denoise.utils.tables import save_table, read_table, TABLE_EXTENSION
+
+
+def group_table():
+    return pd.DataFrame({'subject': ['01', '02', '03'],
+                         # Runs without session have 0, as in group confounds summary
+                         'session': ['1', 0, '2'],
+                         'mean_fd': [0.1, 0.25, np.nan],
+                         'n_spikes': [0, 3, 12],
+                         'include': [True, False, True],
+                         '24HMP_8Phys': np.linspace(-1, 1, 3, dtype=np.float32)})
+
+
+def test_round_trip(tmp_path):
+    table = group_table()
+    path = save_table(table, str(tmp_path / 'group_conf_summary'))
+    assert path.endswith(TABLE_EXTENSION)
+    restored = read_table(path)
+    assert list(restored.columns) == list(table.columns)
+    # Mixed columns are stored as text
+    assert restored['session'].tolist() == ['1', '0', '2']
+    pdt.assert_frame_equal(restored.drop(columns='session'), table.drop(columns='session'))
+
+
+def test_tsv_export_is_readable(tmp_path):
+    table = group_table()
+    save_table(table, str(tmp_path / 'group_conf_summary'), tsv=True)
+    restored = read_table(str(tmp_path / 'group_conf_summary.tsv'))
+    pdt.assert_frame_equal(restored[['mean_fd', 'n_spikes', 'include']], table[['mean_fd', 'n_spikes', 'include']])
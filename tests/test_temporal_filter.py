@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from nilearn.signal import butterworth, clean
+
+from RestingfMRI_Denoise.utils.temporal_filter import fft_filter, prepare_confounds, clean_signals
+
+# Relative error to nilearn reached on runs below (limited by precision of transfer function
+# coefficients used by nilearn at short TR, see fft_filter)
+RELATIVE_TOLERANCE = 1e-5
+RUNS = [(200, 2.), (150, 1.), (300, .72)]
+BANDS = [(.01, .1), (.01, None), (None, .1), (.008, .08)]
+
+
+def random_walk(n_timepoints, n_columns=20, seed=4):
+    """Drifting signals, so run edges are far from zero."""
+    return np.cumsum(np.random.default_rng(seed).standard_normal((n_timepoints, n_columns)), axis=0) + 10.
+
+
+@pytest.mark.parametrize('n_timepoints, t_r', RUNS)
+@pytest.mark.parametrize('high_pass, low_pass', BANDS)
+def test_fft_filter_matches_butterworth(n_timepoints, t_r, high_pass, low_pass):
+    signals = random_walk(n_timepoints)
+    expected = butterworth(signals, 1. / t_r, high_pass=high_pass, low_pass=low_pass, copy=True)
+    error = np.abs(fft_filter(signals, t_r, high_pass, low_pass) - expected).max()
+    assert error <= RELATIVE_TOLERANCE * np.abs(signals).max()
+
+
+@pytest.mark.parametrize('n_timepoints, t_r', RUNS)
+def test_clean_signals_matches_nilearn(n_timepoints, t_r):
+    signals = random_walk(n_timepoints)
+    confounds = np.random.default_rng(5).standard_normal((n_timepoints, 4))
+    expected = clean(signals, confounds=confounds, t_r=t_r, high_pass=.01, low_pass=.1,
+                     detrend=True, standardize='zscore')
+    cleaned = clean_signals(signals, prepare_confounds(confounds, t_r, .01, .1), t_r, .01, .1)
+    # Cleaned signals have unit variance
+    np.testing.assert_allclose(cleaned, expected, atol=10 * RELATIVE_TOLERANCE)
+
+
+def test_no_band_returns_signals():
+    signals = random_walk(50)
+    assert fft_filter(signals, 2.) is signals
+
+
+def test_inverted_band_raises():
+    with pytest.raises(ValueError):
+        fft_filter(random_walk(50), 2., high_pass=.1, low_pass=.01)
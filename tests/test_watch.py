@@ -0,0 +1,59 @@
+import pytest
+
+from RestingfMRI_Denoise.workflows import executor
+
+PIPELINES = [{'name': 'A'}, {'name': 'B'}]
+
+
+def make_runs(n_runs):
+    return [{'entities': {'subject': f'{i:02d}', 'task': 'rest'}} for i in range(n_runs)]
+
+
+@pytest.fixture
+def watcher(monkeypatch, tmp_path):
+    """watch_denoise with per-run stages replaced by runs found in the first
+    poll and processed with given include flags."""
+    def watch(runs, include, group_stages):
+        polls = [runs]
+        monkeypatch.setattr(executor, '_make_options', lambda *args, **kwargs: {'group_dir': str(tmp_path)})
+        monkeypatch.setattr(executor, 'load_pipelines', lambda paths: PIPELINES)
+        monkeypatch.setattr(executor, 'grab_runs', lambda *args, **kwargs: polls.pop() if polls else runs)
+        monkeypatch.setattr(executor, 'changed_runs', lambda grabbed, failed: [])
+        monkeypatch.setattr(executor, 'stable_runs', lambda found, *args: found)
+        monkeypatch.setattr(executor, '_preflight_watched', lambda new, *args: new)
+        monkeypatch.setattr(executor, '_denoise_watched', lambda new, pipelines, *args: (
+            new, [{'conf_summary': {'include': [flag]}, 'records': []} for _ in pipelines for flag in include]))
+        monkeypatch.setattr(executor, 'group_stages', group_stages)
+        monkeypatch.setattr(executor.time, 'sleep', lambda seconds: None)
+        return executor.watch_denoise(str(tmp_path), pipelines_paths=[], group_interval=0, exit_idle=.2,
+                                      pool=object())
+    return watch
+
+
+def test_failed_group_refresh_is_retried(watcher):
+    calls = []
+
+    def group_stages(runs, *args):
+        calls.append(len(runs))
+        if len(calls) == 1:
+            raise ValueError("x and y must have length at least 2")
+
+    result = watcher(make_runs(3), [1, 1, 1], group_stages)
+    assert result['runs'] == 3
+    # First refresh failed, watcher kept polling and refreshed group QC once more
+    assert calls == [3, 3]
+
+
+def test_group_waits_for_included_runs(watcher):
+    calls = []
+    result = watcher(make_runs(3), [1, 0, 0], lambda runs, *args: calls.append(len(runs)))
+    assert result['runs'] == 3
+    assert calls == []
+
+
+def test_included_runs_is_minimum_over_pipelines():
+    runs = make_runs(3)
+    pair_outputs = {(executor.run_key(run['entities']), pipeline['name']): {'conf_summary': {'include': [flag]}}
+                    for pipeline, flags in zip(PIPELINES, ([1, 1, 1], [1, 0, 1]))
+                    for run, flag in zip(runs, flags)}
+    assert executor.included_runs(runs, PIPELINES, pair_outputs) == 2